@@ -0,0 +1,302 @@
+"""ASGI-режим бота (asyncio) з тими самими хендлерами, що й Flask-режим у main.py.
+
+Запуск:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Вебхук приймається асинхронно, а process_update() виконується в пулі з
+ASGI_HANDLER_THREADS потоків: хендлери (handle_feed, process_fight, ...) і шар
+storage синхронні, тож однакова логіка гри в обох режимах. Асинхронна частина —
+доставка: замість одного потоку outbox, що надсилає повідомлення по черзі,
+відповіді йдуть через httpx.AsyncClient до ASGI_MAX_INFLIGHT_SENDS запитів до
+Telegram одночасно (повідомлення одного чату — по порядку).
+
+Запити до БД з доставки (оренда outbox, позначки sent/retry/failed, last_message_id
+для чистки чату) під Postgres ідуть через asyncpg — пул до ASGI_DELIVERY_DB_POOL
+з'єднань у циклі подій, без потоків. Під SQLite asyncpg ні до чого, і ці запити
+виконуються в окремому пулі з ASGI_DELIVERY_THREADS потоків. В обох випадках
+доставка не забирає в хендлерів ні потоків, ні з'єднань.
+
+Хендлери лишаються на psycopg2. Читання і запис players/inventory у них — це
+read-modify-write під player_lock (pg_advisory_xact_lock) в одній транзакції.
+Щоб перенести їх на asyncpg, хендлери довелося б переписати як корутини, тобто
+мати другу копію логіки гри і SQL. Читати рядки наперед через asyncpg поза
+блокуванням не можна: паралельний апдейт того самого гравця дасть втрачений запис.
+Тож одночасних запитів хендлерів до БД не більше ніж ASGI_HANDLER_THREADS.
+
+Порівняння з Flask-режимом: bench_engines.py.
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import asyncpg
+import httpx
+
+import main
+
+ASGI_HANDLER_THREADS = int(os.getenv('ASGI_HANDLER_THREADS', str(main.DB_POOL_MAX)))
+ASGI_MAX_INFLIGHT_SENDS = int(os.getenv('ASGI_MAX_INFLIGHT_SENDS', '200'))
+ASGI_DELIVERY_DB_POOL = int(os.getenv('ASGI_DELIVERY_DB_POOL', '20'))
+ASGI_DELIVERY_THREADS = int(os.getenv('ASGI_DELIVERY_THREADS', '4'))
+
+WEBHOOK_PATH = f"/{main.TELEGRAM_TOKEN}"
+METRICS_PATH = f"/{main.TELEGRAM_TOKEN}/metrics"
+
+
+class AsyncpgDeliveryStore:
+    """Запити доставки outbox через asyncpg (Postgres): ті самі методи, що в storage,
+    але корутини. Advisory locks тут не потрібні — рядки outbox орендуються через SKIP LOCKED."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @classmethod
+    async def connect(cls, dsn, max_size=ASGI_DELIVERY_DB_POOL):
+        return cls(await asyncpg.create_pool(dsn, min_size=1, max_size=max_size))
+
+    async def close(self):
+        await self.pool.close()
+
+    async def claim_outbox(self, limit, now, lease_until):
+        rows = await self.pool.fetch("""
+            UPDATE outbox SET next_attempt_at=$2
+            WHERE id IN (SELECT id FROM outbox WHERE status='pending' AND next_attempt_at <= $1
+                         ORDER BY id LIMIT $3 FOR UPDATE SKIP LOCKED)
+            RETURNING id, chat_id, user_ids, text, reply_markup, delete_message_id, attempts, created_at""",
+            now, lease_until, limit)
+        return [dict(r, user_ids=json.loads(r['user_ids']), reply_markup=json.loads(r['reply_markup']) if r['reply_markup'] else None)
+                for r in rows]
+
+    async def mark_outbox_sent(self, message_id, ts):
+        await self.pool.execute("UPDATE outbox SET status='sent', sent_at=$1, attempts=attempts+1, last_error=NULL WHERE id=$2",
+                                ts, message_id)
+
+    async def mark_outbox_retry(self, message_id, attempts, next_attempt_at, error):
+        await self.pool.execute("UPDATE outbox SET attempts=$1, next_attempt_at=$2, last_error=$3 WHERE id=$4",
+                                attempts, next_attempt_at, error, message_id)
+
+    async def mark_outbox_failed(self, message_id, attempts, error):
+        await self.pool.execute("UPDATE outbox SET status='failed', attempts=$1, last_error=$2 WHERE id=$3",
+                                attempts, error, message_id)
+
+    async def mark_chat_blocked(self, chat_id, reason, ts):
+        await self.pool.execute("""INSERT INTO blocked_chats (chat_id, reason, blocked_at) VALUES ($1,$2,$3)
+                                   ON CONFLICT (chat_id) DO UPDATE SET reason=excluded.reason, blocked_at=excluded.blocked_at""",
+                                chat_id, reason, ts)
+
+    async def outbox_backlog(self, now):
+        return await self.pool.fetchval("SELECT COUNT(*) FROM outbox WHERE status='pending' AND next_attempt_at <= $1", now)
+
+    async def purge_outbox(self, before):
+        await self.pool.execute("DELETE FROM outbox WHERE status != 'pending' AND created_at < $1", before)
+
+    async def cleanup_targets(self, chat_id, user_ids):
+        """Як main.cleanup_targets(): попередні відповіді бота цим гравцям."""
+        if chat_id >= 0 or main.pressure.degrade(main.pressure.SKIP_CLEANUP, "pressure.skip_cleanup"):
+            return []
+        async with self.pool.acquire() as conn:
+            if await conn.fetchval("SELECT cleanup_enabled FROM players WHERE chat_id=$1 LIMIT 1", chat_id) is False:
+                return []
+            rows = await conn.fetch("SELECT user_id, last_message_id FROM players WHERE chat_id=$1 AND user_id = ANY($2::bigint[])",
+                                    chat_id, user_ids)
+        last = {r['user_id']: r['last_message_id'] for r in rows}
+        targets = []
+        for user_id in user_ids:
+            if last.get(user_id) and last[user_id] not in targets:
+                targets.append(last[user_id])
+        return targets
+
+    async def record_delivery(self, chat_id, user_ids, data):
+        if data.get('ok') and user_ids:
+            await self.pool.execute("UPDATE players SET last_message_id=$1 WHERE chat_id=$2 AND user_id = ANY($3::bigint[])",
+                                    data['result']['message_id'], chat_id, user_ids)
+
+
+class ThreadedDeliveryStore:
+    """Ті самі запити доставки через синхронний storage (SQLite) в окремому пулі потоків."""
+
+    FUNCTIONS = {'cleanup_targets': main.cleanup_targets, 'record_delivery': main.record_delivery}
+
+    def __init__(self, threads=ASGI_DELIVERY_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='delivery')
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+    def __getattr__(self, name):
+        fn = self.FUNCTIONS.get(name) or getattr(main.storage, name)
+
+        async def call(*args):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        return call
+
+
+class AsyncOutboxSender(main.OutboxSender):
+    """Outbox, що доставляє пачку паралельно по чатах у циклі подій."""
+
+    def __init__(self, store, max_inflight=ASGI_MAX_INFLIGHT_SENDS):
+        super().__init__(batch_size=max_inflight, background=False)
+        self.store = store
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._event = asyncio.Event()
+        self._loop = None
+        self._client = None
+
+    def wake(self):
+        # enqueue() викликається з потоків хендлерів
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def run(self, client):
+        self._loop = asyncio.get_running_loop()
+        self._client = client
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            try:
+                await self.drain_async()
+                main.pressure.queue_depth = await self.store.outbox_backlog(main.now_utc())
+            except Exception as e:
+                print('async outbox error:', e)
+
+    async def drain_async(self):
+        sent = 0
+        while True:
+            now = main.now_utc()
+            batch = await self.store.claim_outbox(self.batch_size, now, now + timedelta(seconds=self.LEASE_SECONDS))
+            if not batch:
+                break
+            by_chat = {}
+            for msg in sorted(batch, key=lambda m: m['id']):
+                by_chat.setdefault(msg['chat_id'], []).append(msg)
+            sent += sum(await asyncio.gather(*(self._send_chat(msgs) for msgs in by_chat.values())))
+            if len(batch) < self.batch_size:
+                break
+        if time.monotonic() - self._purged_at >= self.PURGE_EVERY_SECONDS:
+            self._purged_at = time.monotonic()
+            await self.store.purge_outbox(main.now_utc() - timedelta(hours=main.OUTBOX_RETENTION_HOURS))
+        return sent
+
+    async def _send_chat(self, msgs):
+        """Повідомлення одного чату по черзі; після невдачі решта чекає, як у drain()."""
+        sent, postponed = 0, None
+        for msg in msgs:
+            if postponed is not None:
+                await self.store.mark_outbox_retry(msg['id'], msg['attempts'], postponed, 'waiting for earlier message')
+                continue
+            retry_at = await self._send_async(msg)
+            if retry_at is None:
+                sent += 1
+            else:
+                postponed = retry_at
+        return sent
+
+    async def _settle(self, msg, data, error=None):
+        retry_at, writes = self.outcome(msg, data, error)
+        for method, args in writes:
+            await getattr(self.store, method)(*args)
+        return retry_at
+
+    async def _post(self, method, payload):
+        r = await self._client.post(main.telegram_url(method), json=payload, timeout=10)
+        return r.json()
+
+    async def _send_async(self, msg):
+        chat_id, user_ids = msg['chat_id'], msg['user_ids']
+        async with self._slots:
+            if msg['delete_message_id']:
+                try:
+                    data = await self._post('deleteMessage', {"chat_id": chat_id, "message_id": msg['delete_message_id']})
+                except Exception as e:
+                    return await self._settle(msg, None, str(e))
+                return await self._settle(msg, data)
+            try:
+                targets = await self.store.cleanup_targets(chat_id, user_ids)
+                await asyncio.gather(*(self._post('deleteMessage', {"chat_id": chat_id, "message_id": m}) for m in targets),
+                                     return_exceptions=True)
+                data = await self._post('sendMessage', main.message_payload(chat_id, msg['text'], msg['reply_markup']))
+            except Exception as e:
+                return await self._settle(msg, None, str(e))
+        await self.store.record_delivery(chat_id, user_ids, data)
+        return await self._settle(msg, data)
+
+
+executor = ThreadPoolExecutor(max_workers=ASGI_HANDLER_THREADS, thread_name_prefix='handler')
+
+
+async def _respond(send, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    tasks, stores = [], []
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, main.get_bot_username)
+            client = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASGI_MAX_INFLIGHT_SENDS))
+            if main.DATABASE_URL:
+                await loop.run_in_executor(executor, main.init_db)
+                if main.OUTBOX_ENABLED:
+                    if main.storage.name == 'postgres':
+                        store = await AsyncpgDeliveryStore.connect(main.DATABASE_URL)
+                    else:
+                        store = ThreadedDeliveryStore()
+                    stores.append(store)
+                    sender = AsyncOutboxSender(store)
+                    main.outbox = sender  # send_message/enqueue у хендлерах тепер будять цей відправник
+                    tasks.append(asyncio.create_task(sender.run(client)))
+                main.start_background_jobs()
+            await loop.run_in_executor(executor, main.set_webhook)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for task in tasks:
+                task.cancel()
+            for store in stores:
+                await store.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    path, method = scope['path'], scope['method']
+    if path == WEBHOOK_PATH and method == 'POST':
+        headers = dict(scope['headers'])
+        secret = headers.get(b'x-telegram-bot-api-secret-token', b'').decode('latin-1') or None
+        status, reply, update = main.accept_update(secret, await _read_body(receive))
+        if update is not None:
+            try:
+                reply = await asyncio.get_running_loop().run_in_executor(executor, main.run_webhook_update, update) or reply
+            except Exception as e:
+                print('update error:', e)
+                await _respond(send, 500, {'ok': False})  # Telegram повторить апдейт
+                return
+        await _respond(send, status, reply)
+    elif path == METRICS_PATH and method == 'GET':
+        await _respond(send, 200, main.metrics_snapshot())
+    else:
+        await _respond(send, 404, {'ok': False})
@@ -0,0 +1,199 @@
+"""Бенчмарк: Flask-режим (python main.py) проти ASGI-режиму (uvicorn asgi:app).
+
+Приклади:
+    python bench_engines.py                                  # SQLite у тимчасовій теці
+    python bench_engines.py --updates 2000 --concurrency 40 --latency-ms 80
+    python bench_engines.py --db postgresql://... --engines asgi
+
+Обидва режими запускаються окремими процесами проти заглушки Bot API з заданою
+затримкою (TELEGRAM_API_URL). Навантажувач шле апдейти з --concurrency паралельними
+з'єднаннями, як Telegram з max_connections, і міряє затримку вебхука, а потім чекає,
+доки outbox доставить усі відповіді (лічильники з /metrics). Для Postgres база має
+бути порожньою тестовою — бенчмарк створює гравців.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+TOKEN = 'bench'
+SECRET = 'bench-secret'
+COMMANDS = ('/feed', '/zonewalk', '/pet', '/wheel', '/top', '/inventory')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def stub_app(latency):
+    """Заглушка Bot API: кожен виклик чекає `latency` с і відповідає ok."""
+    message_ids = itertools.count(1)
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        while (await receive()).get('more_body'):
+            pass
+        await asyncio.sleep(latency)
+        method = scope['path'].rsplit('/', 1)[-1]
+        if method == 'sendMessage':
+            result = {"message_id": next(message_ids)}
+        elif method == 'getMe':
+            result = {"username": "bench_bot"}
+        elif method == 'getChatMember':
+            result = {"status": "member"}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+    return app
+
+
+def start_stub(port, latency):
+    code = (f"import uvicorn, bench_engines; "
+            f"uvicorn.run(bench_engines.stub_app({latency}), host='127.0.0.1', port={port}, log_level='warning')")
+    return subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_engine(engine, port, env):
+    if engine == 'flask':
+        cmd = [sys.executable, 'main.py']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+    # Логи запитів Flask/uvicorn не потрібні; помилки видно в колонці errors
+    return subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+def make_update(update_id, chats, users):
+    chat_id = -1000 - update_id % chats
+    user_id = 1 + update_id % users
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "chat": {"id": chat_id, "type": "group"},
+        "from": {"id": user_id, "username": f"u{user_id}"},
+        "text": COMMANDS[update_id // users % len(COMMANDS)]}}
+
+
+async def load(base, n, concurrency, chats, users):
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(1, n + 1):
+        queue.put_nowait(make_update(i, chats, users))
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            update = queue.get_nowait()
+            t0 = time.perf_counter()
+            try:
+                r = await client.post(f"{base}/{TOKEN}", json=update, headers={'X-Telegram-Bot-Api-Secret-Token': SECRET})
+                if r.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - t0)
+
+    async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=concurrency)) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return time.perf_counter() - started, sorted(latencies), errors
+
+
+async def wait_delivered(base, timeout):
+    """Час, доки outbox не доставить усе поставлене в чергу (за лічильниками /metrics)."""
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=10) as client:
+        while time.perf_counter() - started < timeout:
+            counters = (await client.get(f"{base}/{TOKEN}/metrics")).json()['counters']
+            done = counters.get('outbox.sent', 0) + counters.get('outbox.failed', 0)
+            if done >= counters.get('outbox.enqueued', 0):
+                return time.perf_counter() - started, counters
+            await asyncio.sleep(0.05)
+    return None, counters
+
+
+def run_engine(engine, args, api_url, workdir):
+    port = free_port()
+    db = args.db or f"sqlite:///{os.path.join(workdir, engine + '.db')}"
+    env = dict(os.environ, TELEGRAM_TOKEN=TOKEN, TELEGRAM_API_URL=api_url, DATABASE_URL=db, PORT=str(port),
+               WEBHOOK_SECRET_TOKEN=SECRET, OUTBOX_POLL_SECONDS='0.2', DIGEST_ENABLED='0', PRESSURE_ENABLED='0')
+    env.pop('WEBHOOK_BASE_URL', None)
+    env.pop('CAPTURE_DIR', None)
+    proc = start_engine(engine, port, env)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        async def scenario():
+            async with httpx.AsyncClient() as client:
+                await wait_ready(client, f"{base}/{TOKEN}/metrics")
+            elapsed, latencies, errors = await load(base, args.updates, args.concurrency, args.chats, args.users)
+            delivered, counters = await wait_delivered(base, args.timeout)
+            return elapsed, latencies, errors, delivered, counters
+        elapsed, latencies, errors, delivered, counters = asyncio.run(scenario())
+    finally:
+        proc.terminate()
+        proc.wait()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    return {
+        "engine": engine,
+        "upd/s": round(len(latencies) / elapsed, 1),
+        "p50 ms": round(pct(0.50), 1),
+        "p95 ms": round(pct(0.95), 1),
+        "errors": errors,
+        "sent": counters.get('outbox.sent', 0),
+        "end-to-end s": round(elapsed + delivered, 2) if delivered is not None else 'timeout',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Flask and ASGI engines")
+    parser.add_argument('--engines', default='flask,asgi')
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=40, help="як WEBHOOK_MAX_CONNECTIONS")
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=50, help="затримка заглушки Bot API")
+    parser.add_argument('--timeout', type=float, default=300, help="скільки чекати доставки")
+    parser.add_argument('--db', help="DATABASE_URL (за замовчуванням — свій SQLite на кожен режим)")
+    args = parser.parse_args()
+
+    stub_port = free_port()
+    stub = start_stub(stub_port, args.latency_ms / 1000)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for engine in args.engines.split(','):
+                print(f"running {engine}...", file=sys.stderr)
+                results.append(run_engine(engine, args, f"http://127.0.0.1:{stub_port}", workdir))
+    finally:
+        stub.terminate()
+        stub.wait()
+    columns = list(results[0])
+    print("  ".join(f"{c:>13}" for c in columns))
+    for row in results:
+        print("  ".join(f"{row[c]!s:>13}" for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Розсилка оголошення в усі чати, де є пацєтки (лише для оператора, з консолі).
+
+Приклади:
+    python broadcast.py send "Нова механіка: /royale!"      # створити розсилку і почати
+    python broadcast.py send --file announce.txt --rate 10
+    python broadcast.py resume 3                             # продовжити після рестарту
+    python broadcast.py status                               # останні розсилки
+
+Чати читаються серверним курсором по зростанню chat_id, а після кожного чату
+позиція (last_chat_id) зберігається в broadcasts — resume продовжує з наступного.
+Помилки доставки пишуться в broadcast_failures; чати, де бота заблокували або
+вигнали (403), потрапляють у blocked_chats і наступні розсилки їх пропускають.
+"""
+import argparse
+import os
+import sys
+import time
+
+
+class RateLimiter:
+    """Не більше `rate` викликів wait() за секунду, рівномірно."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+    def pause(self, seconds):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+def send_to_chat(bot, chat_id, text, limiter, max_retries=5):
+    """None, якщо доставлено; інакше текст помилки. 429 чекає retry_after і повторює."""
+    for _ in range(max_retries):
+        limiter.wait()
+        try:
+            data = bot.deliver_message(chat_id, [], text)
+        except Exception as e:
+            error = str(e)
+            limiter.pause(2)
+            continue
+        if data.get('ok'):
+            return None
+        error = f"{data.get('error_code')}: {data.get('description')}"
+        if data.get('error_code') == 429:
+            limiter.pause((data.get('parameters') or {}).get('retry_after', 1))
+            continue
+        if data.get('error_code') == 403 or (data.get('error_code') == 400 and 'chat not found' in str(data.get('description'))):
+            bot.storage.mark_chat_blocked(chat_id, error, bot.now_utc())
+        return error
+    return error
+
+
+def run_broadcast(bot, broadcast_id, rate):
+    broadcast = bot.storage.get_broadcast(broadcast_id)
+    if broadcast is None:
+        raise SystemExit(f"broadcast {broadcast_id} not found")
+    if broadcast['finished_at']:
+        print(f"broadcast {broadcast_id} already finished at {broadcast['finished_at']}")
+        return broadcast
+    limiter = RateLimiter(rate)
+    sent, failed = broadcast['sent'], broadcast['failed']
+    started, printed = time.perf_counter(), 0.0
+    for chat_id in bot.storage.iter_broadcast_chats(broadcast['last_chat_id']):
+        error = send_to_chat(bot, chat_id, broadcast['text'], limiter)
+        bot.storage.checkpoint_broadcast(broadcast_id, chat_id, error)
+        if error is None:
+            sent += 1
+        else:
+            failed += 1
+            print(f"  chat {chat_id}: {error}", file=sys.stderr)
+        now = time.perf_counter()
+        if now - printed >= 5:
+            printed = now
+            print(f"  sent {sent}, failed {failed}, {(sent + failed) / (now - started):.1f} chats/s", file=sys.stderr)
+    bot.storage.finish_broadcast(broadcast_id, bot.now_utc())
+    print(f"broadcast {broadcast_id}: sent {sent}, failed {failed}")
+    return bot.storage.get_broadcast(broadcast_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast an announcement to every chat")
+    sub = parser.add_subparsers(dest='command', required=True)
+    send = sub.add_parser('send', help="створити розсилку і почати")
+    send.add_argument('text', nargs='?')
+    send.add_argument('--file', help="взяти текст з файлу")
+    resume = sub.add_parser('resume', help="продовжити перервану розсилку")
+    resume.add_argument('id', type=int)
+    status = sub.add_parser('status', help="стан останніх розсилок")
+    status.add_argument('--limit', type=int, default=10)
+    for p in (send, resume):
+        p.add_argument('--rate', type=float, default=20.0, help="повідомлень за секунду (Telegram: ~30 загалом)")
+    for p in (send, resume, status):
+        p.add_argument('--db', default=os.getenv('DATABASE_URL'), help="DATABASE_URL (за замовчуванням з оточення)")
+    args = parser.parse_args()
+    if not args.db:
+        parser.error("--db or DATABASE_URL is required")
+    if args.command == 'send':
+        if args.file:
+            with open(args.file, encoding='utf-8') as fh:
+                args.text = fh.read().strip()
+        if not args.text:
+            parser.error("text or --file is required")
+
+    os.environ['DATABASE_URL'] = args.db
+    os.environ.pop('WEBHOOK_BASE_URL', None)
+    import main as bot
+    bot.init_db()
+
+    if args.command == 'status':
+        for b in bot.storage.list_broadcasts(args.limit):
+            state = f"finished {b['finished_at']}" if b['finished_at'] else f"at chat {b['last_chat_id']}"
+            print(f"#{b['id']} {b['created_at']}: sent {b['sent']}, failed {b['failed']}, {state} — {b['text'][:60]!r}")
+        return
+    broadcast_id = bot.storage.create_broadcast(args.text, bot.now_utc()) if args.command == 'send' else args.id
+    print(f"broadcast {broadcast_id} started")
+    run_broadcast(bot, broadcast_id, args.rate)
+
+
+if __name__ == '__main__':
+    main()
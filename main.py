@@ -1,23 +1,104 @@
 import os
 from flask import Flask, request, jsonify
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
 import requests
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
+from contextlib import contextmanager, nullcontext
 import random
 import math
+import sqlite3
+import threading
+import time
+import json
+import re
+import itertools
+import gzip
+import glob
+import csv
+import io
+import atexit
+import hashlib
+import hmac
+import base64
+from abc import ABC, abstractmethod
 
 # === Configuration from environment ===
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL')
 DATABASE_URL = os.getenv('DATABASE_URL')
 PORT = int(os.getenv('PORT', '8080'))
-
-# === NEW FEATURE: Смерть і вербування (New parameters) ===
-STARTING_WEIGHT = 10
-DAILY_RECRUITS_LIMIT = 1
-MAX_RECRUITED_PETS = 3
-# ==========================================================
+# Bot API; можна вказати локальний telegram-bot-api сервер або заглушку для бенчмарку
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Реєстрація вебхука: які апдейти надсилає Telegram і скільки паралельних з'єднань відкриває
+WEBHOOK_ALLOWED_UPDATES = [u for u in os.getenv('WEBHOOK_ALLOWED_UPDATES', 'message,edited_message,callback_query,my_chat_member').split(',') if u]
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Секрет у заголовку X-Telegram-Bot-Api-Secret-Token; за замовчуванням виводиться з токена бота.
+# Перевіряється, лише якщо його задано явно або цей процес сам зареєстрував його в setWebhook —
+# інакше вебхук, зареєстрований вручну чи раніше (без секрету), втратив би всі апдейти
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()[:48]
+webhook_secret_required = bool(os.getenv('WEBHOOK_SECRET_TOKEN'))
+# Підпис callback_data inline-кнопок (HMAC) і скільки секунд кнопка дійсна; ключ за замовчуванням виводиться з токена бота
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET') or hashlib.sha256(f"callback:{TELEGRAM_TOKEN}".encode()).hexdigest()
+CALLBACK_TTL_SECONDS = int(os.getenv('CALLBACK_TTL_SECONDS', '600'))
+# Репліка для чистих читань (/top, /inventory, списки суперників); без неї все йде в primary
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.getenv('REPLICA_CHECK_SECONDS', '2'))
+# Запис вхідних апдейтів для відтворення (replay.py); вимкнено, якщо CAPTURE_DIR не задано
+CAPTURE_DIR = os.getenv('CAPTURE_DIR')
+CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_BYTES', str(64 * 1024 * 1024)))
+CAPTURE_KEEP_FILES = int(os.getenv('CAPTURE_KEEP_FILES', '20'))
+# /globaltop: скільки пацєток показувати і як часто перечитувати топ з БД (зміни інших воркерів)
+GLOBAL_TOP_SIZE = int(os.getenv('GLOBAL_TOP_SIZE', '10'))
+GLOBAL_TOP_REFRESH_SECONDS = float(os.getenv('GLOBAL_TOP_REFRESH_SECONDS', '300'))
+# Outbox: відповіді пишуться в таблицю outbox разом зі зміною стану гри, фоновий відправник їх доставляє
+OUTBOX_ENABLED = os.getenv('OUTBOX_ENABLED', '1') == '1'
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '1'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETENTION_HOURS = float(os.getenv('OUTBOX_RETENTION_HOURS', '24'))
+# Щит кулдаунів у пам'яті: скільки разів відповідати на повтор до тиші і скільки жити
+# блокуванням, що залежать від стану (смерть, порожній інвентар), а не лише від часу
+SHIELD_REPLY_REPEATS = int(os.getenv('SHIELD_REPLY_REPEATS', '2'))
+SHIELD_STATE_TTL_SECONDS = float(os.getenv('SHIELD_STATE_TTL_SECONDS', '30'))
+# Деградація під навантаженням: межі in-flight апдейтів, очікування з'єднання з пулом і черги outbox,
+# при яких бот вважається перевантаженим (навантаження 1.0)
+PRESSURE_ENABLED = os.getenv('PRESSURE_ENABLED', '1') == '1'
+PRESSURE_MAX_INFLIGHT = int(os.getenv('PRESSURE_MAX_INFLIGHT', '32'))
+PRESSURE_POOL_WAIT_MS = float(os.getenv('PRESSURE_POOL_WAIT_MS', '200'))
+PRESSURE_QUEUE_DEPTH = int(os.getenv('PRESSURE_QUEUE_DEPTH', '500'))
+# Холодний архів: пацєтки без жодної команди ARCHIVE_AFTER_DAYS днів переносяться в players_archive
+# (0 — вимкнено); перевірка раз на ARCHIVE_CHECK_SECONDS, пачками по ARCHIVE_BATCH_SIZE
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_CHECK_SECONDS = float(os.getenv('ARCHIVE_CHECK_SECONDS', '3600'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+# Нічний дайджест по чатах за минулу добу UTC (потребує EVENTS_ENABLED): запуск о 00:00 UTC + DIGEST_DELAY_SECONDS,
+# доставка розтягується до DIGEST_CHATS_PER_SECOND чатів за секунду
+DIGEST_ENABLED = os.getenv('DIGEST_ENABLED', '1') == '1'
+DIGEST_DELAY_SECONDS = float(os.getenv('DIGEST_DELAY_SECONDS', '60'))
+DIGEST_CHATS_PER_SECOND = float(os.getenv('DIGEST_CHATS_PER_SECOND', '10'))
+# Нагадування "пацєтко готове" (/remind): крок колеса таймерів і як часто підбирати прострочені
+# нагадування, заплановані іншими воркерами
+REMINDERS_ENABLED = os.getenv('REMINDERS_ENABLED', '1') == '1'
+REMINDER_TICK_SECONDS = float(os.getenv('REMINDER_TICK_SECONDS', '1'))
+REMINDER_SWEEP_SECONDS = float(os.getenv('REMINDER_SWEEP_SECONDS', '300'))
+# Скільки днів історії ваги показує /stats
+STATS_HISTORY_DAYS = int(os.getenv('STATS_HISTORY_DAYS', '7'))
+# Журнал ігрових подій (таблиця events); буфер скидається пачками у фоні
+EVENTS_ENABLED = os.getenv('EVENTS_ENABLED', '1') == '1'
+EVENTS_FLUSH_SECONDS = float(os.getenv('EVENTS_FLUSH_SECONDS', '5'))
+EVENTS_FLUSH_SIZE = int(os.getenv('EVENTS_FLUSH_SIZE', '500'))
+EVENTS_MAX_BUFFER = int(os.getenv('EVENTS_MAX_BUFFER', '100000'))
+# 'table' — окрема таблиця inventory, 'compact' — jsonb-мапа предметів у рядку players
+INVENTORY_LAYOUT = os.getenv('INVENTORY_LAYOUT', 'table')
+# Баланс гри; файл перечитується при зміні не частіше ніж раз на GAME_CONFIG_CHECK_SECONDS
+GAME_CONFIG_PATH = os.getenv('GAME_CONFIG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'game_config.json'))
+GAME_CONFIG_CHECK_SECONDS = float(os.getenv('GAME_CONFIG_CHECK_SECONDS', '5'))
 
 if not TELEGRAM_TOKEN:
     raise RuntimeError('TELEGRAM_TOKEN is not set in environment variables')
@@ -27,11 +108,14 @@ if not WEBHOOK_BASE_URL:
 app = Flask(__name__)
 BOT_USERNAME = None
 
+def telegram_url(method):
+    return f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/{method}"
+
 def get_bot_username():
     """Отримує username бота з Telegram API."""
     global BOT_USERNAME
     try:
-        r = requests.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getMe", timeout=10)
+        r = requests.get(telegram_url('getMe'), timeout=10)
         data = r.json()
         if data.get("ok"):
             BOT_USERNAME = data["result"]["username"].lower()
@@ -41,173 +125,2278 @@ def get_bot_username():
     except Exception as e:
         print("Error getting bot username:", e)
 
-# === DB helpers ===
-def get_conn():
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+# === Metrics ===
+# Прості лічильники й таймінги в пам'яті процесу. Дивитись: GET /<TOKEN>/metrics
+_metrics_lock = threading.Lock()
+COUNTERS = {}
+TIMINGS = {}  # name -> [calls, total_seconds, max_seconds]
+
+def incr(name, n=1):
+    with _metrics_lock:
+        COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+def record_timing(name, seconds):
+    with _metrics_lock:
+        t = TIMINGS.setdefault(name, [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+@app.route(f"/{TELEGRAM_TOKEN}/metrics", methods=['GET'])
+def metrics_endpoint():
+    return jsonify(metrics_snapshot())
+
+def metrics_snapshot():
+    with _metrics_lock:
+        timings = {
+            name: {"calls": calls, "total_ms": round(total * 1000, 3), "avg_ms": round(total * 1000 / calls, 3), "max_ms": round(mx * 1000, 3)}
+            for name, (calls, total, mx) in TIMINGS.items()
+        }
+        return {"counters": dict(COUNTERS), "timings": timings, "pressure": pressure.snapshot()}
+# ================
+
+# === Storage backends ===
+# Усі SQL-запити до players/inventory живуть тут. Хендлери працюють через
+# функції-хелпери нижче, а ті — через глобальний об'єкт `storage`, тож рушій
+# (керований PostgreSQL або вбудований SQLite) обирається одним DATABASE_URL.
+class SqlStorage(ABC):
+    """Спільна логіка для SQL-рушіїв. Запити пишуться з плейсхолдерами %s."""
+    name = 'sql'
+
+    # Гарячі запити, які виконуються на кожну команду. Postgres готує їх
+    # (PREPARE) один раз на з'єднання пулу і далі виконує за іменем. Тут лише
+    # переносимий SQL; запити з діалектом (rollup_weight, *_compact) — у рушіях.
+    STATEMENTS = {
+        'get_player': "SELECT * FROM players WHERE chat_id=%s AND user_id=%s",
+        'update_weight': "UPDATE players SET weight=%s WHERE chat_id=%s AND user_id=%s",
+        'get_inventory': "SELECT item, quantity FROM inventory WHERE chat_id=%s AND user_id=%s",
+        'increment_feed_count': "UPDATE players SET daily_feeds_count = daily_feeds_count + 1 WHERE chat_id=%s AND user_id=%s",
+        'increment_zonewalk_count': "UPDATE players SET daily_zonewalks_count = daily_zonewalks_count + 1 WHERE chat_id=%s AND user_id=%s",
+        'increment_wheel_count': "UPDATE players SET daily_wheel_count = daily_wheel_count + 1 WHERE chat_id=%s AND user_id=%s",
+        # Денне поповнення одним UPDATE: паралельна команда не перезапише /recruit застарілим значенням
+        'top_up_recruits': """UPDATE players SET last_recruitment_utc=%s,
+                                recruited_pets_count = CASE WHEN recruited_pets_count + %s > %s THEN CAST(%s AS INTEGER) ELSE recruited_pets_count + %s END
+                              WHERE chat_id=%s AND user_id=%s AND (last_recruitment_utc IS NULL OR last_recruitment_utc < %s)""",
+        'get_cleanup_status': "SELECT cleanup_enabled FROM players WHERE chat_id=%s LIMIT 1",
+        'set_last_message_id': "UPDATE players SET last_message_id=%s WHERE chat_id=%s AND user_id=%s",
+        'alive_opponents': "SELECT user_id, pet_name, weight FROM players WHERE chat_id=%s AND user_id != %s AND weight > 0 ORDER BY weight DESC",
+        'bump_record': """INSERT INTO chat_records (chat_id, record, user_id, pet_name, value, ts)
+                          SELECT chat_id, %s, user_id, pet_name, %s, %s FROM players WHERE chat_id=%s AND user_id=%s
+                          ON CONFLICT (chat_id, record) DO UPDATE SET user_id=excluded.user_id, pet_name=excluded.pet_name,
+                            value=excluded.value, ts=excluded.ts WHERE chat_records.value < excluded.value""",
+        'add_item': """INSERT INTO inventory (chat_id, user_id, item, quantity) VALUES (%s,%s,%s,%s)
+                       ON CONFLICT (chat_id, user_id, item) DO UPDATE SET quantity = inventory.quantity + EXCLUDED.quantity""",
+        'get_inventory_compact': "SELECT inv FROM players WHERE chat_id=%s AND user_id=%s",
+        # Нагадування ставиться лише гравцям з увімкненим /remind — для інших це порожній INSERT
+        'schedule_reminder': """INSERT INTO reminders (chat_id, user_id, kind, due_at)
+                                SELECT chat_id, user_id, %s, %s FROM players WHERE chat_id=%s AND user_id=%s AND remind_ready
+                                ON CONFLICT (chat_id, user_id, kind) DO UPDATE SET due_at=excluded.due_at""",
+    }
+
+    def __init__(self):
+        self._local = threading.local()
+        self.compact_inventory = INVENTORY_LAYOUT == 'compact'
+
+    # --- Connection management (перевизначається в рушіях) ---
+    @abstractmethod
+    def connect(self):
+        ...
+
+    def release(self, conn):
+        conn.close()
+
+    @abstractmethod
+    def make_cursor(self, conn, dict_rows=False):
+        ...
+
+    def begin(self, conn):
+        pass
+
+    @abstractmethod
+    def init_schema(self):
+        ...
+
+    def execute_named(self, cur, name, params):
+        """Виконує запит з реєстру STATEMENTS і записує його таймінг."""
+        started = time.perf_counter()
+        cur.execute(self.STATEMENTS[name], params)
+        record_timing(f"db.{name}", time.perf_counter() - started)
+
+    @contextmanager
+    def cursor(self, dict_rows=False):
+        """Курсор на одну операцію; всередині transaction() — на її з'єднанні."""
+        conn = getattr(self._local, 'tx_conn', None)
+        if conn is not None:
+            cur = self.make_cursor(conn, dict_rows)
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+        conn = self.connect()
+        try:
+            cur = self.make_cursor(conn, dict_rows)
+            try:
+                yield cur
+            finally:
+                cur.close()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def read_cursor(self, dict_rows=False):
+        """Курсор для чистих читань; рушій може направити його на репліку."""
+        with self.cursor(dict_rows) as cur:
+            yield cur
+
+    @contextmanager
+    def session(self):
+        """Межі однієї команди: після запису в ній читання йдуть лише в primary."""
+        self._local.wrote = False
+        try:
+            yield
+        finally:
+            self._local.wrote = False
+
+    def in_transaction(self):
+        return getattr(self._local, 'tx_conn', None) is not None
+
+    @contextmanager
+    def transaction(self):
+        """Усі операції сховища всередині блоку йдуть однією транзакцією."""
+        if self.in_transaction():
+            yield
+            return
+        conn = self.connect()
+        self._local.tx_conn = conn
+        self._local.after_commit = []
+        self._local.after_rollback = []
+        committed = False
+        try:
+            self.begin(conn)
+            yield
+            conn.commit()
+            committed = True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            hooks = self._local.after_commit if committed else self._local.after_rollback
+            self._local.after_commit = self._local.after_rollback = None
+            self._local.tx_conn = None
+            self.release(conn)
+            if not committed:
+                for fn, args in hooks:
+                    fn(*args)
+        for fn, args in hooks:
+            fn(*args)
+
+    def after_commit(self, fn, *args):
+        """fn(*args) після коміту поточної транзакції, а якщо її немає — одразу.
+        Після відкату (транзакції чи savepoint-а) виклик відкидається."""
+        hooks = getattr(self._local, 'after_commit', None)
+        if hooks is None:
+            fn(*args)
+        else:
+            hooks.append((fn, args))
+
+    def after_rollback(self, fn, *args):
+        """fn(*args), якщо поточну транзакцію (чи savepoint, у якому його зареєстровано)
+        буде відкочено. Поза транзакцією відкочувати нічого — виклик відкидається."""
+        hooks = getattr(self._local, 'after_rollback', None)
+        if hooks is not None:
+            hooks.append((fn, args))
+
+    # --- Players ---
+    def get_player(self, chat_id, user_id):
+        row = self.take_prefetched('players', chat_id, user_id)
+        if row is not NOT_PREFETCHED:
+            return row
+        with self.cursor(dict_rows=True) as cur:
+            self.execute_named(cur, 'get_player', (chat_id, user_id))
+            return cur.fetchone()
+
+    def insert_player(self, chat_id, user_id, username, pet_name, weight, ts):
+        with self.cursor() as cur:
+            cur.execute("""
+                INSERT INTO players (chat_id, user_id, username, pet_name, weight, created_at, born_utc, last_seen_utc)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s)
+            """, (chat_id, user_id, username, pet_name, weight, ts, ts, ts.date()))
+            self._record_weights(cur, chat_id, {user_id: weight}, ts)
+
+    def update_weight(self, chat_id, user_id, new_weight, ts):
+        with self.cursor() as cur:
+            self.execute_named(cur, 'update_weight', (new_weight, chat_id, user_id))
+            self._record_weights(cur, chat_id, {user_id: new_weight}, ts)
+
+    def set_pet_name(self, chat_id, user_id, pet_name):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET pet_name=%s WHERE chat_id=%s AND user_id=%s", (pet_name, chat_id, user_id))
+
+    def set_feed_date_and_count(self, chat_id, user_id, day, count):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET last_feed_utc=%s, daily_feeds_count=%s WHERE chat_id=%s AND user_id=%s", (day, count, chat_id, user_id))
+
+    def increment_feed_count(self, chat_id, user_id):
+        with self.cursor() as cur:
+            self.execute_named(cur, 'increment_feed_count', (chat_id, user_id))
+
+    def set_zonewalk_date_and_count(self, chat_id, user_id, day, count):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET last_zonewalk_utc=%s, daily_zonewalks_count=%s WHERE chat_id=%s AND user_id=%s", (day, count, chat_id, user_id))
+
+    def increment_zonewalk_count(self, chat_id, user_id):
+        with self.cursor() as cur:
+            self.execute_named(cur, 'increment_zonewalk_count', (chat_id, user_id))
+
+    def set_wheel_date_and_count(self, chat_id, user_id, day, count):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET last_wheel_utc=%s, daily_wheel_count=%s WHERE chat_id=%s AND user_id=%s", (day, count, chat_id, user_id))
+
+    def increment_wheel_count(self, chat_id, user_id):
+        with self.cursor() as cur:
+            self.execute_named(cur, 'increment_wheel_count', (chat_id, user_id))
+
+    def set_last_pet_time(self, chat_id, user_id, ts):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET last_pet_utc=%s WHERE chat_id=%s AND user_id=%s", (ts, chat_id, user_id))
+
+    def set_last_fight_time(self, chat_id, user_id, ts):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET last_fight_utc=%s WHERE chat_id=%s AND user_id=%s", (ts, chat_id, user_id))
+
+    def set_last_message_id(self, chat_id, user_id, message_id):
+        with self.cursor() as cur:
+            self.execute_named(cur, 'set_last_message_id', (message_id, chat_id, user_id))
+
+    def get_last_message_ids(self, chat_id):
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT user_id, last_message_id FROM players WHERE chat_id=%s AND last_message_id IS NOT NULL", (chat_id,))
+            return cur.fetchall()
+
+    def get_cleanup_status(self, chat_id):
+        with self.cursor(dict_rows=True) as cur:
+            self.execute_named(cur, 'get_cleanup_status', (chat_id,))
+            row = cur.fetchone()
+        return row['cleanup_enabled'] if row else True
+
+    def set_cleanup_status(self, chat_id, status):
+        self.forget_prefetched(chat_id)
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET cleanup_enabled=%s WHERE chat_id=%s", (status, chat_id))
+
+    def top_up_recruits(self, chat_id, user_id, daily, cap, day):
+        """+daily пацєток для вербування (не більше cap), якщо сьогодні (day) ще не поповнювали."""
+        self.forget_prefetched(chat_id, user_id)
+        with self.cursor() as cur:
+            self.execute_named(cur, 'top_up_recruits', (day, daily, cap, cap, daily, chat_id, user_id, day))
+
+    def kill_pet(self, chat_id, user_id):
+        self.forget_prefetched(chat_id, user_id)
+        if self.compact_inventory:
+            # Інвентар у тому ж рядку — смерть це один UPDATE
+            with self.cursor() as cur:
+                cur.execute("UPDATE players SET weight=%s, pet_name=%s, last_feed_utc=NULL, daily_feeds_count=0, last_zonewalk_utc=NULL, daily_zonewalks_count=0, last_wheel_utc=NULL, daily_wheel_count=0, last_pet_utc=NULL, inv='{}' WHERE chat_id=%s AND user_id=%s",
+                            (0, None, chat_id, user_id))
+            return
+        with self.transaction(), self.cursor() as cur:
+            cur.execute("UPDATE players SET weight=%s, pet_name=%s, last_feed_utc=NULL, daily_feeds_count=0, last_zonewalk_utc=NULL, daily_zonewalks_count=0, last_wheel_utc=NULL, daily_wheel_count=0, last_pet_utc=NULL WHERE chat_id=%s AND user_id=%s",
+                        (0, None, chat_id, user_id))
+            cur.execute("DELETE FROM inventory WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
+
+    def spawn_pet(self, chat_id, user_id, pet_name, weight, ts):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET weight=%s, pet_name=%s, recruited_pets_count=recruited_pets_count-1, last_feed_utc=NULL, daily_feeds_count=0, last_zonewalk_utc=NULL, daily_zonewalks_count=0, last_wheel_utc=NULL, daily_wheel_count=0, last_pet_utc=NULL, born_utc=%s WHERE chat_id=%s AND user_id=%s",
+                        (weight, pet_name, ts, chat_id, user_id))
+            self._record_weights(cur, chat_id, {user_id: weight}, ts)
+
+    def top_players(self, chat_id, limit):
+        with self.read_cursor(dict_rows=True) as cur:
+            cur.execute("SELECT user_id, username, pet_name, weight, born_utc FROM players WHERE chat_id=%s ORDER BY weight DESC LIMIT %s", (chat_id, limit))
+            return cur.fetchall()
+
+    def global_top(self, limit):
+        """Найважчі живі пацєтки всіх чатів — скан players_weight_idx на `limit` записів."""
+        with self.read_cursor(dict_rows=True) as cur:
+            cur.execute("SELECT chat_id, user_id, pet_name, weight FROM players WHERE weight > 0 ORDER BY weight DESC LIMIT %s", (limit,))
+            return cur.fetchall()
+
+    def alive_pet_ids(self, chat_id):
+        with self.cursor() as cur:
+            cur.execute("SELECT user_id FROM players WHERE chat_id=%s AND weight > 0", (chat_id,))
+            return [r[0] for r in cur.fetchall()]
+
+    def alive_opponents(self, chat_id, exclude_user_id):
+        with self.read_cursor(dict_rows=True) as cur:
+            self.execute_named(cur, 'alive_opponents', (chat_id, exclude_user_id))
+            return cur.fetchall()
+
+    # --- Inventory ---
+    # Компактний режим: інвентар — мапа {item: quantity} у колонці players.inv,
+    # тож пацєтко разом з інвентарем читається одним рядком за первинним ключем.
+    def decode_inventory(self, value):
+        if not value:
+            return {}
+        if isinstance(value, str):
+            value = json.loads(value)
+        return {k: int(v) for k, v in value.items() if int(v) > 0}
+
+    def inventory_from_row(self, player):
+        """Інвентар з уже прочитаного рядка players, якщо він там є."""
+        if self.compact_inventory and 'inv' in player:
+            return self.decode_inventory(player['inv'])
+        return self.get_inventory(player['chat_id'], player['user_id'])
+
+    def get_inventory(self, chat_id, user_id):
+        inv = self.take_prefetched('inventory', chat_id, user_id)
+        if inv is not NOT_PREFETCHED:
+            return inv
+        if self.compact_inventory:
+            with self.read_cursor() as cur:
+                self.execute_named(cur, 'get_inventory_compact', (chat_id, user_id))
+                row = cur.fetchone()
+            return self.decode_inventory(row[0]) if row else {}
+        with self.read_cursor(dict_rows=True) as cur:
+            self.execute_named(cur, 'get_inventory', (chat_id, user_id))
+            rows = cur.fetchall()
+        return {r['item']: r['quantity'] for r in rows}
+
+    def add_item(self, chat_id, user_id, item, qty):
+        self.forget_prefetched(chat_id, user_id)
+        with self.cursor() as cur:
+            if self.compact_inventory:
+                self.execute_named(cur, 'add_item_compact', (item, item, qty, chat_id, user_id))
+            else:
+                self.execute_named(cur, 'add_item', (chat_id, user_id, item, qty))
+
+    def remove_item(self, chat_id, user_id, item, qty):
+        self.forget_prefetched(chat_id, user_id)
+        if self.compact_inventory:
+            with self.cursor() as cur:
+                self.execute_named(cur, 'remove_item_compact', (item, qty, item, item, qty, item, chat_id, user_id, item, qty))
+                return cur.rowcount > 0
+        with self.transaction(), self.cursor() as cur:
+            cur.execute("UPDATE inventory SET quantity=quantity-%s WHERE chat_id=%s AND user_id=%s AND item=%s AND quantity>=%s",
+                        (qty, chat_id, user_id, item, qty))
+            if cur.rowcount == 0:
+                return False
+            cur.execute("DELETE FROM inventory WHERE chat_id=%s AND user_id=%s AND item=%s AND quantity<=0", (chat_id, user_id, item))
+        return True
+
+    # --- Пакетна обробка апдейтів (poll.py) ---
+    # Рядки гравців пачки читаються наперед двома запитами. Кожен рядок віддається
+    # не більше одного разу (перше читання в команді йде до її записів), а запис
+    # інвентаря чи кількох гравців чату викидає їх із кешу — далі читання йдуть у БД.
+    @contextmanager
+    def prefetch(self, players):
+        keys = sorted(set(players))
+        cache = {'players': {key: None for key in keys}, 'inventory': {key: {} for key in keys}}
+        if keys:
+            where = "(chat_id, user_id) IN (" + ','.join(['(%s,%s)'] * len(keys)) + ")"
+            params = [v for key in keys for v in key]
+            started = time.perf_counter()
+            with self.cursor(dict_rows=True) as cur:
+                cur.execute("SELECT * FROM players WHERE " + where, params)
+                for r in cur.fetchall():
+                    key = (r['chat_id'], r['user_id'])
+                    cache['players'][key] = r
+                    if self.compact_inventory:
+                        cache['inventory'][key] = self.decode_inventory(r.get('inv'))
+                if not self.compact_inventory:
+                    cur.execute("SELECT chat_id, user_id, item, quantity FROM inventory WHERE quantity > 0 AND " + where, params)
+                    for r in cur.fetchall():
+                        cache['inventory'][(r['chat_id'], r['user_id'])][r['item']] = r['quantity']
+            record_timing("db.prefetch", time.perf_counter() - started)
+        self._local.prefetched = cache
+        try:
+            yield
+        finally:
+            self._local.prefetched = None
+
+    def take_prefetched(self, kind, chat_id, user_id):
+        cache = getattr(self._local, 'prefetched', None)
+        if not cache:
+            return NOT_PREFETCHED
+        value = cache[kind].pop((chat_id, user_id), NOT_PREFETCHED)
+        incr("db.prefetch_hit" if value is not NOT_PREFETCHED else "db.prefetch_miss")
+        return value
+
+    def forget_prefetched(self, chat_id, user_id=None):
+        cache = getattr(self._local, 'prefetched', None)
+        if not cache:
+            return
+        for entries in cache.values():
+            for key in [k for k in entries if k[0] == chat_id and user_id in (None, k[1])]:
+                del entries[key]
+
+    @contextmanager
+    def savepoint(self):
+        """Всередині transaction(): помилка в блоці відкочує лише зміни цього блоку."""
+        with self.cursor() as cur:
+            cur.execute("SAVEPOINT batch_update")
+        hooks, undo = self._local.after_commit, self._local.after_rollback
+        mark, undo_mark = len(hooks), len(undo)
+        try:
+            yield
+            with self.cursor() as cur:
+                cur.execute("RELEASE SAVEPOINT batch_update")
+        except Exception:
+            # У Postgres після помилки SQL транзакція "aborted" і RELEASE теж падає — сюди ж
+            with self.cursor() as cur:
+                cur.execute("ROLLBACK TO SAVEPOINT batch_update")
+            del hooks[mark:]
+            rolled_back, undo[undo_mark:] = undo[undo_mark:], []
+            for fn, args in rolled_back:
+                fn(*args)
+            raise
+
+    # --- Серіалізація дій над гравцями ---
+    def lock_players(self, chat_id, user_ids):
+        """Блокує гравців до кінця поточної transaction().
+
+        SQLite: BEGIN IMMEDIATE у begin() вже серіалізує всіх записувачів бази.
+        """
+
+    # --- Weight history (денні rollups) і рекорди чату ---
+    def _record_weights(self, cur, chat_id, weights, ts):
+        """Інкрементально оновлює min/max/close за день і рекорд 'heaviest' чату."""
+        day = ts.date()
+        for user_id, weight in weights.items():
+            self.execute_named(cur, 'rollup_weight', (chat_id, user_id, day, weight, weight, weight))
+            self.execute_named(cur, 'bump_record', ('heaviest', weight, ts, chat_id, user_id))
+
+    def bump_record(self, chat_id, user_id, record, value, ts):
+        with self.cursor() as cur:
+            self.execute_named(cur, 'bump_record', (record, value, ts, chat_id, user_id))
+
+    def weight_history(self, chat_id, user_id, days):
+        """Останні `days` днів з rollups, від найновішого."""
+        with self.read_cursor(dict_rows=True) as cur:
+            cur.execute("SELECT day, min_weight, max_weight, close_weight FROM weight_daily WHERE chat_id=%s AND user_id=%s ORDER BY day DESC LIMIT %s",
+                        (chat_id, user_id, days))
+            return cur.fetchall()
+
+    def chat_records(self, chat_id):
+        with self.read_cursor(dict_rows=True) as cur:
+            cur.execute("SELECT record, user_id, pet_name, value, ts FROM chat_records WHERE chat_id=%s", (chat_id,))
+            return {r['record']: r for r in cur.fetchall()}
+
+    # --- Events journal (append-only) ---
+    def append_events(self, rows):
+        """rows: [(ts, chat_id, user_id, kind, data_dict)]."""
+        with self.cursor() as cur:
+            cur.executemany("INSERT INTO events (ts, chat_id, user_id, kind, data) VALUES (%s,%s,%s,%s,%s)",
+                            [(ts, c, u, kind, json.dumps(data, ensure_ascii=False)) for ts, c, u, kind, data in rows])
+
+    # --- Холодний архів і видалення чатів ---
+    def touch_player(self, chat_id, user_id, day):
+        with self.cursor() as cur:
+            cur.execute("UPDATE players SET last_seen_utc=%s WHERE chat_id=%s AND user_id=%s", (day, chat_id, user_id))
+
+    def try_lock_players(self, players):
+        """Які з [(chat_id, user_id)] вдалося заблокувати до кінця transaction() без очікування."""
+        return set(players)
+
+    def archive_players(self, seen_before, limit, ts):
+        """Переносить до `limit` гравців, неактивних з seen_before, у players_archive; повертає їх ключі."""
+        with self.transaction(), self.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT * FROM players WHERE last_seen_utc < %s ORDER BY last_seen_utc LIMIT %s" + self.SKIP_LOCKED,
+                        (seen_before, limit))
+            rows = cur.fetchall()
+            # Гравця, над яким зараз виконується команда (player_lock), не чіпаємо
+            locked = self.try_lock_players([(r['chat_id'], r['user_id']) for r in rows])
+            rows = [r for r in rows if (r['chat_id'], r['user_id']) in locked]
+            if not rows:
+                return []
+            keys = [(r['chat_id'], r['user_id']) for r in rows]
+            where = "(chat_id, user_id) IN (" + ','.join(['(%s,%s)'] * len(keys)) + ")"
+            params = [v for key in keys for v in key]
+            inventories = {key: {} for key in keys}
+            if self.compact_inventory:
+                for r in rows:
+                    inventories[(r['chat_id'], r['user_id'])] = self.decode_inventory(r['inv'])
+            else:
+                cur.execute("SELECT chat_id, user_id, item, quantity FROM inventory WHERE quantity > 0 AND " + where, params)
+                for r in cur.fetchall():
+                    inventories[(r['chat_id'], r['user_id'])][r['item']] = r['quantity']
+            cur.executemany("""INSERT INTO players_archive (chat_id, user_id, data, inv, archived_at) VALUES (%s,%s,%s,%s,%s)
+                               ON CONFLICT (chat_id, user_id) DO UPDATE SET data=excluded.data, inv=excluded.inv, archived_at=excluded.archived_at""",
+                            [(r['chat_id'], r['user_id'],
+                              json.dumps({k: v for k, v in r.items() if k not in ('chat_id', 'user_id', 'inv')}, default=_json_default),
+                              json.dumps(inventories[(r['chat_id'], r['user_id'])]), ts) for r in rows])
+            cur.execute("DELETE FROM players WHERE " + where, params)
+            cur.execute("DELETE FROM inventory WHERE " + where, params)
+        return keys
+
+    def restore_player(self, chat_id, user_id, day):
+        """Повертає гравця з архіву в players; None, якщо в архіві його немає."""
+        self.forget_prefetched(chat_id, user_id)
+        with self.transaction(), self.cursor() as cur:
+            cur.execute("DELETE FROM players_archive WHERE chat_id=%s AND user_id=%s RETURNING data, inv", (chat_id, user_id))
+            archived = cur.fetchone()
+            if not archived:
+                return None
+            data, inv = json.loads(archived[0]), json.loads(archived[1])
+            data.update(chat_id=chat_id, user_id=user_id, last_seen_utc=day)
+            if self.compact_inventory:
+                data['inv'] = json.dumps(inv)
+            cur.execute(f"INSERT INTO players ({', '.join(data)}) VALUES ({', '.join(['%s'] * len(data))})", list(data.values()))
+            if not self.compact_inventory and inv:
+                cur.executemany("INSERT INTO inventory (chat_id, user_id, item, quantity) VALUES (%s,%s,%s,%s)",
+                                [(chat_id, user_id, item, qty) for item, qty in inv.items()])
+        return self.get_player(chat_id, user_id)
+
+    def purge_chat(self, chat_id):
+        """Видаляє все, що стосується чату, з якого бота прибрали; повертає кількість гравців."""
+        self.forget_prefetched(chat_id)
+        with self.transaction(), self.cursor() as cur:
+            cur.execute("DELETE FROM players WHERE chat_id=%s", (chat_id,))
+            purged = cur.rowcount
+            cur.execute("DELETE FROM players_archive WHERE chat_id=%s", (chat_id,))
+            purged += cur.rowcount
+            for table in ('inventory', 'weight_daily', 'chat_records'):
+                cur.execute(f"DELETE FROM {table} WHERE chat_id=%s", (chat_id,))
+            cur.execute("DELETE FROM outbox WHERE chat_id=%s AND status='pending'", (chat_id,))
+            cur.execute("DELETE FROM reminders WHERE chat_id=%s", (chat_id,))
+        return purged
+
+    # --- Нагадування (/remind) ---
+    def set_remind_ready(self, chat_id, user_id, enabled):
+        with self.transaction(), self.cursor() as cur:
+            cur.execute("UPDATE players SET remind_ready=%s WHERE chat_id=%s AND user_id=%s", (enabled, chat_id, user_id))
+            if not enabled:
+                cur.execute("DELETE FROM reminders WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
+
+    def schedule_reminder(self, chat_id, user_id, kind, due):
+        """True, якщо нагадування записано (гравець його увімкнув)."""
+        with self.cursor() as cur:
+            self.execute_named(cur, 'schedule_reminder', (kind, due, chat_id, user_id))
+            return cur.rowcount > 0
+
+    def cancel_reminders(self, chat_id, user_id):
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM reminders WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
+
+    def pending_reminders(self):
+        with self.cursor() as cur:
+            cur.execute("SELECT chat_id, user_id, kind, due_at FROM reminders")
+            return cur.fetchall()
+
+    def claim_reminders(self, now, keys=None):
+        """Видаляє настали нагадування [(chat_id, user_id, kind)] (або всі до now, якщо keys=None)
+        і повертає їх разом з іменами живих пацєток. Видалення — і є "забрати": з кількох
+        воркерів нагадування надішле лише той, чий DELETE його повернув."""
+        with self.transaction(), self.cursor(dict_rows=True) as cur:
+            if keys is None:
+                cur.execute("DELETE FROM reminders WHERE due_at <= %s RETURNING chat_id, user_id, kind", (now,))
+            else:
+                keys = sorted(keys)
+                cur.execute("DELETE FROM reminders WHERE due_at <= %s AND (chat_id, user_id, kind) IN ("
+                            + ','.join(['(%s,%s,%s)'] * len(keys)) + ") RETURNING chat_id, user_id, kind",
+                            [now] + [v for key in keys for v in key])
+            claimed = cur.fetchall()
+            if not claimed:
+                return []
+            players = sorted({(r['chat_id'], r['user_id']) for r in claimed})
+            cur.execute("SELECT chat_id, user_id, username, pet_name FROM players WHERE weight > 0 AND (chat_id, user_id) IN ("
+                        + ','.join(['(%s,%s)'] * len(players)) + ")", [v for key in players for v in key])
+            alive = {(r['chat_id'], r['user_id']): r for r in cur.fetchall()}
+        return [dict(alive[(r['chat_id'], r['user_id'])], kind=r['kind']) for r in claimed if (r['chat_id'], r['user_id']) in alive]
+
+    # --- Нічний дайджест (агрегати по всіх чатах за добу) ---
+    def daily_digest(self, start, end):
+        """{chat_id: {'gainer': row|None, 'deaths': [pet_name], 'wheel': [rows]}} для чатів з подіями за [start, end)."""
+        digests = {}
+        with self.read_cursor(dict_rows=True) as cur:
+            self.execute_named(cur, 'digest_gainers', (start, end))
+            for r in cur.fetchall():
+                digests.setdefault(r['chat_id'], {'gainer': None, 'deaths': [], 'wheel': []})['gainer'] = r
+            self.execute_named(cur, 'digest_deaths', (start, end))
+            for r in cur.fetchall():
+                digests.setdefault(r['chat_id'], {'gainer': None, 'deaths': [], 'wheel': []})['deaths'].append(r['pet_name'])
+            self.execute_named(cur, 'digest_wheel', (start, end))
+            for r in cur.fetchall():
+                digests.setdefault(r['chat_id'], {'gainer': None, 'deaths': [], 'wheel': []})['wheel'].append(r)
+        return digests
+
+    def claim_digest(self, day, now, stale_before):
+        """True, якщо дайджест за `day` рахує цей воркер. Рядок digest_runs — і вибір одного
+        виконавця з усіх воркерів, і пам'ять про вже зроблені дні між рестартами; незавершене
+        захоплення, старіше за stale_before, можна перехопити."""
+        with self.cursor() as cur:
+            cur.execute("""INSERT INTO digest_runs (day, started_at) VALUES (%s,%s)
+                           ON CONFLICT (day) DO UPDATE SET started_at=excluded.started_at
+                           WHERE digest_runs.finished_at IS NULL AND digest_runs.started_at < %s""", (day, now, stale_before))
+            return cur.rowcount > 0
+
+    def finish_digest(self, day, chats, ts):
+        with self.cursor() as cur:
+            cur.execute("UPDATE digest_runs SET finished_at=%s, chats=%s WHERE day=%s", (ts, chats, day))
+
+    def release_digest(self, day):
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM digest_runs WHERE day=%s AND finished_at IS NULL", (day,))
+
+    # --- Розсилка по всіх чатах (broadcast.py) ---
+    def create_broadcast(self, text, ts):
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO broadcasts (text, created_at) VALUES (%s,%s) RETURNING id", (text, ts))
+            return cur.fetchone()[0]
+
+    def get_broadcast(self, broadcast_id):
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT * FROM broadcasts WHERE id=%s", (broadcast_id,))
+            return cur.fetchone()
+
+    def list_broadcasts(self, limit):
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT %s", (limit,))
+            return cur.fetchall()
+
+    BROADCAST_CHATS_SQL = """SELECT chat_id FROM players WHERE chat_id > %s
+                             UNION SELECT chat_id FROM players_archive WHERE chat_id > %s
+                             EXCEPT SELECT chat_id FROM blocked_chats ORDER BY 1"""
+
+    def iter_broadcast_chats(self, after):
+        """chat_id усіх чатів з гравцями (крім заблокованих) після `after`, по зростанню."""
+        with self.cursor() as cur:
+            cur.execute(self.BROADCAST_CHATS_SQL, (after, after))
+            while rows := cur.fetchmany(self.COPY_BATCH_ROWS):
+                yield from (r[0] for r in rows)
+
+    def checkpoint_broadcast(self, broadcast_id, chat_id, error=None):
+        """Чат оброблено: зсуває позицію розсилки і, якщо була помилка, записує її — однією транзакцією."""
+        with self.transaction(), self.cursor() as cur:
+            if error is None:
+                cur.execute("UPDATE broadcasts SET last_chat_id=%s, sent=sent+1 WHERE id=%s", (chat_id, broadcast_id))
+            else:
+                cur.execute("UPDATE broadcasts SET last_chat_id=%s, failed=failed+1 WHERE id=%s", (chat_id, broadcast_id))
+                cur.execute("""INSERT INTO broadcast_failures (broadcast_id, chat_id, error) VALUES (%s,%s,%s)
+                               ON CONFLICT (broadcast_id, chat_id) DO UPDATE SET error=excluded.error""",
+                            (broadcast_id, chat_id, error))
+
+    def finish_broadcast(self, broadcast_id, ts):
+        with self.cursor() as cur:
+            cur.execute("UPDATE broadcasts SET finished_at=%s WHERE id=%s", (ts, broadcast_id))
+
+    def mark_chat_blocked(self, chat_id, reason, ts):
+        with self.cursor() as cur:
+            cur.execute("""INSERT INTO blocked_chats (chat_id, reason, blocked_at) VALUES (%s,%s,%s)
+                           ON CONFLICT (chat_id) DO UPDATE SET reason=excluded.reason, blocked_at=excluded.blocked_at""",
+                        (chat_id, reason, ts))
+
+    def unblock_chat(self, chat_id):
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM blocked_chats WHERE chat_id=%s", (chat_id,))
+
+    # --- Потокові знімки (snapshot.py) ---
+    # Формат — CSV як у COPY ... WITH (FORMAT csv, NULL '\N'), тож знімок переноситься між рушіями.
+    BOOL_COLUMNS = frozenset({'cleanup_enabled', 'remind_ready'})
+    COPY_BATCH_ROWS = 1000
+
+    def table_columns(self, table):
+        with self.cursor() as cur:
+            cur.execute(f"SELECT * FROM {table} LIMIT 0")
+            return [d[0] for d in cur.description]
+
+    def copy_out(self, table, columns, chat_ids, out):
+        """Пише рядки таблиці (лише чатів chat_ids, якщо задано) CSV-ом у file-like `out`."""
+        query, params = self._snapshot_query(table, columns, chat_ids)
+        writer = csv.writer(out, lineterminator='\n')
+        with self.read_cursor() as cur:
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(self.COPY_BATCH_ROWS)
+                if not rows:
+                    break
+                writer.writerows([[_csv_value(v) for v in row] for row in rows])
+
+    def copy_in(self, table, columns, keys, src):
+        """Upsert рядків CSV з file-like `src` у таблицю; повертає кількість рядків."""
+        updates = ', '.join(f"{c}=excluded.{c}" for c in columns if c not in keys)
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+               f"ON CONFLICT ({', '.join(keys)}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING"))
+        bools = [c in self.BOOL_COLUMNS for c in columns]
+        total = 0
+        with self.transaction(), self.cursor() as cur:
+            for batch in _batched(csv.reader(io.TextIOWrapper(src, encoding='utf-8', newline='')), self.COPY_BATCH_ROWS):
+                cur.executemany(sql, [[None if v == '\\N' else (v in ('t', 'true', 'True', '1')) if b else v
+                                       for v, b in zip(row, bools)] for row in batch])
+                total += len(batch)
+        return total
+
+    @staticmethod
+    def _snapshot_query(table, columns, chat_ids):
+        query = f"SELECT {', '.join(columns)} FROM {table}"
+        if chat_ids:
+            return query + " WHERE chat_id IN (" + ','.join(['%s'] * len(chat_ids)) + ")", list(chat_ids)
+        return query, []
+
+    # --- Outbox вихідних повідомлень ---
+    SKIP_LOCKED = ''
+
+    def enqueue_messages(self, rows, ts, not_before=None):
+        """rows: [(dedup_key, chat_id, user_ids, text, reply_markup)]; повтор dedup_key ігнорується.
+
+        not_before — не надсилати раніше (за замовчуванням одразу).
+        """
+        with self.cursor() as cur:
+            cur.executemany("""INSERT INTO outbox (dedup_key, chat_id, user_ids, text, reply_markup, created_at, next_attempt_at)
+                               VALUES (%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (dedup_key) DO NOTHING""",
+                            [(key, chat_id, json.dumps(user_ids), text, json.dumps(markup) if markup else None, ts, not_before or ts)
+                             for key, chat_id, user_ids, text, markup in rows])
+
+    def enqueue_deletes(self, rows, ts):
+        """rows: [(dedup_key, chat_id, message_id)] — deleteMessage у тій самій черзі, що й відповіді."""
+        with self.cursor() as cur:
+            cur.executemany("""INSERT INTO outbox (dedup_key, chat_id, user_ids, text, delete_message_id, created_at, next_attempt_at)
+                               VALUES (%s,%s,'[]','',%s,%s,%s) ON CONFLICT (dedup_key) DO NOTHING""",
+                            [(key, chat_id, message_id, ts, ts) for key, chat_id, message_id in rows])
+
+    def claim_outbox(self, limit, now, lease_until):
+        """Бере до `limit` готових до відправки повідомлень і здає їх в оренду до lease_until."""
+        with self.transaction(), self.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT id, chat_id, user_ids, text, reply_markup, delete_message_id, attempts, created_at FROM outbox WHERE status='pending' AND next_attempt_at <= %s ORDER BY id LIMIT %s" + self.SKIP_LOCKED,
+                        (now, limit))
+            rows = cur.fetchall()
+            if rows:
+                cur.execute("UPDATE outbox SET next_attempt_at=%s WHERE id IN (" + ','.join(['%s'] * len(rows)) + ")",
+                            [lease_until] + [r['id'] for r in rows])
+        return [dict(r, user_ids=json.loads(r['user_ids']), reply_markup=json.loads(r['reply_markup']) if r['reply_markup'] else None)
+                for r in rows]
+
+    def mark_outbox_sent(self, message_id, ts):
+        with self.cursor() as cur:
+            cur.execute("UPDATE outbox SET status='sent', sent_at=%s, attempts=attempts+1, last_error=NULL WHERE id=%s", (ts, message_id))
+
+    def mark_outbox_retry(self, message_id, attempts, next_attempt_at, error):
+        with self.cursor() as cur:
+            cur.execute("UPDATE outbox SET attempts=%s, next_attempt_at=%s, last_error=%s WHERE id=%s",
+                        (attempts, next_attempt_at, error, message_id))
+
+    def mark_outbox_failed(self, message_id, attempts, error):
+        with self.cursor() as cur:
+            cur.execute("UPDATE outbox SET status='failed', attempts=%s, last_error=%s WHERE id=%s", (attempts, error, message_id))
+
+    def outbox_backlog(self, now):
+        """Скільки повідомлень уже мали б бути надіслані."""
+        with self.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM outbox WHERE status='pending' AND next_attempt_at <= %s", (now,))
+            return cur.fetchone()[0]
+
+    def purge_outbox(self, before):
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM outbox WHERE status != 'pending' AND created_at < %s", (before,))
+
+    # --- Bulk (set-based) операції для масових подій у чаті ---
+    # Дані передаються одним JSON-параметром, тож сотні пацєток — це кілька запитів.
+    ROW_LOCK = ''
+
+    def load_chat_pets(self, chat_id):
+        """Живі пацєтки чату та їхні інвентарі: ([players], {user_id: {item: qty}})."""
+        with self.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT * FROM players WHERE chat_id=%s AND weight > 0" + self.ROW_LOCK, (chat_id,))
+            pets = cur.fetchall()
+            if self.compact_inventory:
+                return pets, {p['user_id']: self.decode_inventory(p.get('inv')) for p in pets}
+            inventories = {p['user_id']: {} for p in pets}
+            cur.execute("SELECT user_id, item, quantity FROM inventory WHERE chat_id=%s AND quantity > 0", (chat_id,))
+            for r in cur.fetchall():
+                if r['user_id'] in inventories:
+                    inventories[r['user_id']][r['item']] = r['quantity']
+        return pets, inventories
+
+    def bulk_set_weights(self, chat_id, weights, ts):
+        self.forget_prefetched(chat_id)
+        payload = json.dumps([{"user_id": u, "weight": w} for u, w in weights.items()])
+        with self.cursor() as cur:
+            self.execute_named(cur, 'bulk_set_weights', (payload, chat_id))
+            self._record_weights(cur, chat_id, weights, ts)
+
+    def bulk_kill(self, chat_id, user_ids):
+        with self.transaction():
+            with self.cursor() as cur:
+                self.execute_named(cur, 'bulk_kill', (chat_id, json.dumps(list(user_ids))))
+            self.bulk_replace_inventories(chat_id, {u: {} for u in user_ids})
+
+    def bulk_replace_inventories(self, chat_id, inventories):
+        self.forget_prefetched(chat_id)
+        with self.transaction(), self.cursor() as cur:
+            if self.compact_inventory:
+                payload = json.dumps([{"user_id": u, "inv": inv} for u, inv in inventories.items()])
+                self.execute_named(cur, 'bulk_set_inv', (payload, chat_id))
+                return
+            self.execute_named(cur, 'bulk_delete_inventory', (chat_id, json.dumps(list(inventories))))
+            rows = [{"user_id": u, "item": k, "quantity": q} for u, inv in inventories.items() for k, q in inv.items() if q > 0]
+            if rows:
+                self.execute_named(cur, 'bulk_insert_inventory', (chat_id, json.dumps(rows)))
+
+
+class _PreparedConnection(psycopg2.extensions.connection):
+    """З'єднання пулу, яке пам'ятає, які запити на ньому вже підготовлені."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def player_lock_key(chat_id, user_id):
+    """Стабільний signed bigint-ключ advisory lock для пари (chat_id, user_id)."""
+    digest = hashlib.blake2b(f"{chat_id}:{user_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+# Відставання репліки в секундах; 0, якщо вона програла весь отриманий WAL
+REPLICA_LAG_SQL = """SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"""
+
+# Скидання стану пацєтка при смерті (kill_pet і масові події)
+KILL_RESET_SQL = "weight=0, pet_name=NULL, last_feed_utc=NULL, daily_feeds_count=0, last_zonewalk_utc=NULL, daily_zonewalks_count=0, last_wheel_utc=NULL, daily_wheel_count=0, last_pet_utc=NULL"
+
+
+def _to_positional(sql):
+    # %s -> $1, $2, ... для PREPARE
+    parts = sql.split('%s')
+    return parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+
+
+class PostgresStorage(SqlStorage):
+    name = 'postgres'
+
+    STATEMENTS = {
+        **SqlStorage.STATEMENTS,
+        'schedule_reminder': """INSERT INTO reminders (chat_id, user_id, kind, due_at)
+                                SELECT chat_id, user_id, %s::text, %s::timestamptz FROM players WHERE chat_id=%s AND user_id=%s AND remind_ready
+                                ON CONFLICT (chat_id, user_id, kind) DO UPDATE SET due_at=excluded.due_at""",
+        'rollup_weight': """INSERT INTO weight_daily (chat_id, user_id, day, min_weight, max_weight, close_weight) VALUES (%s,%s,%s,%s,%s,%s)
+                            ON CONFLICT (chat_id, user_id, day) DO UPDATE SET min_weight=LEAST(weight_daily.min_weight, excluded.min_weight),
+                              max_weight=GREATEST(weight_daily.max_weight, excluded.max_weight), close_weight=excluded.close_weight""",
+        'add_item_compact': """UPDATE players SET inv = jsonb_set(COALESCE(inv, '{}'::jsonb), ARRAY[%s::text], to_jsonb(COALESCE((inv->>%s)::int, 0) + %s))
+                               WHERE chat_id=%s AND user_id=%s""",
+        'remove_item_compact': """UPDATE players SET inv = CASE WHEN (inv->>%s)::int > %s
+                                      THEN jsonb_set(inv, ARRAY[%s::text], to_jsonb((inv->>%s)::int - %s))
+                                      ELSE inv - %s::text END
+                                  WHERE chat_id=%s AND user_id=%s AND COALESCE((inv->>%s)::int, 0) >= %s""",
+        'bulk_set_weights': """UPDATE players p SET weight = v.weight
+                               FROM jsonb_to_recordset(%s::jsonb) AS v(user_id bigint, weight int)
+                               WHERE p.chat_id=%s AND p.user_id=v.user_id""",
+        'bulk_kill': f"UPDATE players SET {KILL_RESET_SQL} WHERE chat_id=%s AND user_id IN (SELECT value::bigint FROM jsonb_array_elements_text(%s::jsonb))",
+        'bulk_delete_inventory': "DELETE FROM inventory WHERE chat_id=%s AND user_id IN (SELECT value::bigint FROM jsonb_array_elements_text(%s::jsonb))",
+        'bulk_insert_inventory': """INSERT INTO inventory (chat_id, user_id, item, quantity)
+                                    SELECT %s, v.user_id, v.item, v.quantity
+                                    FROM jsonb_to_recordset(%s::jsonb) AS v(user_id bigint, item text, quantity int)""",
+        'bulk_set_inv': """UPDATE players p SET inv = v.inv
+                           FROM jsonb_to_recordset(%s::jsonb) AS v(user_id bigint, inv jsonb)
+                           WHERE p.chat_id=%s AND p.user_id=v.user_id""",
+        # Дайджест: одне найбільше сумарне зростання на чат, загиблі в Зоні, найкращий виграш кожного призу
+        'digest_gainers': """SELECT g.chat_id, g.user_id, g.gain, p.pet_name FROM (
+                               SELECT chat_id, user_id, SUM((data->>'delta')::int) AS gain,
+                                      ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY SUM((data->>'delta')::int) DESC, user_id) AS rn
+                               FROM events WHERE ts >= %s AND ts < %s AND data ? 'delta' GROUP BY chat_id, user_id
+                             ) g LEFT JOIN players p ON p.chat_id=g.chat_id AND p.user_id=g.user_id
+                             WHERE g.rn = 1 AND g.gain > 0""",
+        'digest_deaths': """SELECT chat_id, data->>'pet_name' AS pet_name FROM events
+                            WHERE kind='death' AND ts >= %s AND ts < %s AND data->>'cause' = 'zonewalk' ORDER BY chat_id, ts""",
+        'digest_wheel': """SELECT w.chat_id, w.user_id, w.reward, w.quantity, p.pet_name FROM (
+                             SELECT chat_id, user_id, data->>'reward' AS reward, (data->>'quantity')::int AS quantity,
+                                    ROW_NUMBER() OVER (PARTITION BY chat_id, data->>'reward' ORDER BY (data->>'quantity')::int DESC, ts) AS rn
+                             FROM events WHERE kind='wheel' AND ts >= %s AND ts < %s AND data->>'reward' != 'nothing'
+                           ) w LEFT JOIN players p ON p.chat_id=w.chat_id AND p.user_id=w.user_id
+                           WHERE w.rn = 1""",
+    }
+    ROW_LOCK = ' FOR UPDATE'
+    SKIP_LOCKED = ' FOR UPDATE SKIP LOCKED'
+
+    def __init__(self, dsn, pool_min=DB_POOL_MIN, pool_max=DB_POOL_MAX, replica_dsn=None):
+        super().__init__()
+        self.dsn = dsn
+        self.replica = PostgresStorage(replica_dsn, pool_min, pool_max) if replica_dsn else None
+        self.replica_max_lag = REPLICA_MAX_LAG_SECONDS
+        self._replica_ok = False
+        self._replica_checked = float('-inf')
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._event_partitions = set()
+        # ThreadedConnectionPool не чекає на вільне з'єднання, а кидає PoolError
+        self._slots = threading.BoundedSemaphore(pool_max)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.pool_min, self.pool_max, self.dsn,
+                    sslmode='require', connection_factory=_PreparedConnection)
+            return self._pool
+
+    def connect(self):
+        started = time.perf_counter()
+        self._slots.acquire()
+        waited = time.perf_counter() - started
+        record_timing("db.pool_wait", waited)
+        pressure.observe_pool_wait(waited)
+        try:
+            return self._get_pool().getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            self._get_pool().putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def make_cursor(self, conn, dict_rows=False):
+        return conn.cursor(cursor_factory=RealDictCursor) if dict_rows else conn.cursor()
+
+    @contextmanager
+    def cursor(self, dict_rows=False):
+        with super().cursor(dict_rows) as cur:
+            yield cur
+            # Будь-що, крім SELECT, — запис: далі в цій команді читаємо лише primary
+            if cur.statusmessage and not cur.statusmessage.startswith('SELECT'):
+                self._local.wrote = True
+
+    def replica_fresh(self):
+        """Чи відстає репліка не більше ніж на replica_max_lag (перевірка раз на REPLICA_CHECK_SECONDS)."""
+        now = time.monotonic()
+        if now - self._replica_checked >= REPLICA_CHECK_SECONDS:
+            self._replica_checked = now
+            try:
+                with self.replica.cursor() as cur:
+                    cur.execute(REPLICA_LAG_SQL)
+                    lag = float(cur.fetchone()[0])
+                ok = lag <= self.replica_max_lag
+            except Exception as e:
+                print('replica check error:', e)
+                ok = False
+            if ok != self._replica_ok:
+                print('replica', 'in sync' if ok else 'lagging or down, reading from primary')
+            self._replica_ok = ok
+        return self._replica_ok
+
+    @contextmanager
+    def read_cursor(self, dict_rows=False):
+        use_replica = (self.replica is not None
+                       and not self.in_transaction()
+                       and not getattr(self._local, 'wrote', False)
+                       and self.replica_fresh())
+        if not use_replica:
+            with self.cursor(dict_rows) as cur:
+                yield cur
+            return
+        incr("db.replica_reads")
+        with self.replica.cursor(dict_rows) as cur:
+            yield cur
+
+    def lock_players(self, chat_id, user_ids):
+        """pg_advisory_xact_lock на кожного гравця, завжди у порядку user_id —
+        дві дії над тими самими гравцями не можуть чекати одна на одну по колу."""
+        if not self.in_transaction():
+            raise RuntimeError("lock_players() must be called inside transaction()")
+        started = time.perf_counter()
+        with self.cursor() as cur:
+            for user_id in sorted(set(user_ids)):
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (player_lock_key(chat_id, user_id),))
+        record_timing("db.lock_wait", time.perf_counter() - started)
+
+    def try_lock_players(self, players):
+        keys = {player_lock_key(chat_id, user_id): (chat_id, user_id) for chat_id, user_id in players}
+        if not keys:
+            return set()
+        with self.cursor() as cur:
+            cur.execute("SELECT k FROM unnest(%s::bigint[]) AS k WHERE pg_try_advisory_xact_lock(k)", (list(keys),))
+            return {keys[r[0]] for r in cur.fetchall()}
+
+    def iter_broadcast_chats(self, after):
+        """Серверний (named) курсор: клієнт тримає в пам'яті лише itersize рядків."""
+        conn = self.connect()
+        try:
+            with conn.cursor(name='broadcast_chats') as cur:
+                cur.itersize = self.COPY_BATCH_ROWS
+                cur.execute(self.BROADCAST_CHATS_SQL, (after, after))
+                for row in cur:
+                    yield row[0]
+            conn.commit()
+        finally:
+            self.release(conn)
+
+    def copy_out(self, table, columns, chat_ids, out):
+        query, params = self._snapshot_query(table, columns, chat_ids)
+        with self.read_cursor() as cur:
+            cur.copy_expert(cur.mogrify(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, NULL '\\N')", params).decode(), out)
+
+    def copy_in(self, table, columns, keys, src):
+        """COPY у тимчасову таблицю і один INSERT ... ON CONFLICT звідти."""
+        cols = ', '.join(columns)
+        updates = ', '.join(f"{c}=excluded.{c}" for c in columns if c not in keys)
+        with self.transaction(), self.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE snapshot_stage (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+            cur.copy_expert(f"COPY snapshot_stage ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", src)
+            cur.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM snapshot_stage ON CONFLICT ({', '.join(keys)}) DO "
+                        + (f"UPDATE SET {updates}" if updates else "NOTHING"))
+            return cur.rowcount
+
+    def ensure_event_partitions(self, cur, months):
+        """Місячні партиції events_YYYY_MM створюються за потреби; повертає місяці, яких
+        ще немає в кеші. Кешувати їх можна лише після коміту — відкочений CREATE не лишає
+        партиції, і наступна спроба мусить створити її знову."""
+        created = set()
+        for year, month in sorted(months):
+            if (year, month) in self._event_partitions:
+                continue
+            start = date(year, month, 1)
+            end = date(year + month // 12, month % 12 + 1, 1)
+            cur.execute(f"CREATE TABLE IF NOT EXISTS events_{year}_{month:02d} PARTITION OF events FOR VALUES FROM (%s) TO (%s)",
+                        (start, end))
+            created.add((year, month))
+        return created
+
+    def append_events(self, rows):
+        # COPY у CSV: одна операція на всю пачку замість INSERT на кожну подію
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for ts, chat_id, user_id, kind, data in rows:
+            writer.writerow([ts.isoformat(), chat_id, '' if user_id is None else user_id, kind,
+                             json.dumps(data, ensure_ascii=False)])
+        buf.seek(0)
+        with self.transaction(), self.cursor() as cur:
+            created = self.ensure_event_partitions(cur, {(ts.year, ts.month) for ts, *_ in rows})
+            cur.copy_expert("COPY events (ts, chat_id, user_id, kind, data) FROM STDIN WITH (FORMAT csv)", buf)
+        self._event_partitions |= created
+
+    def execute_named(self, cur, name, params):
+        conn = cur.connection
+        started = time.perf_counter()
+        if name not in conn.prepared:
+            cur.execute(f"PREPARE {name} AS {_to_positional(self.STATEMENTS[name])}")
+            conn.prepared.add(name)
+            incr("db.prepare")
+        if params:
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+        record_timing(f"db.{name}", time.perf_counter() - started)
+
+    def init_schema(self):
+        sql_players_create = """
+        CREATE TABLE IF NOT EXISTS players (
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          username TEXT,
+          pet_name TEXT,
+          weight INTEGER NOT NULL DEFAULT 10,
+          last_feed_utc DATE,
+          daily_feeds_count INTEGER NOT NULL DEFAULT 0,
+          last_zonewalk_utc DATE,
+          daily_zonewalks_count INTEGER NOT NULL DEFAULT 0,
+          last_wheel_utc DATE,
+          daily_wheel_count INTEGER NOT NULL DEFAULT 0,
+          last_pet_utc TIMESTAMPTZ,
+          last_message_id BIGINT,
+          cleanup_enabled BOOLEAN NOT NULL DEFAULT TRUE,
+          created_at TIMESTAMPTZ DEFAULT now(),
+          recruited_pets_count INTEGER NOT NULL DEFAULT 0,
+          last_recruitment_utc DATE,
+          PRIMARY KEY (chat_id, user_id)
+        );
+        """
+        sql_inv = """
+        CREATE TABLE IF NOT EXISTS inventory (
+          id SERIAL PRIMARY KEY,
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          item TEXT NOT NULL,
+          quantity INTEGER NOT NULL DEFAULT 0,
+          UNIQUE (chat_id, user_id, item)
+        );
+        """
+        conn = self.connect()
+        cur = conn.cursor()
+
+        # === Migration logic ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name IN ('last_feed', 'last_zonewalk')")
+        old_columns = [row[0] for row in cur.fetchall()]
+
+        if 'last_feed' in old_columns:
+            print("Migrating 'last_feed' column...")
+            cur.execute("ALTER TABLE players RENAME COLUMN last_feed TO last_feed_utc")
+            cur.execute("ALTER TABLE players ALTER COLUMN last_feed_utc TYPE DATE USING last_feed_utc::date")
+
+        if 'last_zonewalk' in old_columns:
+            print("Migrating 'last_zonewalk' column...")
+            cur.execute("ALTER TABLE players RENAME COLUMN last_zonewalk TO last_zonewalk_utc")
+            cur.execute("ALTER TABLE players ALTER COLUMN last_zonewalk_utc TYPE DATE USING last_zonewalk_utc::date")
+
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='daily_zonewalks_count'")
+        if not cur.fetchone():
+            print("Adding 'daily_zonewalks_count' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN daily_zonewalks_count INTEGER NOT NULL DEFAULT 0")
+
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='daily_feeds_count'")
+        if not cur.fetchone():
+            print("Adding 'daily_feeds_count' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN daily_feeds_count INTEGER NOT NULL DEFAULT 0")
+
+        # === NEW FEATURE: Колесо Фортуни (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_wheel_utc'")
+        if not cur.fetchone():
+            print("Adding 'last_wheel_utc' and 'daily_wheel_count' columns...")
+            cur.execute("ALTER TABLE players ADD COLUMN last_wheel_utc DATE")
+            cur.execute("ALTER TABLE players ADD COLUMN daily_wheel_count INTEGER NOT NULL DEFAULT 0")
+        # =================================================
+
+        # === NEW FEATURE: Pet Cooldown (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_pet_utc'")
+        if not cur.fetchone():
+            print("Adding 'last_pet_utc' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN last_pet_utc TIMESTAMPTZ")
+        # ===============================================
+
+        # === NEW FEATURE: Message cleanup (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_message_id'")
+        if not cur.fetchone():
+            print("Adding 'last_message_id' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN last_message_id BIGINT")
+        # =================================================
+
+        # === NEW FEATURE: Cleanup toggle (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='cleanup_enabled'")
+        if not cur.fetchone():
+            print("Adding 'cleanup_enabled' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN cleanup_enabled BOOLEAN NOT NULL DEFAULT TRUE")
+        # =================================================
+
+        # === NEW FEATURE: Смерть і вербування (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='recruited_pets_count'")
+        if not cur.fetchone():
+            print("Adding 'recruited_pets_count' and 'last_recruitment_utc' columns...")
+            cur.execute("ALTER TABLE players ADD COLUMN recruited_pets_count INTEGER NOT NULL DEFAULT 0")
+            cur.execute("ALTER TABLE players ADD COLUMN last_recruitment_utc DATE")
+        # =======================================================
+
+        # === NEW FEATURE: Fight cooldown (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_fight_utc'")
+        if not cur.fetchone():
+            print("Adding 'last_fight_utc' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN last_fight_utc TIMESTAMPTZ")
+        # ==================================================
+
+        # --- Фрагмент у init_db() ---
+        cur.execute("""
+          SELECT column_name
+          FROM information_schema.columns
+          WHERE table_name='players' AND column_name='born_utc'
+        """)
+        if not cur.fetchone():
+          print("Adding 'born_utc' column...")
+          cur.execute("ALTER TABLE players ADD COLUMN born_utc TIMESTAMPTZ")
+          cur.execute("UPDATE players SET born_utc = NOW()")
+
+        # Create tables if they don't exist
+        cur.execute(sql_players_create)
+        cur.execute(sql_inv)
+
+        # === Compact inventory (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='inv'")
+        if not cur.fetchone():
+            print("Adding 'inv' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN inv JSONB")
+        if self.compact_inventory:
+            cur.execute("""
+                UPDATE players p SET inv = COALESCE(
+                  (SELECT jsonb_object_agg(i.item, i.quantity) FROM inventory i
+                   WHERE i.chat_id=p.chat_id AND i.user_id=p.user_id AND i.quantity > 0), '{}'::jsonb)
+                WHERE p.inv IS NULL
+            """)
+            cur.execute("DELETE FROM inventory")
+            if cur.rowcount:
+                print(f"Moved {cur.rowcount} inventory rows into players.inv")
+        else:
+            cur.execute("""
+                INSERT INTO inventory (chat_id, user_id, item, quantity)
+                SELECT p.chat_id, p.user_id, kv.key, kv.value::int
+                FROM players p, jsonb_each_text(p.inv) kv
+                WHERE p.inv IS NOT NULL AND kv.value::int > 0
+                ON CONFLICT (chat_id, user_id, item) DO UPDATE SET quantity = EXCLUDED.quantity
+            """)
+            if cur.rowcount:
+                print(f"Moved {cur.rowcount} items from players.inv back into inventory")
+            cur.execute("UPDATE players SET inv = NULL WHERE inv IS NOT NULL")
+        # ========================================
+
+        # === Розсилки і заблоковані чати ===
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+              id BIGSERIAL PRIMARY KEY,
+              text TEXT NOT NULL,
+              created_at TIMESTAMPTZ NOT NULL,
+              last_chat_id BIGINT NOT NULL DEFAULT -9223372036854775808,
+              sent INTEGER NOT NULL DEFAULT 0,
+              failed INTEGER NOT NULL DEFAULT 0,
+              finished_at TIMESTAMPTZ
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_failures (
+              broadcast_id BIGINT NOT NULL,
+              chat_id BIGINT NOT NULL,
+              error TEXT,
+              PRIMARY KEY (broadcast_id, chat_id)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS blocked_chats (
+              chat_id BIGINT PRIMARY KEY,
+              reason TEXT,
+              blocked_at TIMESTAMPTZ NOT NULL
+            )
+        """)
+        # ====================================
+
+        # === Холодний архів (DB Migration) ===
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_seen_utc'")
+        if not cur.fetchone():
+            print("Adding 'last_seen_utc' column...")
+            cur.execute("ALTER TABLE players ADD COLUMN last_seen_utc DATE")
+            cur.execute("UPDATE players SET last_seen_utc = CURRENT_DATE")
+        cur.execute("CREATE INDEX IF NOT EXISTS players_last_seen_idx ON players (last_seen_utc)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS players_archive (
+              chat_id BIGINT NOT NULL,
+              user_id BIGINT NOT NULL,
+              data TEXT NOT NULL,
+              inv TEXT NOT NULL,
+              archived_at TIMESTAMPTZ NOT NULL,
+              PRIMARY KEY (chat_id, user_id)
+            )
+        """)
+        # =====================================
+
+        # === Нічний дайджест: зроблені дні ===
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS digest_runs (
+              day DATE PRIMARY KEY,
+              started_at TIMESTAMPTZ NOT NULL,
+              finished_at TIMESTAMPTZ,
+              chats INTEGER
+            )
+        """)
+        # ====================================
+
+        # === Нагадування (DB Migration) ===
+        cur.execute("ALTER TABLE players ADD COLUMN IF NOT EXISTS remind_ready BOOLEAN NOT NULL DEFAULT FALSE")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS reminders (
+              chat_id BIGINT NOT NULL,
+              user_id BIGINT NOT NULL,
+              kind TEXT NOT NULL,
+              due_at TIMESTAMPTZ NOT NULL,
+              PRIMARY KEY (chat_id, user_id, kind)
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS reminders_due_idx ON reminders (due_at)")
+        # ====================================
+
+        # === Events journal (append-only, партиції по місяцях) ===
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+              ts TIMESTAMPTZ NOT NULL,
+              chat_id BIGINT NOT NULL,
+              user_id BIGINT,
+              kind TEXT NOT NULL,
+              data JSONB
+            ) PARTITION BY RANGE (ts)
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS events_chat_ts_idx ON events (chat_id, ts)")
+        cur.execute("CREATE INDEX IF NOT EXISTS events_kind_ts_idx ON events (kind, ts)")
+        today = now_utc().date()
+        partitions = self.ensure_event_partitions(cur, {(today.year, today.month), (today.year + today.month // 12, today.month % 12 + 1)})
+        # =========================================================
+
+        # Глобальний топ читає лише цей індекс (index-only scan)
+        cur.execute("CREATE INDEX IF NOT EXISTS players_weight_idx ON players (weight DESC) INCLUDE (chat_id, user_id, pet_name)")
+
+        # === Weight history rollups і рекорди чату ===
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS weight_daily (
+              chat_id BIGINT NOT NULL,
+              user_id BIGINT NOT NULL,
+              day DATE NOT NULL,
+              min_weight INTEGER NOT NULL,
+              max_weight INTEGER NOT NULL,
+              close_weight INTEGER NOT NULL,
+              PRIMARY KEY (chat_id, user_id, day)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS chat_records (
+              chat_id BIGINT NOT NULL,
+              record TEXT NOT NULL,
+              user_id BIGINT NOT NULL,
+              pet_name TEXT,
+              value INTEGER NOT NULL,
+              ts TIMESTAMPTZ,
+              PRIMARY KEY (chat_id, record)
+            )
+        """)
+        # =============================================
+
+        # === Outbox вихідних повідомлень ===
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+              id BIGSERIAL PRIMARY KEY,
+              dedup_key TEXT UNIQUE,
+              chat_id BIGINT NOT NULL,
+              user_ids TEXT NOT NULL,
+              text TEXT NOT NULL,
+              reply_markup TEXT,
+              status TEXT NOT NULL DEFAULT 'pending',
+              attempts INTEGER NOT NULL DEFAULT 0,
+              created_at TIMESTAMPTZ NOT NULL,
+              next_attempt_at TIMESTAMPTZ NOT NULL,
+              sent_at TIMESTAMPTZ,
+              last_error TEXT
+            )
+        """)
+        # Рядок з delete_message_id — це deleteMessage, а не відповідь
+        cur.execute("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS delete_message_id BIGINT")
+        cur.execute("CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (next_attempt_at, id) WHERE status='pending'")
+        # ===================================
+
+        conn.commit()
+        self._event_partitions |= partitions
+        cur.close()
+        self.release(conn)
+
+
+# --- SQLite: дати зберігаються як ISO-рядки і повертаються як date/datetime ---
+# Маркер "у кеші prefetch цього немає" (None там — прочитаний відсутній гравець)
+NOT_PREFETCHED = object()
+
+def _sqlite_timestamp(raw):
+    ts = datetime.fromisoformat(raw.decode())
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+def _json_default(value):
+    """date/datetime у JSON архіву — ISO-рядками, які обидва рушії приймають назад."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def _csv_value(value):
+    """Значення для CSV-знімка в тому ж вигляді, що дає COPY у Postgres."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+def _batched(iterable, size):
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, size)):
+        yield batch
+
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime, lambda d: d.isoformat())
+sqlite3.register_converter('DATE', lambda raw: date.fromisoformat(raw.decode()))
+sqlite3.register_converter('TIMESTAMPTZ', _sqlite_timestamp)
+sqlite3.register_converter('BOOLEAN', lambda raw: bool(int(raw)))
+
+
+class _SqliteCursor:
+    """Обгортка над sqlite3-курсором з інтерфейсом psycopg2 (%s, dict-рядки)."""
+
+    def __init__(self, cur, dict_rows):
+        self._cur = cur
+        self._dict_rows = dict_rows
+
+    def _row(self, row):
+        if row is None:
+            return None
+        return dict(row) if self._dict_rows else tuple(row)
+
+    def execute(self, sql, params=()):
+        self._cur.execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, sql, seq):
+        self._cur.executemany(sql.replace('%s', '?'), seq)
+
+    def fetchone(self):
+        return self._row(self._cur.fetchone())
+
+    def fetchall(self):
+        return [self._row(r) for r in self._cur.fetchall()]
+
+    def fetchmany(self, size):
+        return [self._row(r) for r in self._cur.fetchmany(size)]
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def close(self):
+        self._cur.close()
+
+
+class SqliteStorage(SqlStorage):
+    """Вбудоване сховище в одному файлі (WAL) — без мережі, для малих інсталяцій і тестів."""
+    name = 'sqlite'
+
+    STATEMENTS = {
+        **SqlStorage.STATEMENTS,
+        'rollup_weight': """INSERT INTO weight_daily (chat_id, user_id, day, min_weight, max_weight, close_weight) VALUES (%s,%s,%s,%s,%s,%s)
+                            ON CONFLICT (chat_id, user_id, day) DO UPDATE SET min_weight=MIN(weight_daily.min_weight, excluded.min_weight),
+                              max_weight=MAX(weight_daily.max_weight, excluded.max_weight), close_weight=excluded.close_weight""",
+        'add_item_compact': """UPDATE players SET inv = json_set(COALESCE(inv, '{}'), '$.' || %s, COALESCE(json_extract(inv, '$.' || %s), 0) + %s)
+                               WHERE chat_id=%s AND user_id=%s""",
+        'remove_item_compact': """UPDATE players SET inv = CASE WHEN json_extract(inv, '$.' || %s) > %s
+                                      THEN json_set(inv, '$.' || %s, json_extract(inv, '$.' || %s) - %s)
+                                      ELSE json_remove(inv, '$.' || %s) END
+                                  WHERE chat_id=%s AND user_id=%s AND COALESCE(json_extract(inv, '$.' || %s), 0) >= %s""",
+        'bulk_set_weights': """UPDATE players SET weight = v.weight
+                               FROM (SELECT json_extract(value, '$.user_id') AS user_id, json_extract(value, '$.weight') AS weight FROM json_each(%s)) AS v
+                               WHERE players.chat_id=%s AND players.user_id=v.user_id""",
+        'bulk_kill': f"UPDATE players SET {KILL_RESET_SQL} WHERE chat_id=%s AND user_id IN (SELECT value FROM json_each(%s))",
+        'bulk_delete_inventory': "DELETE FROM inventory WHERE chat_id=%s AND user_id IN (SELECT value FROM json_each(%s))",
+        'bulk_insert_inventory': """INSERT INTO inventory (chat_id, user_id, item, quantity)
+                                    SELECT %s, json_extract(value, '$.user_id'), json_extract(value, '$.item'), json_extract(value, '$.quantity')
+                                    FROM json_each(%s)""",
+        'digest_gainers': """SELECT g.chat_id, g.user_id, g.gain, p.pet_name FROM (
+                               SELECT chat_id, user_id, SUM(json_extract(data, '$.delta')) AS gain,
+                                      ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY SUM(json_extract(data, '$.delta')) DESC, user_id) AS rn
+                               FROM events WHERE ts >= %s AND ts < %s AND json_extract(data, '$.delta') IS NOT NULL GROUP BY chat_id, user_id
+                             ) g LEFT JOIN players p ON p.chat_id=g.chat_id AND p.user_id=g.user_id
+                             WHERE g.rn = 1 AND g.gain > 0""",
+        'digest_deaths': """SELECT chat_id, json_extract(data, '$.pet_name') AS pet_name FROM events
+                            WHERE kind='death' AND ts >= %s AND ts < %s AND json_extract(data, '$.cause') = 'zonewalk' ORDER BY chat_id, ts""",
+        'digest_wheel': """SELECT w.chat_id, w.user_id, w.reward, w.quantity, p.pet_name FROM (
+                             SELECT chat_id, user_id, json_extract(data, '$.reward') AS reward, json_extract(data, '$.quantity') AS quantity,
+                                    ROW_NUMBER() OVER (PARTITION BY chat_id, json_extract(data, '$.reward') ORDER BY json_extract(data, '$.quantity') DESC, ts) AS rn
+                             FROM events WHERE kind='wheel' AND ts >= %s AND ts < %s AND json_extract(data, '$.reward') != 'nothing'
+                           ) w LEFT JOIN players p ON p.chat_id=w.chat_id AND p.user_id=w.user_id
+                           WHERE w.rn = 1""",
+        'bulk_set_inv': """UPDATE players SET inv = v.inv
+                           FROM (SELECT json_extract(value, '$.user_id') AS user_id, json_extract(value, '$.inv') AS inv FROM json_each(%s)) AS v
+                           WHERE players.chat_id=%s AND players.user_id=v.user_id""",
+    }
+
+    def __init__(self, path):
+        super().__init__()
+        if path in ('', ':memory:'):
+            # Спільна in-memory база для всіх потоків процесу
+            self.path, self.uri = 'file:pacetko?mode=memory&cache=shared', True
+        else:
+            self.path, self.uri = path, False
+        self._keepalive = self.connect()
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, uri=self.uri, detect_types=sqlite3.PARSE_DECLTYPES,
+                                   isolation_level=None, check_same_thread=False, timeout=5)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def release(self, conn):
+        # З'єднання живе в потоці, закривати його після кожного запиту немає сенсу
+        pass
+
+    def make_cursor(self, conn, dict_rows=False):
+        return _SqliteCursor(conn.cursor(), dict_rows)
+
+    def begin(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+
+    def init_schema(self):
+        conn = self.connect()
+        conn.executescript("""
+        CREATE TABLE IF NOT EXISTS players (
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          username TEXT,
+          pet_name TEXT,
+          weight INTEGER NOT NULL DEFAULT 10,
+          last_feed_utc DATE,
+          daily_feeds_count INTEGER NOT NULL DEFAULT 0,
+          last_zonewalk_utc DATE,
+          daily_zonewalks_count INTEGER NOT NULL DEFAULT 0,
+          last_wheel_utc DATE,
+          daily_wheel_count INTEGER NOT NULL DEFAULT 0,
+          last_pet_utc TIMESTAMPTZ,
+          last_message_id BIGINT,
+          cleanup_enabled BOOLEAN NOT NULL DEFAULT 1,
+          created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+          recruited_pets_count INTEGER NOT NULL DEFAULT 0,
+          last_recruitment_utc DATE,
+          last_fight_utc TIMESTAMPTZ,
+          born_utc TIMESTAMPTZ,
+          last_seen_utc DATE,
+          remind_ready BOOLEAN NOT NULL DEFAULT 0,
+          PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS inventory (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          item TEXT NOT NULL,
+          quantity INTEGER NOT NULL DEFAULT 0,
+          UNIQUE (chat_id, user_id, item)
+        );
+        CREATE TABLE IF NOT EXISTS events (
+          ts TIMESTAMPTZ NOT NULL,
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT,
+          kind TEXT NOT NULL,
+          data TEXT
+        );
+        CREATE INDEX IF NOT EXISTS events_chat_ts_idx ON events (chat_id, ts);
+        CREATE INDEX IF NOT EXISTS events_kind_ts_idx ON events (kind, ts);
+        CREATE INDEX IF NOT EXISTS players_weight_idx ON players (weight DESC, chat_id, user_id, pet_name);
+        CREATE TABLE IF NOT EXISTS weight_daily (
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          day DATE NOT NULL,
+          min_weight INTEGER NOT NULL,
+          max_weight INTEGER NOT NULL,
+          close_weight INTEGER NOT NULL,
+          PRIMARY KEY (chat_id, user_id, day)
+        );
+        CREATE TABLE IF NOT EXISTS chat_records (
+          chat_id BIGINT NOT NULL,
+          record TEXT NOT NULL,
+          user_id BIGINT NOT NULL,
+          pet_name TEXT,
+          value INTEGER NOT NULL,
+          ts TIMESTAMPTZ,
+          PRIMARY KEY (chat_id, record)
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          dedup_key TEXT UNIQUE,
+          chat_id BIGINT NOT NULL,
+          user_ids TEXT NOT NULL,
+          text TEXT NOT NULL,
+          reply_markup TEXT,
+          status TEXT NOT NULL DEFAULT 'pending',
+          attempts INTEGER NOT NULL DEFAULT 0,
+          created_at TIMESTAMPTZ NOT NULL,
+          next_attempt_at TIMESTAMPTZ NOT NULL,
+          sent_at TIMESTAMPTZ,
+          last_error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (next_attempt_at, id) WHERE status='pending';
+        CREATE TABLE IF NOT EXISTS players_archive (
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          data TEXT NOT NULL,
+          inv TEXT NOT NULL,
+          archived_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY (chat_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          text TEXT NOT NULL,
+          created_at TIMESTAMPTZ NOT NULL,
+          last_chat_id BIGINT NOT NULL DEFAULT -9223372036854775808,
+          sent INTEGER NOT NULL DEFAULT 0,
+          failed INTEGER NOT NULL DEFAULT 0,
+          finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_failures (
+          broadcast_id BIGINT NOT NULL,
+          chat_id BIGINT NOT NULL,
+          error TEXT,
+          PRIMARY KEY (broadcast_id, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS blocked_chats (
+          chat_id BIGINT PRIMARY KEY,
+          reason TEXT,
+          blocked_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS reminders (
+          chat_id BIGINT NOT NULL,
+          user_id BIGINT NOT NULL,
+          kind TEXT NOT NULL,
+          due_at TIMESTAMPTZ NOT NULL,
+          PRIMARY KEY (chat_id, user_id, kind)
+        );
+        CREATE INDEX IF NOT EXISTS reminders_due_idx ON reminders (due_at);
+        CREATE TABLE IF NOT EXISTS digest_runs (
+          day DATE PRIMARY KEY,
+          started_at TIMESTAMPTZ NOT NULL,
+          finished_at TIMESTAMPTZ,
+          chats INTEGER
+        );
+        """)
+        self._add_column('players', 'inv', 'TEXT')
+        self._add_column('outbox', 'delete_message_id', 'BIGINT')
+        self._add_column('players', 'remind_ready', 'BOOLEAN NOT NULL DEFAULT 0')
+        if self._add_column('players', 'last_seen_utc', 'DATE'):
+            conn.execute("UPDATE players SET last_seen_utc = ?", (now_utc().date(),))
+        conn.execute("CREATE INDEX IF NOT EXISTS players_last_seen_idx ON players (last_seen_utc)")
+        with self.transaction(), self.cursor() as cur:
+            if self.compact_inventory:
+                cur.execute("""
+                    UPDATE players SET inv = COALESCE(
+                      (SELECT json_group_object(i.item, i.quantity) FROM inventory i
+                       WHERE i.chat_id=players.chat_id AND i.user_id=players.user_id AND i.quantity > 0), '{}')
+                    WHERE inv IS NULL
+                """)
+                cur.execute("DELETE FROM inventory")
+            else:
+                cur.execute("""
+                    INSERT INTO inventory (chat_id, user_id, item, quantity)
+                    SELECT p.chat_id, p.user_id, kv.key, kv.value
+                    FROM players p, json_each(p.inv) kv
+                    WHERE p.inv IS NOT NULL AND kv.value > 0
+                    ON CONFLICT (chat_id, user_id, item) DO UPDATE SET quantity = EXCLUDED.quantity
+                """)
+                cur.execute("UPDATE players SET inv = NULL WHERE inv IS NOT NULL")
+
+    def _add_column(self, table, column, decl):
+        conn = self.connect()
+        columns = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            print(f"Adding '{column}' column to {table}...")
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+            return True
+        return False
+
+
+def create_storage(url, replica_url=None):
+    """sqlite:///шлях/до/файлу.db — вбудований SQLite, будь-що інше — DSN PostgreSQL."""
+    if url and url.startswith('sqlite:'):
+        path = url[len('sqlite:///'):] if url.startswith('sqlite:///') else url[len('sqlite:'):]
+        return SqliteStorage(path)
+    return PostgresStorage(url, replica_dsn=replica_url)
+
+storage = create_storage(DATABASE_URL, DATABASE_REPLICA_URL)
 
 def init_db():
-    sql_players_create = """
-    CREATE TABLE IF NOT EXISTS players (
-      chat_id BIGINT NOT NULL,
-      user_id BIGINT NOT NULL,
-      username TEXT,
-      pet_name TEXT,
-      weight INTEGER NOT NULL DEFAULT 10,
-      last_feed_utc DATE,
-      daily_feeds_count INTEGER NOT NULL DEFAULT 0,
-      last_zonewalk_utc DATE,
-      daily_zonewalks_count INTEGER NOT NULL DEFAULT 0,
-      last_wheel_utc DATE,
-      daily_wheel_count INTEGER NOT NULL DEFAULT 0,
-      last_pet_utc TIMESTAMPTZ,
-      last_message_id BIGINT,
-      cleanup_enabled BOOLEAN NOT NULL DEFAULT TRUE,
-      created_at TIMESTAMPTZ DEFAULT now(),
-      recruited_pets_count INTEGER NOT NULL DEFAULT 0,
-      last_recruitment_utc DATE,
-      PRIMARY KEY (chat_id, user_id)
-    );
-    """
-    sql_inv = """
-    CREATE TABLE IF NOT EXISTS inventory (
-      id SERIAL PRIMARY KEY,
-      chat_id BIGINT NOT NULL,
-      user_id BIGINT NOT NULL,
-      item TEXT NOT NULL,
-      quantity INTEGER NOT NULL DEFAULT 0,
-      UNIQUE (chat_id, user_id, item)
-    );
+    storage.init_schema()
+
+# === NEW FEATURE: Hot/cold players ===
+# players і inventory містять лише тих, хто грав останні ARCHIVE_AFTER_DAYS днів;
+# решта лежить у players_archive одним JSON-рядком і повертається ensure_player()
+# на першій же команді. Гравця під player_lock архіватор пропускає (try-lock).
+class ColdArchiver:
+    def __init__(self, after_days=ARCHIVE_AFTER_DAYS, check_seconds=ARCHIVE_CHECK_SECONDS, batch_size=ARCHIVE_BATCH_SIZE,
+                 background=True):
+        self.after_days = after_days
+        self.check_seconds = check_seconds
+        self.batch_size = batch_size
+        self.background = background
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if not self.after_days or not self.background or self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cold-archiver', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print('archiver error:', e)
+            time.sleep(self.check_seconds)
+
+    def run_once(self):
+        """Архівує всіх неактивних гравців пачками; повертає їх кількість."""
+        seen_before = now_utc().date() - timedelta(days=self.after_days)
+        archived = 0
+        while True:
+            started = time.perf_counter()
+            keys = storage.archive_players(seen_before, self.batch_size, now_utc())
+            record_timing("archive.batch", time.perf_counter() - started)
+            for chat_id, user_id in keys:
+                leaderboard.observe(chat_id, user_id, 0)
+                shield.forget(chat_id, user_id)
+            archived += len(keys)
+            if len(keys) < self.batch_size:
+                break
+        incr("archive.archived", archived)
+        return archived
+
+archiver = ColdArchiver()
+
+def handle_bot_membership(update):
+    """my_chat_member: бота вигнали або він вийшов — стан чату більше нікому не потрібен."""
+    chat_id = update['chat']['id']
+    status = (update.get('new_chat_member') or {}).get('status')
+    if status in ('member', 'administrator'):
+        storage.unblock_chat(chat_id)  # бота повернули — розсилки знову йдуть у цей чат
+        return
+    if status not in ('left', 'kicked'):
+        return
+    purged = storage.purge_chat(chat_id)
+    _top_cache.pop(chat_id, None)
+    leaderboard.load()
+    incr("archive.purged_chats")
+    print(f"Bot removed from chat {chat_id} ({status}), purged {purged} players")
+# ====================================
+
+# === NEW FEATURE: Нічний дайджест ===
+# Після опівночі UTC кількома запитами по events (усі чати разом) рахуються підсумки
+# минулої доби. Рахує лише воркер, що захопив день у digest_runs; він же пам'ятає
+# зроблені дні, тож воркер, запущений після опівночі, дорахує пропущений дайджест.
+# Повідомлення йдуть в outbox з ключем digest:<день>:<чат> і розкладені в часі, щоб
+# не впертися в ліміти Telegram.
+class DigestJob:
+    CLAIM_SECONDS = 6 * 3600  # незавершений (воркер упав) день можна перехопити після цього
+    RETRY_SECONDS = 300
+
+    def __init__(self, delay_seconds=DIGEST_DELAY_SECONDS, chats_per_second=DIGEST_CHATS_PER_SECOND, background=True):
+        self.delay_seconds = delay_seconds
+        self.chats_per_second = chats_per_second
+        self.background = background
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if not (DIGEST_ENABLED and EVENTS_ENABLED) or not self.background or self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='daily-digest', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            now = now_utc()
+            # Та сама межа доби, що й у format_timedelta_to_next_day()
+            due = datetime.combine(now.date(), datetime.min.time(), tzinfo=timezone.utc) + timedelta(seconds=self.delay_seconds)
+            if now < due:
+                time.sleep((due - now).total_seconds())
+                continue
+            # Минула доба: або щойно настала північ, або воркер стартував пізніше і доганяє
+            try:
+                self.run(now.date() - timedelta(days=1))
+            except Exception as e:
+                print('digest error:', e)
+                time.sleep(self.RETRY_SECONDS)
+                continue
+            time.sleep((due + timedelta(days=1) - now_utc()).total_seconds())
+
+    def run(self, day):
+        """Рахує й ставить у чергу дайджести за `day`; повертає кількість чатів (0, якщо
+        день уже зробив або саме робить інший воркер)."""
+        now = now_utc()
+        if not storage.claim_digest(day, now, now - timedelta(seconds=self.CLAIM_SECONDS)):
+            incr("digest.skipped")
+            return 0
+        try:
+            sent = self._run_day(day)
+        except Exception:
+            storage.release_digest(day)
+            raise
+        storage.finish_digest(day, sent, now_utc())
+        return sent
+
+    def _run_day(self, day):
+        journal.flush()  # свої події — в БД; інші воркери скидають свої кожні EVENTS_FLUSH_SECONDS
+        start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+        started = time.perf_counter()
+        digests = storage.daily_digest(start, start + timedelta(days=1))
+        record_timing("digest.query", time.perf_counter() - started)
+        messages = [(chat_id, text) for chat_id, d in sorted(digests.items()) if (text := format_digest(day, d))]
+        ts = now_utc()
+        if OUTBOX_ENABLED:
+            # Кожна секунда розкладу — окрема пачка на chats_per_second чатів зі своїм not_before
+            per_second = max(1, int(self.chats_per_second))
+            for second, i in enumerate(range(0, len(messages), per_second)):
+                storage.enqueue_messages([(f"digest:{day}:{chat_id}", chat_id, [], text, None) for chat_id, text in messages[i:i + per_second]],
+                                         ts, not_before=ts + timedelta(seconds=second))
+            outbox.start()
+        else:
+            for chat_id, text in messages:
+                try:
+                    deliver_message(chat_id, [], text)
+                except Exception as e:
+                    print('digest send error', e)
+                time.sleep(1 / self.chats_per_second)
+        incr("digest.chats", len(messages))
+        return len(messages)
+
+def format_digest(day, digest):
+    lines = [f"📰 Підсумки дня {day:%d.%m.%Y}:"]
+    gainer = digest['gainer']
+    if gainer:
+        lines.append(f"🐷 Найбільше наїло сальця: {gainer['pet_name'] or 'Пацєтко'} (+{gainer['gain']} кг)")
+    if digest['deaths']:
+        lines.append("💀 Не повернулися із Зони: " + ", ".join(name or 'Пацєтко' for name in digest['deaths']))
+    # Найкращий виграш — найрідкісніший приз колеса за поточним конфігом
+    wins = sorted(digest['wheel'], key=lambda w: (GAME.wheel_rewards.get(w['reward'], {}).get('weight', math.inf), -w['quantity']))
+    if wins:
+        best = wins[0]
+        lines.append(f"🎰 Найкращий виграш у Золотому Хряцику: {best['pet_name'] or 'Пацєтко'} — {GAME.item_name(best['reward'])} ({best['quantity']} шт)")
+    return "\n".join(lines) if len(lines) > 1 else None
+
+digest = DigestJob()
+
+def start_background_jobs():
+    """Фонові потоки воркера; повторні виклики нічого не роблять."""
+    if OUTBOX_ENABLED:
+        outbox.start()  # дошле те, що лишилося в outbox до рестарту
+    archiver.start()
+    digest.start()
+    reminders.start()
+# ====================================
+
+# === NEW FEATURE: Нагадування (/remind) ===
+# Гравець, що увімкнув /remind, отримує одне повідомлення, коли минає кулдаун /pet чи
+# /fight або настає нова доба UTC для /zonewalk, — замість перевіряти командою.
+# Таблиця reminders — джерело правди (переживає рестарт), а в пам'яті кожного воркера
+# ієрархічне колесо таймерів, яке каже, коли й що забирати з неї.
+class TimingWheel:
+    """Ієрархічне колесо таймерів: рівень i має `slots` комірок по slots**i тиків.
+
+    add() і кожен тик — O(1). Таймер лягає на найнижчий рівень, куди вміщується його
+    відстань; коли нижчий рівень робить повний оберт, відповідна комірка вищого рівня
+    розсипається на нижчі (каскад), тож до спрацювання таймер переноситься не більше
+    `levels` разів. Час — секунди epoch, тик — `tick` секунд.
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # === Migration logic ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name IN ('last_feed', 'last_zonewalk')")
-    old_columns = [row[0] for row in cur.fetchall()]
-    
-    if 'last_feed' in old_columns:
-        print("Migrating 'last_feed' column...")
-        cur.execute("ALTER TABLE players RENAME COLUMN last_feed TO last_feed_utc")
-        cur.execute("ALTER TABLE players ALTER COLUMN last_feed_utc TYPE DATE USING last_feed_utc::date")
-        
-    if 'last_zonewalk' in old_columns:
-        print("Migrating 'last_zonewalk' column...")
-        cur.execute("ALTER TABLE players RENAME COLUMN last_zonewalk TO last_zonewalk_utc")
-        cur.execute("ALTER TABLE players ALTER COLUMN last_zonewalk_utc TYPE DATE USING last_zonewalk_utc::date")
-    
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='daily_zonewalks_count'")
-    if not cur.fetchone():
-        print("Adding 'daily_zonewalks_count' column...")
-        cur.execute("ALTER TABLE players ADD COLUMN daily_zonewalks_count INTEGER NOT NULL DEFAULT 0")
-
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='daily_feeds_count'")
-    if not cur.fetchone():
-        print("Adding 'daily_feeds_count' column...")
-        cur.execute("ALTER TABLE players ADD COLUMN daily_feeds_count INTEGER NOT NULL DEFAULT 0")
-
-    # === NEW FEATURE: Колесо Фортуни (DB Migration) ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_wheel_utc'")
-    if not cur.fetchone():
-        print("Adding 'last_wheel_utc' and 'daily_wheel_count' columns...")
-        cur.execute("ALTER TABLE players ADD COLUMN last_wheel_utc DATE")
-        cur.execute("ALTER TABLE players ADD COLUMN daily_wheel_count INTEGER NOT NULL DEFAULT 0")
-    # =================================================
-
-    # === NEW FEATURE: Pet Cooldown (DB Migration) ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_pet_utc'")
-    if not cur.fetchone():
-        print("Adding 'last_pet_utc' column...")
-        cur.execute("ALTER TABLE players ADD COLUMN last_pet_utc TIMESTAMPTZ")
-    # ===============================================
-    
-    # === NEW FEATURE: Message cleanup (DB Migration) ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_message_id'")
-    if not cur.fetchone():
-        print("Adding 'last_message_id' column...")
-        cur.execute("ALTER TABLE players ADD COLUMN last_message_id BIGINT")
-    # =================================================
-    
-    # === NEW FEATURE: Cleanup toggle (DB Migration) ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='cleanup_enabled'")
-    if not cur.fetchone():
-        print("Adding 'cleanup_enabled' column...")
-        cur.execute("ALTER TABLE players ADD COLUMN cleanup_enabled BOOLEAN NOT NULL DEFAULT TRUE")
-    # =================================================
-
-    # === NEW FEATURE: Смерть і вербування (DB Migration) ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='recruited_pets_count'")
-    if not cur.fetchone():
-        print("Adding 'recruited_pets_count' and 'last_recruitment_utc' columns...")
-        cur.execute("ALTER TABLE players ADD COLUMN recruited_pets_count INTEGER NOT NULL DEFAULT 0")
-        cur.execute("ALTER TABLE players ADD COLUMN last_recruitment_utc DATE")
-    # =======================================================
-    
-    # === NEW FEATURE: Fight cooldown (DB Migration) ===
-    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='players' AND column_name='last_fight_utc'")
-    if not cur.fetchone():
-        print("Adding 'last_fight_utc' column...")
-        cur.execute("ALTER TABLE players ADD COLUMN last_fight_utc TIMESTAMPTZ")
-    # ==================================================
-    
-    # --- Фрагмент у init_db() --- 
-    cur.execute("""
-      SELECT column_name
-      FROM information_schema.columns
-      WHERE table_name='players' AND column_name='born_utc'
-    """)
-    if not cur.fetchone():
-      print("Adding 'born_utc' column...")
-      cur.execute("ALTER TABLE players ADD COLUMN born_utc TIMESTAMPTZ")
-      cur.execute("UPDATE players SET born_utc = NOW()")
-
-    # Create tables if they don't exist
-    cur.execute(sql_players_create)
-    cur.execute(sql_inv)
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# === Game data ===
-ITEMS = {
-    "baton": {"u_name": "Батон", "feed_delta": (-2,5), "uses_for": ["feed", "external_feed"]},
-    "sausage": {"u_name": "Ковбаса", "feed_delta": (-4,9), "uses_for": ["feed", "external_feed"]},
-    "can": {"u_name": 'Консерва "Сніданок Пацєти"', "feed_delta": (-7,15), "uses_for": ["feed", "external_feed"]},
-    "vodka": {"u_name": 'Горілка "Пацятки"', "feed_delta": (-12,25), "uses_for": ["feed", "zonewalk", "external_feed"]},
-    "energy": {"u_name": 'Енергетик "Нон Хрюк"', "feed_delta": None, "uses_for": ["zonewalk"]},
-    "low_saloid": {"u_name": "Малий шприц з салоїдами", "feed_delta": (5,5), "uses_for": ["feed", "external_feed"]},
-    "mid_saloid": {"u_name": "Шприц з салоїдами", "feed_delta": (10,10), "uses_for": ["feed", "external_feed"]},
-    "big_saloid": {"u_name": "Великий шприц з салоїдами", "feed_delta": (15,15), "uses_for": ["feed", "external_feed"]},
-    "strange_saloid": {"u_name": "Дивний шприц з салоїдами", "feed_delta": (-50,50), "uses_for": ["feed", "external_feed"]},
-}
-ALIASES = {
-    "батон":"baton","хліб":"baton","baton":"baton",
-    "ковбаса":"sausage","sausage":"sausage",
-    "консерва":"can","сніданок":"can","can":"can",
-    "горілка":"vodka","пацятки":"vodka","vodka":"vodka",
-    "енергетик":"energy","енергітик":"energy","energy":"energy",
-    "малий_салоїд": "low_saloid", "малий_шприц": "low_saloid", "low_saloid": "low_saloid",
-    "салоїд": "mid_saloid", "шприц": "mid_saloid", "mid_saloid": "mid_saloid",
-    "великий_салоїд": "big_saloid", "великий_шприц": "big_saloid", "big_saloid": "big_saloid",
-    "дивний_салоїд": "strange_saloid", "дивний_шприц": "strange_saloid", "strange_saloid": "strange_saloid",
-}
 
-LOOT_POOL = ["baton", "sausage", "can", "vodka", "energy", "low_saloid", "mid_saloid", "big_saloid", "strange_saloid"]
-LOOT_WEIGHTS = [20, 15, 15, 5, 10, 15, 10, 7, 3]
-
-# === NEW FEATURE: Колесо Фортуни (Rewards) ===
-WHEEL_REWARDS = {
-    "nothing": {"u_name": "Дуля з маком і консервна банка від Сидора", "quantity": 0, "weight": 30},
-    "baton": {"u_name": "Батон", "quantity": 1, "weight": 15},
-    "sausage": {"u_name": "Ковбаса", "quantity": 1, "weight": 10},
-    "can": {"u_name": 'Консерва "Сніданок Пацєти"', "quantity": 1, "weight": 10},
-    "vodka": {"u_name": 'Горілка "Пацятки"', "quantity": 1, "weight": 5},
-    "energy": {"u_name": 'Енергетик "Нон Хрюк"', "quantity": 1, "weight": 10},
-    "low_saloid": {"u_name": "Малий шприц з салоїдами", "quantity": 1, "weight": 10},
-    "mid_saloid": {"u_name": "Шприц з салоїдами", "quantity": 1, "weight": 5},
-    "big_saloid": {"u_name": "Великий шприц з салоїдами", "quantity": 1, "weight": 3},
-    "strange_saloid": {"u_name": "Дивний шприц з салоїдами", "quantity": 1, "weight": 2},
+    def __init__(self, now, tick=1.0, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.current = int(now // tick)  # останній оброблений тик
+        self.size = 0
+
+    def add(self, due, item):
+        self._place(max(int(math.ceil(due / self.tick)), self.current + 1), item)
+        self.size += 1
+
+    def _place(self, expires, item):
+        delta = expires - self.current
+        level, span = 0, self.slots
+        while delta >= span and level < len(self.levels) - 1:
+            level, span = level + 1, span * self.slots
+        if delta >= span:
+            # За горизонтом колеса: у найдальшу комірку, звідти каскадом ще раз
+            expires_at = self.current + span - 1
+        else:
+            expires_at = expires
+        slot = (expires_at // (span // self.slots)) % self.slots
+        self.levels[level][slot].append((expires, item))
+
+    def advance(self, now):
+        """Прокручує колесо до `now`; повертає елементи, чий час настав."""
+        due = []
+        target = int(now // self.tick)
+        while self.current < target:
+            self.current += 1
+            for level in range(1, len(self.levels)):
+                span = self.slots ** level
+                if self.current % span:
+                    break
+                slot = self.levels[level][(self.current // span) % self.slots]
+                entries, slot[:] = list(slot), []
+                for expires, item in entries:
+                    self._place(expires, item)
+            slot = self.levels[0][self.current % self.slots]
+            due.extend(item for _, item in slot)
+            slot.clear()
+        self.size -= len(due)
+        return due
+
+REMINDER_TEXTS = {
+    'pet': "{pet} знову чекає, щоб його почухали за вушком: /pet",
+    'fight': "{pet} зализало подряпини і рветься в бійку: /fight",
+    'zonewalk': "{pet} відпочило, нові ходки в Зону вже доступні: /zonewalk",
 }
+
+def next_utc_day():
+    """Початок наступної доби UTC — та сама межа, що й у format_timedelta_to_next_day()."""
+    return datetime.combine(now_utc().date() + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+
+def schedule_reminder(chat_id, user_id, kind, due):
+    if REMINDERS_ENABLED and storage.schedule_reminder(chat_id, user_id, kind, due):
+        reminders.add(chat_id, user_id, kind, due)
+        incr("reminders.scheduled")
+
+def format_reminders(rows):
+    lines = ["🔔 Пацєтка готові:"]
+    for r in rows:
+        mention = f"@{r['username']} — " if r.get('username') else ""
+        lines.append(mention + REMINDER_TEXTS[r['kind']].format(pet=r['pet_name'] or 'Пацєтко'))
+    return "\n".join(lines)
+
+class ReminderScheduler:
+    def __init__(self, tick_seconds=REMINDER_TICK_SECONDS, sweep_seconds=REMINDER_SWEEP_SECONDS, background=True):
+        self.tick_seconds = tick_seconds
+        self.sweep_seconds = sweep_seconds
+        self.background = background
+        self.wheel = TimingWheel(time.time(), tick=tick_seconds)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def start(self):
+        if not REMINDERS_ENABLED or not self.background or self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self.load()
+                self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+                self._thread.start()
+
+    def load(self):
+        """Після рестарту: усі нагадування з БД — у колесо (прострочені спрацюють на першому тіку)."""
+        rows = storage.pending_reminders()
+        for chat_id, user_id, kind, due_at in rows:
+            self.add(chat_id, user_id, kind, due_at)
+        return len(rows)
+
+    def add(self, chat_id, user_id, kind, due):
+        with self._lock:
+            self.wheel.add(due.timestamp(), (chat_id, user_id, kind))
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick_seconds)
+            try:
+                self.run_once()
+            except Exception as e:
+                print('reminders error:', e)
+
+    def run_once(self, now=None):
+        """Один тік: забирає й надсилає нагадування, чий час настав; повертає кількість."""
+        now = now or now_utc()
+        with self._lock:
+            due = self.wheel.advance(now.timestamp())
+        fired = self.fire(storage.claim_reminders(now, set(due))) if due else 0
+        # Нагадування, заплановані воркером, що відтоді впав, є лише в БД
+        if time.monotonic() - self._swept_at >= self.sweep_seconds:
+            self._swept_at = time.monotonic()
+            fired += self.fire(storage.claim_reminders(now - timedelta(seconds=self.sweep_seconds)))
+        return fired
+
+    def fire(self, rows):
+        """Одне повідомлення на чат з усіма його нагадуваннями цього тіку."""
+        by_chat = {}
+        for r in rows:
+            by_chat.setdefault(r['chat_id'], []).append(r)
+        ts = now_utc()
+        messages = [(chat_id, format_reminders(chat_rows)) for chat_id, chat_rows in sorted(by_chat.items())]
+        if OUTBOX_ENABLED:
+            if messages:
+                storage.enqueue_messages([(f"remind:{chat_id}:{ts.timestamp():.3f}", chat_id, [], text, None) for chat_id, text in messages], ts)
+                outbox.wake()
+        else:
+            for chat_id, text in messages:
+                try:
+                    deliver_message(chat_id, [], text)
+                except Exception as e:
+                    print('reminder send error', e)
+        incr("reminders.fired", len(rows))
+        incr("reminders.messages", len(messages))
+        return len(rows)
+
+reminders = ReminderScheduler()
+
+def handle_remind(chat_id, user_id, username):
+    player = ensure_player(chat_id, user_id, username)
+    pet_name = player.get('pet_name') or 'Пацєтко'
+    if not REMINDERS_ENABLED:
+        send_message(chat_id, user_id, "Нагадування зараз вимкнені.")
+        return
+    enabled = not player.get('remind_ready')
+    storage.set_remind_ready(chat_id, user_id, enabled)
+    if not enabled:
+        send_message(chat_id, user_id, "🔕 Нагадування вимкнено.")
+        return
+    # Кулдауни, що вже йдуть, теж дочекаються нагадування
+    now = now_utc()
+    if player.get('last_pet_utc') and player['last_pet_utc'] + timedelta(hours=GAME.pet_cooldown_hours) > now:
+        schedule_reminder(chat_id, user_id, 'pet', player['last_pet_utc'] + timedelta(hours=GAME.pet_cooldown_hours))
+    if player.get('last_fight_utc') and player['last_fight_utc'] + timedelta(hours=GAME.fight_cooldown_hours) > now:
+        schedule_reminder(chat_id, user_id, 'fight', player['last_fight_utc'] + timedelta(hours=GAME.fight_cooldown_hours))
+    if player.get('last_zonewalk_utc') == now.date() and player['daily_zonewalks_count'] >= GAME.daily_zonewalks_limit:
+        schedule_reminder(chat_id, user_id, 'zonewalk', next_utc_day())
+    send_message(chat_id, user_id, f"🔔 Нагадування увімкнено: бот напише, коли {pet_name} можна буде чухати (/pet), битися (/fight) і коли з'являться нові ходки (/zonewalk). Вимкнути — ще раз /remind.")
+# ====================================
+
+# === NEW FEATURE: Events journal ===
+# Механіки пишуть події в буфер у пам'яті, а фоновий потік скидає їх у events
+# пачками (COPY у Postgres), тож аналітика не чіпає гарячу таблицю players.
+class EventJournal:
+    def __init__(self, flush_seconds=EVENTS_FLUSH_SECONDS, flush_size=EVENTS_FLUSH_SIZE, max_buffer=EVENTS_MAX_BUFFER):
+        self.flush_seconds = flush_seconds
+        self.flush_size = flush_size
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def emit(self, kind, chat_id, user_id, data, ts=None):
+        with self._lock:
+            self._buffer.append((ts or now_utc(), chat_id, user_id, kind, data))
+            if len(self._buffer) > self.max_buffer:
+                dropped = len(self._buffer) - self.max_buffer
+                del self._buffer[:dropped]
+                incr("events.dropped", dropped)
+            full = len(self._buffer) >= self.flush_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-journal', daemon=True)
+                self._thread.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return
+            started = time.perf_counter()
+            try:
+                storage.append_events(rows)
+            except Exception as e:
+                print('events flush error:', e)
+                with self._lock:
+                    self._buffer[:0] = rows  # спробуємо наступного разу
+                return
+            record_timing("events.flush", time.perf_counter() - started)
+            incr("events.written", len(rows))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+journal = EventJournal()
+atexit.register(journal.flush)
+
+def emit_event(kind, chat_id, user_id, **data):
+    """Подія потрапляє в журнал лише після коміту: відкочена смерть чи годування не записуються."""
+    if EVENTS_ENABLED:
+        storage.after_commit(journal.emit, kind, chat_id, user_id, data, now_utc())
+# ===================================
+
+# === NEW FEATURE: Global leaderboard ===
+# Кандидати в глобальний топ у пам'яті: завантажуються з players_weight_idx і
+# оновлюються на кожній зміні ваги, тож /globaltop не сканує players.
+# Усі пацєтки поза топом важать не більше за floor; поки принаймні n кандидатів
+# важчі за floor, перші n — точний топ. Інакше (або раз на
+# GLOBAL_TOP_REFRESH_SECONDS, щоб підхопити записи інших воркерів) — перечитуємо.
+class GlobalLeaderboard:
+    def __init__(self, size=GLOBAL_TOP_SIZE, refresh_seconds=GLOBAL_TOP_REFRESH_SECONDS):
+        self.size = size
+        self.capacity = size * 4
+        self.refresh_seconds = refresh_seconds
+        self._entries = {}  # (chat_id, user_id) -> [weight, pet_name]
+        self._floor = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        rows = storage.global_top(self.capacity)
+        with self._lock:
+            self._entries = {(r['chat_id'], r['user_id']): [r['weight'], r['pet_name']] for r in rows}
+            self._floor = rows[-1]['weight'] if len(rows) == self.capacity else 0
+            self._loaded_at = time.monotonic()
+        incr("globaltop.reload")
+
+    def observe(self, chat_id, user_id, weight, pet_name=None):
+        # Після коміту: відкочена вага чи смерть не потрапляє в топ
+        storage.after_commit(self._observe, chat_id, user_id, weight, pet_name)
+
+    def _observe(self, chat_id, user_id, weight, pet_name):
+        with self._lock:
+            if self._floor is None:
+                return  # ще не завантажено — load() прочитає актуальний стан
+            key = (chat_id, user_id)
+            entry = self._entries.get(key)
+            if weight <= 0:
+                self._entries.pop(key, None)
+            elif entry:
+                entry[0] = weight
+                if pet_name:
+                    entry[1] = pet_name
+            elif weight > self._floor:
+                self._entries[key] = [weight, pet_name]
+                if len(self._entries) > self.capacity:
+                    evicted = min(self._entries, key=lambda k: self._entries[k][0])
+                    self._floor = max(self._floor, self._entries.pop(evicted)[0])
+
+    def top(self, n):
+        with self._lock:
+            fresh = self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_seconds
+            # floor == 0: завантажено всіх живих пацєток, пропущених немає
+            exact = fresh and (self._floor == 0 or sum(1 for w, _ in self._entries.values() if w > self._floor) >= n)
+        if not exact:
+            self.load()
+        with self._lock:
+            ranked = [(key, list(entry)) for key, entry in sorted(self._entries.items(), key=lambda kv: -kv[1][0])[:n]]
+        rows = []
+        for (chat_id, user_id), (weight, pet_name) in ranked:
+            if pet_name is None:
+                # Новачок у топі, доданий через observe() без імені
+                player = storage.get_player(chat_id, user_id)
+                pet_name = player and player.get('pet_name')
+                with self._lock:
+                    entry = self._entries.get((chat_id, user_id))
+                    if entry and entry[1] is None:
+                        entry[1] = pet_name
+            rows.append((chat_id, user_id, weight, pet_name))
+        return rows
+
+leaderboard = GlobalLeaderboard()
+# =======================================
+
+# === Game data (game_config.json, hot reload) ===
+# Баланс гри живе у версіонованому JSON. При завантаженні він перевіряється і
+# компілюється в готові таблиці (аліаси, кумулятивні ваги луту й колеса, множини
+# предметів за призначенням). Новий конфіг підміняє старий однією операцією, а
+# кожен апдейт працює з тією версією, що була актуальна на його початку.
+ITEM_USES = ('feed', 'zonewalk', 'external_feed')
+GAME_LIMITS = ('daily_feeds', 'daily_zonewalks', 'daily_wheel', 'pet_cooldown_hours', 'fight_cooldown_hours',
+               'starting_weight', 'daily_recruits', 'max_recruited_pets')
+
+class GameConfig:
+    def __init__(self, raw):
+        def check(cond, msg):
+            if not cond:
+                raise ValueError(f"game config: {msg}")
+
+        check(isinstance(raw.get('version'), int), "version must be an integer")
+        self.version = raw['version']
+
+        limits = raw.get('limits') or {}
+        for name in GAME_LIMITS:
+            check(isinstance(limits.get(name), int) and limits[name] >= 0, f"limits.{name} must be a non-negative integer")
+        self.daily_feeds_limit = limits['daily_feeds']
+        self.daily_zonewalks_limit = limits['daily_zonewalks']
+        self.daily_wheel_limit = limits['daily_wheel']
+        self.pet_cooldown_hours = limits['pet_cooldown_hours']
+        self.fight_cooldown_hours = limits['fight_cooldown_hours']
+        self.starting_weight = limits['starting_weight']
+        self.daily_recruits_limit = limits['daily_recruits']
+        self.max_recruited_pets = limits['max_recruited_pets']
+
+        self.items, self.aliases = {}, {}
+        self.usable = {use: set() for use in ITEM_USES}
+        loot = []
+        check(raw.get('items'), "items must not be empty")
+        for key, item in raw['items'].items():
+            check(isinstance(item.get('u_name'), str) and item['u_name'], f"items.{key}.u_name is required")
+            uses = frozenset(item.get('uses_for') or [])
+            check(uses <= set(ITEM_USES), f"items.{key}.uses_for: unknown use {sorted(uses - set(ITEM_USES))}")
+            delta = item.get('feed_delta')
+            if delta is not None:
+                check(len(delta) == 2 and delta[0] <= delta[1], f"items.{key}.feed_delta must be [min, max]")
+                delta = tuple(delta)
+            check(delta is not None or not uses & {'feed', 'external_feed'}, f"items.{key} is edible but has no feed_delta")
+            self.items[key] = {'u_name': item['u_name'], 'feed_delta': delta, 'uses_for': uses}
+            for use in uses:
+                self.usable[use].add(key)
+            for alias in [key] + list(item.get('aliases') or []):
+                alias = alias.lower()
+                check(self.aliases.get(alias, key) == key, f"alias '{alias}' used by {self.aliases.get(alias)} and {key}")
+                self.aliases[alias] = key
+            if item.get('loot_weight'):
+                loot.append((key, item['loot_weight']))
+        self.usable = {use: frozenset(keys) for use, keys in self.usable.items()}
+        check(loot, "at least one item needs loot_weight")
+        self.loot_keys = tuple(k for k, _ in loot)
+        self.loot_cum_weights = list(itertools.accumulate(w for _, w in loot))
+
+        for name, use in (('feed_priority', 'feed'), ('zonewalk_priority', 'zonewalk')):
+            order = raw.get(name) or []
+            check(all(k in self.usable[use] for k in order), f"{name} may only list items usable for {use}")
+            setattr(self, name, tuple(order))
+
+        self.wheel_rewards = {}
+        check(raw.get('wheel'), "wheel must not be empty")
+        for key, reward in raw['wheel'].items():
+            check(key == 'nothing' or key in self.items, f"wheel.{key} is not an item")
+            check(isinstance(reward.get('weight'), (int, float)) and reward['weight'] > 0, f"wheel.{key}.weight must be positive")
+            self.wheel_rewards[key] = {'u_name': reward.get('u_name') or self.items[key]['u_name'],
+                                       'quantity': int(reward.get('quantity', 1)), 'weight': reward['weight']}
+        self.wheel_keys = tuple(self.wheel_rewards)
+        self.wheel_cum_weights = list(itertools.accumulate(r['weight'] for r in self.wheel_rewards.values()))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def item_name(self, key):
+        return self.items.get(key, {}).get('u_name', key)
+
+
+class _GameProxy:
+    """GAME.<атрибут> — конфіг, закріплений за поточним апдейтом, або найсвіжіший."""
+
+    def __getattr__(self, name):
+        return getattr(getattr(_game_local, 'config', None) or _game_state['config'], name)
+
+
+_game_local = threading.local()
+_game_lock = threading.Lock()
+_game_state = {'config': GameConfig.load(GAME_CONFIG_PATH), 'mtime': os.path.getmtime(GAME_CONFIG_PATH), 'checked': time.monotonic()}
+GAME = _GameProxy()
+
+def reload_game_config(force=False):
+    """Перечитує game_config.json, якщо він змінився; зламаний файл не замінює робочий конфіг."""
+    with _game_lock:
+        mtime = os.path.getmtime(GAME_CONFIG_PATH)
+        if mtime == _game_state['mtime'] and not force:
+            return False
+        _game_state['mtime'] = mtime
+        try:
+            config = GameConfig.load(GAME_CONFIG_PATH)
+        except Exception as e:
+            incr("game_config.reload_error")
+            print('game config reload failed, keeping version', _game_state['config'].version, '-', e)
+            return False
+        _game_state['config'] = config
+    incr("game_config.reload")
+    print('game config loaded, version', config.version)
+    return True
+
+@contextmanager
+def pin_game():
+    """Закріплює версію конфігу на час обробки одного апдейта."""
+    now = time.monotonic()
+    if now - _game_state['checked'] >= GAME_CONFIG_CHECK_SECONDS:
+        _game_state['checked'] = now
+        try:
+            reload_game_config()
+        except OSError as e:
+            print('game config check failed:', e)
+    _game_local.config = _game_state['config']
+    try:
+        yield
+    finally:
+        _game_local.config = None
 # ===============================================
 
 # === Utility helpers ===
@@ -215,238 +2404,141 @@ def now_utc():
     return datetime.now(timezone.utc)
 
 def ensure_player(chat_id, user_id, username):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM players WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    row = cur.fetchone()
+    row = storage.get_player(chat_id, user_id)
+    today = now_utc().date()
+    if not row:
+        # Навіть з ARCHIVE_AFTER_DAYS=0: вже заархівовані гравці мають повернутися
+        row = storage.restore_player(chat_id, user_id, today)
+        if row:
+            incr("archive.restored")
+            leaderboard.observe(chat_id, user_id, row['weight'], row.get('pet_name'))
+    elif row and row.get('last_seen_utc') != today:
+        storage.touch_player(chat_id, user_id, today)  # одна зміна на гравця на добу
     if not row:
         pet_name = f"Пацєтко_{user_id%1000}"
         # --- Функція створення нового пацєтка ---
-        cur.execute("""
-            INSERT INTO players (chat_id, user_id, username, pet_name, weight, created_at, born_utc)
-            VALUES (%s,%s,%s,%s,%s,%s,%s)
-        """, (chat_id, user_id, username or '', pet_name, STARTING_WEIGHT, now_utc(), now_utc()))
-        conn.commit()
-        cur.execute("SELECT * FROM players WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-        row = cur.fetchone()
-    cur.close()
-    conn.close()
+        storage.insert_player(chat_id, user_id, username or '', pet_name, GAME.starting_weight, now_utc())
+        leaderboard.observe(chat_id, user_id, GAME.starting_weight, pet_name)
+        row = storage.get_player(chat_id, user_id)
+    shield.observe(row)
     return row
 
 def update_weight(chat_id, user_id, new_weight):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET weight=%s WHERE chat_id=%s AND user_id=%s", (new_weight, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.update_weight(chat_id, user_id, new_weight, now_utc())
+    leaderboard.observe(chat_id, user_id, new_weight)
 
 def set_last_feed_date_and_count(chat_id, user_id, ts=None, count=0):
     ts = ts or now_utc().date()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET last_feed_utc=%s, daily_feeds_count=%s WHERE chat_id=%s AND user_id=%s", (ts, count, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_feed_date_and_count(chat_id, user_id, ts, count)
 
 def increment_feed_count(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET daily_feeds_count = daily_feeds_count + 1 WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.increment_feed_count(chat_id, user_id)
 
 def set_last_zonewalk_date_and_count(chat_id, user_id, ts=None, count=0):
     ts = ts or now_utc().date()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET last_zonewalk_utc=%s, daily_zonewalks_count=%s WHERE chat_id=%s AND user_id=%s", (ts, count, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_zonewalk_date_and_count(chat_id, user_id, ts, count)
+    if count >= GAME.daily_zonewalks_limit:
+        schedule_reminder(chat_id, user_id, 'zonewalk', next_utc_day())
 
 def increment_zonewalk_count(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET daily_zonewalks_count = daily_zonewalks_count + 1 WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.increment_zonewalk_count(chat_id, user_id)
 
 # === NEW FEATURE: Колесо Фортуни (DB Helpers) ===
 def set_last_wheel_date_and_count(chat_id, user_id, ts=None, count=0):
     ts = ts or now_utc().date()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET last_wheel_utc=%s, daily_wheel_count=%s WHERE chat_id=%s AND user_id=%s", (ts, count, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_wheel_date_and_count(chat_id, user_id, ts, count)
 
 def increment_wheel_count(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET daily_wheel_count = daily_wheel_count + 1 WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.increment_wheel_count(chat_id, user_id)
 # =================================================
 
 # === NEW FEATURE: Pet Cooldown (DB Helper) ===
 def update_last_pet_time(chat_id, user_id, ts=None):
     ts = ts or now_utc()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET last_pet_utc=%s WHERE chat_id=%s AND user_id=%s", (ts, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_last_pet_time(chat_id, user_id, ts)
+    shield.block(chat_id, user_id, 'pet', ts + timedelta(hours=GAME.pet_cooldown_hours))
+    schedule_reminder(chat_id, user_id, 'pet', ts + timedelta(hours=GAME.pet_cooldown_hours))
 # ===============================================
 
 # === NEW FEATURE: Message cleanup (DB Helper) ===
 def update_last_message_id(chat_id, user_id, message_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET last_message_id=%s WHERE chat_id=%s AND user_id=%s", (message_id, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_last_message_id(chat_id, user_id, message_id)
 
 def get_chat_cleanup_status(chat_id):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT cleanup_enabled FROM players WHERE chat_id=%s LIMIT 1", (chat_id,))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row['cleanup_enabled'] if row else True
+    return storage.get_cleanup_status(chat_id)
 
 def set_chat_cleanup_status(chat_id, status):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET cleanup_enabled=%s WHERE chat_id=%s", (status, chat_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_cleanup_status(chat_id, status)
 # ===============================================
 
 # === NEW FEATURE: Смерть і вербування (DB helpers) ===
 def update_recruits_count(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT recruited_pets_count, last_recruitment_utc FROM players WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    row = cur.fetchone()
-    if not row:
-        cur.close()
-        conn.close()
-        return
+    storage.top_up_recruits(chat_id, user_id, GAME.daily_recruits_limit, GAME.max_recruited_pets, now_utc().date())
 
-    recruits, last_date = row
-    current_date = now_utc().date()
+@contextmanager
+def player_lock(chat_id, *user_ids):
+    """Read-modify-write над гравцями однією транзакцією під їхніми блокуваннями.
 
-    if last_date is None or last_date < current_date:
-        new_recruits = min(recruits + DAILY_RECRUITS_LIMIT, MAX_RECRUITED_PETS)
-        cur.execute("UPDATE players SET recruited_pets_count=%s, last_recruitment_utc=%s WHERE chat_id=%s AND user_id=%s",
-                    (new_recruits, current_date, chat_id, user_id))
-        conn.commit()
-        
-    cur.close()
-    conn.close()
+    Паралельні апдейти (кілька воркерів gunicorn) тих самих гравців виконуються
+    по черзі, тож безкоштовні спроби і предмети не можна витратити двічі.
+    """
+    buffer = getattr(_outbox_local, 'buffer', None)
+    mark = len(buffer) if buffer is not None else 0
+    # У пачці poll.py транзакція спільна: помилка хендлера (її ловить process_update)
+    # має відкотити лише цей блок, як окрема транзакція під вебхуком
+    nested = storage.in_transaction()
+    try:
+        with storage.transaction(), storage.savepoint() if nested else nullcontext():
+            storage.lock_players(chat_id, user_ids)
+            yield
+            flush_messages()  # відповіді комітяться разом зі зміною стану
+    except Exception:
+        if buffer is not None:
+            del buffer[mark:]  # стан відкотився — відповіді про нього теж не надсилаємо
+        raise
 
 def get_player_data(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM players WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
+    row = storage.get_player(chat_id, user_id)
+    if row:
+        shield.observe(row)
     return row
 
-def kill_pet(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET weight=%s, pet_name=%s, last_feed_utc=NULL, daily_feeds_count=0, last_zonewalk_utc=NULL, daily_zonewalks_count=0, last_wheel_utc=NULL, daily_wheel_count=0, last_pet_utc=NULL WHERE chat_id=%s AND user_id=%s",
-                (0, None, chat_id, user_id))
-    cur.execute("DELETE FROM inventory WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+def kill_pet(chat_id, user_id, cause=None):
+    with storage.transaction():
+        player = storage.get_player(chat_id, user_id)
+        if player:
+            storage.bump_record(chat_id, user_id, 'longest_lived', get_days_alive(player['born_utc']), now_utc())
+        storage.kill_pet(chat_id, user_id)
+        storage.cancel_reminders(chat_id, user_id)
+    leaderboard.observe(chat_id, user_id, 0)
+    shield.mark_dead(chat_id, user_id)
+    emit_event('death', chat_id, user_id, cause=cause, pet_name=player and player.get('pet_name'))
 
 def spawn_pet(chat_id, user_id, username):
-    conn = get_conn()
-    cur = conn.cursor()
     pet_name = f"Пацєтко_{user_id%1000}"
-    cur.execute("UPDATE players SET weight=%s, pet_name=%s, recruited_pets_count=recruited_pets_count-1, last_feed_utc=NULL, daily_feeds_count=0, last_zonewalk_utc=NULL, daily_zonewalks_count=0, last_wheel_utc=NULL, daily_wheel_count=0, last_pet_utc=NULL WHERE chat_id=%s AND user_id=%s",
-                (STARTING_WEIGHT, pet_name, chat_id, user_id))
     # --- Відродження після смерті ---
-    cur.execute(
-        "UPDATE players SET born_utc = %s WHERE chat_id=%s AND user_id=%s",
-        (now_utc(), chat_id, user_id)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.spawn_pet(chat_id, user_id, pet_name, GAME.starting_weight, now_utc())
+    leaderboard.observe(chat_id, user_id, GAME.starting_weight, pet_name)
+    shield.forget(chat_id, user_id)
+    emit_event('spawn', chat_id, user_id, weight=GAME.starting_weight)
 # =======================================================
 
 def get_inventory(chat_id, user_id):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT item, quantity FROM inventory WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return {r['item']: r['quantity'] for r in rows}
+    return storage.get_inventory(chat_id, user_id)
+
+def get_player_inventory(player):
+    return storage.inventory_from_row(player)
 
 def add_item(chat_id, user_id, item, qty=1):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT quantity FROM inventory WHERE chat_id=%s AND user_id=%s AND item=%s", (chat_id, user_id, item))
-    r = cur.fetchone()
-    if r:
-        cur.execute("UPDATE inventory SET quantity=quantity+%s WHERE chat_id=%s AND user_id=%s AND item=%s", (qty, chat_id, user_id, item))
-    else:
-        cur.execute("INSERT INTO inventory (chat_id, user_id, item, quantity) VALUES (%s,%s,%s,%s)", (chat_id, user_id, item, qty))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.add_item(chat_id, user_id, item, qty)
+    shield.forget(chat_id, user_id, 'feed', 'zonewalk')
 
 def remove_item(chat_id, user_id, item, qty=1):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT quantity FROM inventory WHERE chat_id=%s AND user_id=%s AND item=%s", (chat_id, user_id, item))
-    r = cur.fetchone()
-    if not r or r[0] < qty:
-        cur.close()
-        conn.close()
-        return False
-    newq = r[0] - qty
-    if newq > 0:
-        cur.execute("UPDATE inventory SET quantity=%s WHERE chat_id=%s AND user_id=%s AND item=%s", (newq, chat_id, user_id, item))
-    else:
-        cur.execute("DELETE FROM inventory WHERE chat_id=%s AND user_id=%s AND item=%s", (chat_id, user_id, item))
-    conn.commit()
-    cur.close()
-    conn.close()
-    return True
+    return storage.remove_item(chat_id, user_id, item, qty)
 
 def top_players(chat_id, limit=10):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT user_id, username, pet_name, weight, born_utc FROM players WHERE chat_id=%s ORDER BY weight DESC LIMIT %s", (chat_id, limit))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
-
+    return storage.top_players(chat_id, limit)
 # === Game mechanics ===
-DAILY_FEEDS_LIMIT = 1
-DAILY_ZONEWALKS_LIMIT = 2
-DAILY_WHEEL_LIMIT = 3
-PET_COOLDOWN_HOURS = 2
-FIGHT_COOLDOWN_HOURS = 2
-# =========================================================
 
 # === NEW FEATURE: Смерть і вербування (Updated bounded_weight) ===
 def bounded_weight(old, delta):
@@ -455,7 +2547,7 @@ def bounded_weight(old, delta):
 # ====================================================================
 
 def pick_item_count():
-    r = random.random()
+    r = rng.random()
     if r < 0.50:
         return 0
     if r < 0.80:
@@ -465,23 +2557,85 @@ def pick_item_count():
     return 3
 
 def pick_loot(n):
-    return random.choices(LOOT_POOL, weights=LOOT_WEIGHTS, k=n)
+    return rng.choices(GAME.loot_keys, cum_weights=GAME.loot_cum_weights, k=n)
 
 def zonewalk_weight_delta():
-    r = random.random()
+    r = rng.random()
     if r < 0.50:
         return 0
     elif r < 0.75:
-        return -random.randint(1,5)
+        return -rng.randint(1,5)
+    else:
+        return rng.randint(1,5)
+
+def free_feed_delta():
+    r = rng.random()
+    if r < 0.35:
+        # 35% шанс втрати ваги (від -40 до -1)
+        delta = rng.randint(1, 20)
+    elif r < 0.50:
+        # 15% шанс, що вага не зміниться (з 40% по 45%)
+        delta = rng.randint(21, 30)
+    elif r < 0.55:
+        # 5% шанс, що вага не зміниться (з 40% по 45%)
+        delta = rng.randint(31, 40)
+    elif r < 0.60:
+        # 5% шанс, що вага не зміниться (з 40% по 45%)
+        delta = 0
+    elif r < 0.85:
+        # 25% шанс, що вага не зміниться (з 40% по 45%)
+        delta = rng.randint(-20, -1)
+    elif r < 0.95:
+        # 10% шанс, що вага не зміниться (з 40% по 45%)
+        delta = rng.randint(-30, -21)
     else:
-        return random.randint(1,5)
+        # 55% шанс набрати вагу (від 1 до 40)
+        delta = rng.randint(-40, -31)
+    return delta
+
+def auto_feed_delta(item_key):
+    # Автоматична годівля з інвентаря: 40% шанс, що предмет зайде в мінус
+    a, b = GAME.items[item_key]['feed_delta']
+    if rng.random() < 0.40:
+        return rng.randint(a, 0)
+    return rng.randint(0, b)
+
+def roll_zonewalk(pet_name, weight):
+    """Одна ходка в Зону без запису в БД. Повертає (статус, текст, хабар, нова вага)."""
+    death_messages = [
+        f"Під час ходки, {pet_name} загризли собаки.",
+        f"{pet_name} вирішив дослідити закинуте село, і жахливий салосіся висмоктав все сальце у {pet_name}.",
+        f"{pet_name} вирішив повеселитися і заліз в Карусель.",
+        f"{pet_name} був поранений і просив допомоги, але інше пацєтко йомо лише сказало 'До зустрічі!'.",
+        f"{pet_name} потрапив під Викид і розплавилося на шкварочки.",
+        f"{pet_name} поліз з цікавості куди не треба і потрапив під вплив іншого Моноліту."
+    ]
+
+    # === Моментальна смерть (5% шанс) ===
+    if rng.random() < 0.05:
+        death_title = "☠️Ще одне пацєтко поглинула Зона...☠️"
+        death_text = rng.choice(death_messages)
+        return "Смерть", f"\n{death_title}\n{death_text}", [], 0
+    # =====================================
+
+    cnt = pick_item_count()
+    loot = pick_loot(cnt) if cnt > 0 else []
+    delta = zonewalk_weight_delta()
+    neww = bounded_weight(weight, delta)
+
+    if neww <= 0:
+        return "Смерть", f"Під час ходки, {pet_name} наступив на аномалію, і помер. Смерть в зоні – звичне діло. Царство йому небесне.", loot, neww
+
+    s = f"\nВ процесі ходки {pet_name} набрав {delta:+d} кг сальця, і тепер важить {neww} кг."
+    if cnt == 0:
+        s += "\nЦей раз без хабаря."
+    else:
+        s += f"\nЄ хабар! {pet_name} приніс: " + ", ".join(f"{GAME.items[it]['u_name']}" for it in loot)
+    return "Продовження", s, loot, neww
 
 # === NEW FEATURE: Колесо Фортуни (Main Logic) ===
 def spin_wheel():
-    items = list(WHEEL_REWARDS.keys())
-    weights = [WHEEL_REWARDS[item]['weight'] for item in items]
-    reward = random.choices(items, weights=weights, k=1)[0]
-    return reward
+    return rng.choices(GAME.wheel_keys, cum_weights=GAME.wheel_cum_weights, k=1)[0]
 # ===============================================
         
 # === Time formatting helper ===
@@ -512,25 +2666,12 @@ def format_timedelta_to_next_day():
 # --- Нові хелпери ---
 def update_last_fight_time(chat_id, user_id, ts=None):
     ts = ts or now_utc()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET last_fight_utc=%s WHERE chat_id=%s AND user_id=%s", (ts, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_last_fight_time(chat_id, user_id, ts)
+    shield.block(chat_id, user_id, 'fight', ts + timedelta(hours=GAME.fight_cooldown_hours))
+    schedule_reminder(chat_id, user_id, 'fight', ts + timedelta(hours=GAME.fight_cooldown_hours))
 
 def get_alive_opponents(chat_id, exclude_user_id):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("""
-        SELECT user_id, pet_name, weight FROM players
-        WHERE chat_id=%s AND user_id != %s AND weight > 0
-        ORDER BY weight DESC
-    """, (chat_id, exclude_user_id))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+    return storage.alive_opponents(chat_id, exclude_user_id)
 
 # --- Хелпер --- 
 def get_days_alive(born_utc):
@@ -539,9 +2680,213 @@ def get_days_alive(born_utc):
     return (now_utc().date() - born_utc.date()).days
 # =========================================================
 
+# === NEW FEATURE: Cooldown shield ===
+# Індекс "коли дію знову можна виконати" для (chat_id, user_id, action), який
+# заповнюється з кожного прочитаного рядка players і з записів кулдаунів. Очевидні
+# повтори відповідаються без ensure_player/транзакції, а після SHIELD_REPLY_REPEATS
+# відповідей — ігноруються. Кулдауни й денні ліміти лише зростають, тож їм можна
+# вірити до кінця; смерть і порожній інвентар може змінити інший воркер, тому ці
+# блокування живуть не довше SHIELD_STATE_TTL_SECONDS.
+SHIELDED_COMMANDS = {'/pet': 'pet', '/fight': 'fight', '/wheel': 'wheel', '/feed': 'feed', '/zonewalk': 'zonewalk'}
+
+class CooldownShield:
+    PRUNE_EVERY = 1000
+
+    def __init__(self, reply_repeats=SHIELD_REPLY_REPEATS, state_ttl=SHIELD_STATE_TTL_SECONDS):
+        self.reply_repeats = reply_repeats
+        self.state_ttl = timedelta(seconds=state_ttl)
+        self._entries = {}  # (chat_id, user_id) -> {'pet_name': ..., action: [valid_until, ready_at, hits]}
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def observe(self, row):
+        now = now_utc()
+        today = now.date()
+        midnight = datetime.combine(today + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+        blocks = {}
+        if row['weight'] <= 0:
+            blocks['dead'] = (now + self.state_ttl, None)
+        else:
+            for action, column, hours in (('pet', 'last_pet_utc', GAME.pet_cooldown_hours),
+                                          ('fight', 'last_fight_utc', GAME.fight_cooldown_hours)):
+                if row.get(column) and row[column] + timedelta(hours=hours) > now:
+                    ready = row[column] + timedelta(hours=hours)
+                    blocks[action] = (ready, ready)
+            if row.get('last_wheel_utc') == today and row['daily_wheel_count'] >= GAME.daily_wheel_limit:
+                blocks['wheel'] = (midnight, midnight)
+            # Інвентар відомий без запиту лише в компактному layout
+            inv = storage.decode_inventory(row['inv']) if storage.compact_inventory and 'inv' in row else None
+            for action, limit in (('feed', GAME.daily_feeds_limit), ('zonewalk', GAME.daily_zonewalks_limit)):
+                exhausted = row.get(f'last_{action}_utc') == today and row[f'daily_{action}s_count'] >= limit
+                if exhausted and inv is not None and not any(q > 0 and k in GAME.usable[action] for k, q in inv.items()):
+                    blocks[action] = (min(midnight, now + self.state_ttl), midnight)
+        storage.after_commit(self._store, (row['chat_id'], row['user_id']), row.get('pet_name') or 'Пацєтко', blocks)
+
+    # Зміни індексу застосовуються після коміту транзакції, в якій їх зроблено (і в тому ж
+    # порядку): відкочена дія не має лишати "кулдаун" для того, чого не сталося.
+    def block(self, chat_id, user_id, action, until):
+        storage.after_commit(self._block, chat_id, user_id, action, until, until)
+
+    def mark_dead(self, chat_id, user_id):
+        storage.after_commit(self._block, chat_id, user_id, 'dead', now_utc() + self.state_ttl, None)
+
+    def forget(self, chat_id, user_id, *actions):
+        storage.after_commit(self._forget, chat_id, user_id, actions)
+
+    def _store(self, key, pet_name, blocks):
+        with self._lock:
+            old = self._entries.get(key, {})
+            entry = {'pet_name': pet_name}
+            for action, (valid_until, ready_at) in blocks.items():
+                hits = old[action][2] if action in old and old[action][1] == ready_at else 0
+                entry[action] = [valid_until, ready_at, hits]
+            self._entries[key] = entry
+
+    def _block(self, chat_id, user_id, action, until, ready_at):
+        with self._lock:
+            entry = self._entries.setdefault((chat_id, user_id), {'pet_name': 'Пацєтко'})
+            entry[action] = [until, ready_at, 0]
+
+    def _forget(self, chat_id, user_id, actions):
+        with self._lock:
+            if not actions:
+                self._entries.pop((chat_id, user_id), None)
+                return
+            entry = self._entries.get((chat_id, user_id))
+            for action in actions:
+                if entry:
+                    entry.pop(action, None)
+
+    def intercept(self, chat_id, user_id, action):
+        """True, якщо команду відбито (з відповіддю або мовчки) без звернення до гри."""
+        now = now_utc()
+        with self._lock:
+            self._checks += 1
+            if self._checks % self.PRUNE_EVERY == 0:
+                self._prune(now)
+            entry = self._entries.get((chat_id, user_id))
+            if not entry:
+                return False
+            kind = 'dead' if 'dead' in entry and entry['dead'][0] > now else action
+            block = entry.get(kind)
+            if not block or block[0] <= now:
+                return False
+            block[2] += 1
+            hits, ready_at, pet_name = block[2], block[1], entry['pet_name']
+        incr("shield.hit")
+        if hits > self.reply_repeats:
+            incr("shield.dropped")
+            return True
+        incr("shield.replied")
+        send_message(chat_id, user_id, self.reply(kind, pet_name, ready_at - now if ready_at else None))
+        return True
+
+    def _prune(self, now):
+        for key in [k for k, e in self._entries.items()
+                    if all(v[0] <= now for a, v in e.items() if a != 'pet_name')]:
+            del self._entries[key]
+
+    @staticmethod
+    def reply(kind, pet_name, left):
+        left = format_timedelta(left) if left else None
+        if kind == 'dead':
+            return "На жаль, ваше пацєтко померло. Щоб продовжити грати, завербуйте нове командою /recruit (скільки доступно — /check_recruits)."
+        if kind == 'pet':
+            return f"*звук цвіркунів* {pet_name} ніяк не реагує на чух. Наступний чух через {left}."
+        if kind == 'fight':
+            return f"{pet_name} ще облизує подряпини після попередньої бійки. Знову гатитися зможе через {left}."
+        if kind == 'wheel':
+            return f"Казино Золотий Хряцик для {pet_name} на сьогодні закрите. Наступний деп через {left}."
+        if kind == 'feed':
+            return f"Безкоштовні харчі вже з'їдені, а предметів для годівлі немає. Наступна поставка від Бармена через {left}."
+        return f"Паця вже виходило всі ходки, а енергетика чи горілки немає. Сили на наступні будуть через {left}."
+
+shield = CooldownShield()
+# ====================================
+
+# === NEW FEATURE: Backpressure ===
+# Навантаження — найгірше з трьох відношень: апдейти в обробці / PRESSURE_MAX_INFLIGHT,
+# згладжене очікування пулу / PRESSURE_POOL_WAIT_MS, черга outbox / PRESSURE_QUEUE_DEPTH.
+# Що вище навантаження, то більше кроків деградації вмикається; кожен крок — лічильник pressure.*.
+class BackpressureController:
+    SKIP_CLEANUP, SKIP_FOOTER, STALE_TOP, BUSY = 1, 2, 3, 4
+    THRESHOLDS = (0.5, 0.75, 1.0, 1.5)  # навантаження, з якого вмикається крок 1..4
+    POOL_WAIT_HALF_LIFE = 2.0  # с; без нових очікувань оцінка згасає
+
+    def __init__(self, enabled=PRESSURE_ENABLED, max_inflight=PRESSURE_MAX_INFLIGHT,
+                 pool_wait_ms=PRESSURE_POOL_WAIT_MS, queue_depth=PRESSURE_QUEUE_DEPTH):
+        self.enabled = enabled
+        self.max_inflight = max_inflight
+        self.pool_wait_limit = pool_wait_ms / 1000
+        self.queue_limit = queue_depth
+        self.inflight = 0
+        self.queue_depth = 0
+        self._pool_wait = 0.0
+        self._pool_wait_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    def _decayed_pool_wait(self, now):
+        return self._pool_wait * 0.5 ** ((now - self._pool_wait_at) / self.POOL_WAIT_HALF_LIFE)
+
+    def observe_pool_wait(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._pool_wait = max(seconds, 0.8 * self._decayed_pool_wait(now) + 0.2 * seconds)
+            self._pool_wait_at = now
+
+    def load(self):
+        return max(self.inflight / self.max_inflight,
+                   self._decayed_pool_wait(time.monotonic()) / self.pool_wait_limit,
+                   self.queue_depth / self.queue_limit)
+
+    def level(self):
+        if not self.enabled:
+            return 0
+        load = self.load()
+        return sum(1 for t in self.THRESHOLDS if load >= t)
+
+    def degrade(self, step, counter):
+        """True, якщо крок деградації `step` зараз увімкнений (і рахує це в метриках)."""
+        if self.level() < step:
+            return False
+        incr(counter)
+        return True
+
+    def snapshot(self):
+        return {"level": self.level(), "load": round(self.load(), 3), "inflight": self.inflight,
+                "pool_wait_ms": round(self._decayed_pool_wait(time.monotonic()) * 1000, 3), "queue_depth": self.queue_depth}
+
+pressure = BackpressureController()
+
+def busy_reply(update):
+    """Відповідь методом Bot API в тілі вебхука, коли обробляти апдейт немає сил."""
+    text = "Бот зараз перевантажений, пацєтки стоять у черзі. Спробуй за хвилинку."
+    callback = update.get('callback_query')
+    if callback:
+        return {'method': 'answerCallbackQuery', 'callback_query_id': callback['id'], 'text': text}
+    msg = update.get('message') or update.get('edited_message') or {}
+    chat_id = (msg.get('chat') or {}).get('id')
+    if chat_id is None:
+        return {'ok': True}
+    return {'method': 'sendMessage', 'chat_id': chat_id, 'text': text}
+# ====================================
+
 # === Telegram helpers ===
 def is_admin(chat_id, user_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getChatMember"
+    """Єдиний виклик Telegram, на який чекає обробка апдейта: від відповіді залежить, чи
+    виконувати адмінську команду (/royale, /toggle_cleanup, /clear_chat), тож у outbox
+    його не відкласти. Інші команди його не роблять."""
+    url = telegram_url('getChatMember')
     payload = {"chat_id": chat_id, "user_id": user_id}
     try:
         r = requests.post(url, json=payload, timeout=5)
@@ -554,50 +2899,407 @@ def is_admin(chat_id, user_id):
     return False
 
 def delete_message(chat_id, message_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/deleteMessage"
-    payload = {"chat_id": chat_id, "message_id": message_id}
+    """Видалення йде тією ж дорогою, що й відповіді: буфер апдейта -> outbox."""
+    deletes = getattr(_outbox_local, 'deletes', None)
+    if deletes is not None:
+        deletes.append((chat_id, message_id))
+    elif OUTBOX_ENABLED:
+        outbox.enqueue_deletes([(chat_id, message_id)])
+    else:
+        try:
+            deliver_delete(chat_id, message_id)
+        except Exception as e:
+            print('delete_message error', e)
+
+def deliver_delete(chat_id, message_id):
+    """Одне deleteMessage; повертає відповідь Telegram, мережеві помилки піднімає далі."""
+    r = requests.post(telegram_url('deleteMessage'), json={"chat_id": chat_id, "message_id": message_id}, timeout=5)
+    return r.json()
+
+def answer_callback(callback_id, text=None):
+    """Прибирає спінер на кнопці; text — коротке спливаюче повідомлення. Під вебхуком
+    відповідь іде в тілі відповіді на нього, без окремого запиту до Telegram."""
+    payload = {"callback_query_id": callback_id}
+    if text:
+        payload["text"] = text
+    replies = getattr(_webhook_local, 'replies', None)
+    if replies is not None:
+        replies.append(dict(payload, method='answerCallbackQuery'))
+        return
     try:
-        requests.post(url, json=payload, timeout=5)
+        requests.post(telegram_url('answerCallbackQuery'), json=payload, timeout=5)
     except Exception as e:
-        print('delete_message error', e)
+        print('answer_callback error', e)
 
 def send_message(chat_id, user_id, text, reply_markup=None):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+    buffer = getattr(_outbox_local, 'buffer', None)
+    if buffer is not None:
+        buffer.append((chat_id, user_id, text, reply_markup))
+    elif OUTBOX_ENABLED:
+        outbox.enqueue([(chat_id, [user_id], text, reply_markup)])
+    else:
+        try:
+            deliver_message(chat_id, [user_id], text, reply_markup)
+        except Exception as e:
+            print('send_message error', e)
+
+def deliver_message(chat_id, user_ids, text, reply_markup=None):
+    """Одне sendMessage; повертає відповідь Telegram, мережеві помилки піднімає далі."""
+    for message_id in cleanup_targets(chat_id, user_ids):
+        try:
+            deliver_delete(chat_id, message_id)
+        except Exception as e:
+            print('delete_message error', e)
+    r = requests.post(telegram_url('sendMessage'), json=message_payload(chat_id, text, reply_markup), timeout=10)
+    data = r.json()
+    record_delivery(chat_id, user_ids, data)
+    return data
+
+def message_payload(chat_id, text, reply_markup=None):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup:
         payload['reply_markup'] = reply_markup
-    
-    # === NEW FEATURE: Message cleanup ===
-    if chat_id < 0 and get_chat_cleanup_status(chat_id): # Only for group chats with cleanup enabled
+    return payload
+
+# === NEW FEATURE: Message cleanup ===
+def cleanup_targets(chat_id, user_ids):
+    """Попередні відповіді бота цим гравцям, які треба видалити перед новою."""
+    if chat_id >= 0 or pressure.degrade(pressure.SKIP_CLEANUP, "pressure.skip_cleanup"):
+        return []
+    if not get_chat_cleanup_status(chat_id): # Only for group chats with cleanup enabled
+        return []
+    targets = []
+    for user_id in user_ids:
         player = get_player_data(chat_id, user_id)
         if player:
             last_message_id = player.get('last_message_id')
-            if last_message_id:
-                delete_message(chat_id, last_message_id)
-    # ====================================
-    
-    try:
-        r = requests.post(url, json=payload, timeout=10)
-        data = r.json()
-        if data.get('ok'):
-            message_id = data['result']['message_id']
+            if last_message_id and last_message_id not in targets:
+                targets.append(last_message_id)
+    return targets
+# ====================================
+
+def record_delivery(chat_id, user_ids, data):
+    if data.get('ok'):
+        message_id = data['result']['message_id']
+        for user_id in user_ids:
             update_last_message_id(chat_id, user_id, message_id)
-        return r
-    except Exception as e:
-        print('send_message error', e)
+
+# === NEW FEATURE: Callback tokens ===
+# callback_data — компактний підписаний токен "код:термін:аргументи:підпис" (до 64 байт).
+# Підпис (HMAC, 8 байт) покриває й chat_id, тож токен не переноситься в інший чат, а
+# підробка, прострочена чи повторна кнопка відсіюються без жодного запиту до БД.
+CALLBACK_ACTIONS = {
+    # дія: (код, типи аргументів); перший аргумент — власник кнопки
+    'fight': ('f', (int, int)),
+    'use_item': ('i', (int, str)),
+    'use_target': ('t', (int, str, int)),
+}
+_CALLBACK_CODES = {code: (action, types) for action, (code, types) in CALLBACK_ACTIONS.items()}
+
+def _b36(n):
+    digits = ''
+    while True:
+        n, r = divmod(n, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[r] + digits
+        if not n:
+            return digits
+
+def _callback_signature(chat_id, body):
+    digest = hmac.new(CALLBACK_SECRET.encode(), f"{chat_id}:{body}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:8]).decode().rstrip('=')
+
+def make_callback(chat_id, action, *args):
+    code, types = CALLBACK_ACTIONS[action]
+    fields = [code, _b36(int(time.time()) + CALLBACK_TTL_SECONDS)]
+    fields += [_b36(a) if t is int else a for t, a in zip(types, args)]
+    body = ':'.join(fields)
+    data = f"{body}:{_callback_signature(chat_id, body)}"
+    if len(data.encode()) > 64:
+        raise ValueError(f"callback_data too long: {data}")
+    return data
+
+def read_callback(chat_id, data):
+    """(дія, аргументи, термін дії) з токена; None — чужий підпис або старий формат кнопки."""
+    body, _, signature = data.rpartition(':')
+    if not body or not hmac.compare_digest(signature, _callback_signature(chat_id, body)):
+        return None
+    code, expires, *fields = body.split(':')
+    if code not in _CALLBACK_CODES:
+        return None
+    action, types = _CALLBACK_CODES[code]
+    if len(fields) != len(types):
+        return None
+    return action, [int(f, 36) if t is int else f for t, f in zip(types, fields)], int(expires, 36)
+
+class CallbackPresses:
+    """Клавіатура (повідомлення) спрацьовує один раз: інші натискання на неї до кінця
+    терміну дії токена відкидаються. Повтор того самого апдейта (той самий
+    callback_query id) відкидається теж, поки натискання обробляється чи вже оброблене;
+    повторити можна лише натискання, обробка якого впала чи відкотилася (finish(..., False))."""
+
+    RUNNING, DONE, FAILED = 'running', 'done', 'failed'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pressed = {}  # (chat_id, message_id) -> [callback_id, expires, стан]
+
+    def first(self, chat_id, message_id, callback_id, expires):
+        now = time.time()
+        with self._lock:
+            if len(self._pressed) > 10000:
+                self._pressed = {k: v for k, v in self._pressed.items() if v[1] > now}
+            seen = self._pressed.get((chat_id, message_id))
+            if seen and seen[1] > now and seen[2] != self.FAILED:
+                return False
+            self._pressed[(chat_id, message_id)] = [callback_id, expires, self.RUNNING]
+            return True
+
+    def finish(self, chat_id, message_id, callback_id, ok):
+        with self._lock:
+            seen = self._pressed.get((chat_id, message_id))
+            if seen and seen[0] == callback_id:
+                seen[2] = self.DONE if ok else self.FAILED
+
+callback_presses = CallbackPresses()
+# ====================================
+
+# === NEW FEATURE: Per-chat message coalescing ===
+# Усе, що хендлери надсилають під час обробки одного апдейта, склеюється по чатах
+# в одне sendMessage (до ліміту Telegram), щоб не впиратися в ~20 повідомлень/хв у групах.
+# Клавіатура прикріплюється до склеєного повідомлення і закриває його.
+TELEGRAM_MESSAGE_LIMIT = 4096
+_outbox_local = threading.local()
+
+@contextmanager
+def coalesce_messages(update_id=None):
+    """update_id (якщо відомий) дає повідомленням outbox ключі дедуплікації на випадок повтору апдейта."""
+    if getattr(_outbox_local, 'buffer', None) is not None:
+        yield
+        return
+    _outbox_local.buffer = []
+    _outbox_local.deletes = []
+    _outbox_local.update_id = update_id
+    _outbox_local.seq = 0
+    try:
+        yield
+    finally:
+        flush_messages(final=True)
+
+def flush_messages(final=False):
+    """Склеює накопичене і ставить в outbox (або надсилає одразу, якщо outbox вимкнено)."""
+    buffer = getattr(_outbox_local, 'buffer', None)
+    deletes = getattr(_outbox_local, 'deletes', None) or []
+    if buffer is None or (not buffer and not deletes and not final):
+        return
+    _outbox_local.buffer = None if final else []
+    _outbox_local.deletes = None if final else []
+    merged = merge_messages(buffer)
+    incr("telegram.messages_coalesced", len(buffer) - len(merged))
+    if OUTBOX_ENABLED:
+        if deletes:
+            outbox.enqueue_deletes(deletes, update_id=_outbox_local.update_id)
+        if merged:
+            outbox.enqueue(merged, update_id=_outbox_local.update_id, seq=_outbox_local.seq)
+            _outbox_local.seq += len(merged)
+        return
+    if not final:
+        _outbox_local.buffer = buffer  # без outbox надсилаємо лише після коміту
+        _outbox_local.deletes = deletes
+        return
+    for chat_id, message_id in deletes:
+        try:
+            deliver_delete(chat_id, message_id)
+        except Exception as e:
+            print('delete_message error', e)
+    for chat_id, user_ids, text, reply_markup in merged:
+        try:
+            deliver_message(chat_id, user_ids, text, reply_markup)
+        except Exception as e:
+            print('send_message error', e)
+
+def merge_messages(buffer):
+    """[(chat_id, user_id, text, markup)] -> [(chat_id, [user_ids], text, markup)] зі збереженням порядку."""
+    chunks, open_chunks = [], {}
+    for chat_id, user_id, text, reply_markup in buffer:
+        chunk = open_chunks.get(chat_id)
+        if chunk and len(chunk[2]) + 2 + len(text) <= TELEGRAM_MESSAGE_LIMIT:
+            chunk[2] += "\n\n" + text
+            if user_id not in chunk[1]:
+                chunk[1].append(user_id)
+        else:
+            chunk = [chat_id, [user_id], text, None]
+            chunks.append(chunk)
+        if reply_markup:
+            chunk[3] = reply_markup
+            open_chunks.pop(chat_id, None)
+        else:
+            open_chunks[chat_id] = chunk
+    return [tuple(c) for c in chunks]
+# ================================================
+
+# === NEW FEATURE: Transactional outbox ===
+# Відповіді лежать у таблиці outbox, доки фоновий відправник не отримає від Telegram ok.
+# Оренда (next_attempt_at у майбутньому) не дає двом воркерам узяти одне повідомлення;
+# помилки повторюються з експоненційною паузою, 400/403 (чат недоступний) — одразу failed.
+# Доставка at-least-once: падіння між sendMessage і позначкою sent дасть повтор.
+class OutboxSender:
+    LEASE_SECONDS = 30
+    PURGE_EVERY_SECONDS = 600
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, poll_seconds=OUTBOX_POLL_SECONDS, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 background=True):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.background = background
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._purged_at = 0.0
+
+    def enqueue(self, messages, update_id=None, seq=0):
+        """messages: [(chat_id, user_ids, text, reply_markup)]."""
+        rows = [(f"{update_id}:{seq + i}" if update_id is not None else None, chat_id, user_ids, text, markup)
+                for i, (chat_id, user_ids, text, markup) in enumerate(messages)]
+        storage.enqueue_messages(rows, now_utc())
+        incr("outbox.enqueued", len(rows))
+        self.wake()
+
+    def enqueue_deletes(self, deletes, update_id=None):
+        """deletes: [(chat_id, message_id)]; повтор апдейта не ставить їх удруге."""
+        rows = [(f"{update_id}:del:{message_id}" if update_id is not None else None, chat_id, message_id)
+                for chat_id, message_id in deletes]
+        storage.enqueue_deletes(rows, now_utc())
+        incr("outbox.enqueued_deletes", len(rows))
+        self.wake()
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        if not self.background or self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='outbox-sender', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+            try:
+                self.drain()
+                pressure.queue_depth = storage.outbox_backlog(now_utc())
+            except Exception as e:
+                print('outbox sender error:', e)
+
+    def drain(self):
+        """Надсилає все, що готове до відправки; повертає кількість надісланих."""
+        sent = 0
+        while True:
+            now = now_utc()
+            batch = storage.claim_outbox(self.batch_size, now, now + timedelta(seconds=self.LEASE_SECONDS))
+            if not batch:
+                break
+            postponed = {}  # chat_id -> коли повторити; наступні повідомлення чату чекають, щоб не змішати порядок
+            for msg in sorted(batch, key=lambda m: m['id']):
+                if msg['chat_id'] in postponed:
+                    storage.mark_outbox_retry(msg['id'], msg['attempts'], postponed[msg['chat_id']], 'waiting for earlier message')
+                    continue
+                retry_at = self._send(msg)
+                if retry_at is None:
+                    sent += 1
+                else:
+                    postponed[msg['chat_id']] = retry_at
+            if len(batch) < self.batch_size:
+                break
+        if time.monotonic() - self._purged_at >= self.PURGE_EVERY_SECONDS:
+            self._purged_at = time.monotonic()
+            storage.purge_outbox(now_utc() - timedelta(hours=OUTBOX_RETENTION_HOURS))
+        return sent
+
+    def _send(self, msg):
+        try:
+            if msg['delete_message_id']:
+                data = deliver_delete(msg['chat_id'], msg['delete_message_id'])
+            else:
+                data = deliver_message(msg['chat_id'], msg['user_ids'], msg['text'], msg['reply_markup'])
+        except Exception as e:
+            return self.settle(msg, None, str(e))
+        return self.settle(msg, data)
+
+    def settle(self, msg, data, error=None):
+        """Записує результат спроби (data — відповідь Telegram або None при мережевій помилці).
+
+        None, якщо повідомлення більше не треба відправляти; інакше час наступної спроби.
+        """
+        retry_at, writes = self.outcome(msg, data, error)
+        for method, args in writes:
+            getattr(storage, method)(*args)
+        return retry_at
+
+    def outcome(self, msg, data, error=None):
+        """(час наступної спроби або None, [(метод storage, аргументи)]) — що записати після спроби.
+        Окремо від settle(), бо ASGI-режим виконує ці записи асинхронним драйвером."""
+        attempts = msg['attempts'] + 1
+        retry_after = None
+        writes = []
+        if data is not None:
+            if data.get('ok'):
+                record_timing("outbox.delivery_lag", (now_utc() - msg['created_at']).total_seconds())
+                incr("outbox.sent")
+                return None, [('mark_outbox_sent', (msg['id'], now_utc()))]
+            error = f"{data.get('error_code')}: {data.get('description')}"
+            if data.get('error_code') in (400, 403):
+                # бота вигнали з чату, повідомлення зламане або його вже не видалити — повтор не допоможе
+                attempts = self.max_attempts
+            if data.get('error_code') == 403:
+                writes.append(('mark_chat_blocked', (msg['chat_id'], error, now_utc())))
+            retry_after = (data.get('parameters') or {}).get('retry_after')
+        if attempts >= self.max_attempts:
+            print('outbox: giving up on message', msg['id'], '-', error)
+            incr("outbox.failed")
+            return None, writes + [('mark_outbox_failed', (msg['id'], attempts, error))]
+        retry_at = now_utc() + timedelta(seconds=retry_after or min(2 ** attempts, 300))
+        incr("outbox.retry")
+        return retry_at, writes + [('mark_outbox_retry', (msg['id'], attempts, retry_at, error))]
+
+outbox = OutboxSender()
+# =========================================
 
 def set_webhook():
+    global webhook_secret_required
     if not WEBHOOK_BASE_URL:
         print('WEBHOOK_BASE_URL not set; skip setWebhook')
+        if not webhook_secret_required:
+            print('WARNING: webhook secret is not enforced; set WEBHOOK_SECRET_TOKEN to reject unsigned requests')
         return
     hook = f"{WEBHOOK_BASE_URL}/{TELEGRAM_TOKEN}"
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook"
+    url = telegram_url('setWebhook')
+    payload = {
+        'url': hook,
+        'allowed_updates': WEBHOOK_ALLOWED_UPDATES,
+        'max_connections': WEBHOOK_MAX_CONNECTIONS,
+        'secret_token': WEBHOOK_SECRET_TOKEN,
+    }
     try:
-        r = requests.post(url, data={'url': hook}, timeout=10)
+        r = requests.post(url, json=payload, timeout=10)
         print('setWebhook result:', r.status_code, r.text)
+        if r.json().get('ok'):
+            webhook_secret_required = True
     except Exception as e:
         print('setWebhook failed:', e)
 
+def delete_webhook():
+    """getUpdates не працює, поки встановлено вебхук (409 Conflict)."""
+    try:
+        r = requests.post(telegram_url('deleteWebhook'), json={'drop_pending_updates': False}, timeout=10)
+        print('deleteWebhook result:', r.status_code, r.text)
+    except Exception as e:
+        print('deleteWebhook failed:', e)
+
 # === Command handlers (simple parsing) ===
 def handle_start(chat_id, user_id):
     txt = (
@@ -607,20 +3309,25 @@ def handle_start(chat_id, user_id):
         "ходити в ходки в зону за хабаром(/zonewalk). Є інвентар, де буде лежати весь хабар вашого пацєти, (/inventory), також можна дати клікуху вашому пацєтку (/name), "
         "і подивитися топ по вазі і дізнатися хто найкраще сталкерське пацєтко (/top).\n\n"
         "Формат команд:\n"
-        f"/feed [предмет] - безкоштовне харчування прямо від Бармена з Бару 100 Пятачків ({DAILY_FEEDS_LIMIT} разів на добу UTC). Додатково можна вказати предмет з інвентарю.\n"
-        f"/zonewalk [предмет] - організувати ходку в небезпечну Зону ({DAILY_ZONEWALKS_LIMIT} разів на добу UTC). Додатково можна тяпнути енергетика або горілки, щоб мати можливість і сили сходити більше разів.\n"
-        f"/wheel - крутнути умовне Колесо Фортуни, щоб виграти хабар ({DAILY_WHEEL_LIMIT} раз на добу UTC).\n"
-        f"/pet - почухати пацю за вушком (кожні {PET_COOLDOWN_HOURS} год).\n"
+        f"/feed [предмет] - безкоштовне харчування прямо від Бармена з Бару 100 Пятачків ({GAME.daily_feeds_limit} разів на добу UTC). Додатково можна вказати предмет з інвентарю.\n"
+        f"/zonewalk [предмет] - організувати ходку в небезпечну Зону ({GAME.daily_zonewalks_limit} разів на добу UTC). Додатково можна тяпнути енергетика або горілки, щоб мати можливість і сили сходити більше разів.\n"
+        "/feed all [N], /zonewalk all [N] - витратити всі безкоштовні спроби (і до N предметів з інвентаря) за один раз.\n"
+        f"/wheel - крутнути умовне Колесо Фортуни, щоб виграти хабар ({GAME.daily_wheel_limit} раз на добу UTC).\n"
+        f"/pet - почухати пацю за вушком (кожні {GAME.pet_cooldown_hours} год).\n"
         "/name Ім'я - дати ім'я пацєтці\n"
         "/top - топ-10 Сталкерів Пацєток чату за вагою\n"
+        f"/globaltop - топ-{GLOBAL_TOP_SIZE} пацєток серед усіх чатів\n"
+        f"/stats - вага пацєтка за останні {STATS_HISTORY_DAYS} дн. і рекорди чату\n"
         "/inventory - показати інвентарь\n"
         "/recruit - завербувати нове пацєтко, якщо старе померло.\n"
         "/check_recruits - перевірити кількість пацєток, доступних для вербування.\n"
-        f"/fight - викликати пацєтко на бій (кожні {FIGHT_COOLDOWN_HOURS} год).\n"
+        f"/fight - викликати пацєтко на бій (кожні {GAME.fight_cooldown_hours} год).\n"
         f"/use - використати предмет на іншому пацєтку.\n"
+        "/remind - увімкнути/вимкнути нагадування, коли пацєтко знову готове до /pet, /fight і /zonewalk.\n"
         "\nАдмін-команди:\n"
         "/toggle_cleanup - вмикає/вимикає автоочищення повідомлень бота."
         "/clear_chat - видаляє останні повідомлення бота від кожного гравця."
+        "\n/royale - королівська битва між усіма живими пацєтками чату."
     )
     send_message(chat_id, user_id, txt)
 
@@ -648,18 +3355,20 @@ def handle_name(chat_id, user_id, username, args_text):
     if not newname:
         send_message(chat_id, user_id, "Вкажи ім'я: /name Ім'я")
         return
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE players SET pet_name=%s WHERE chat_id=%s AND user_id=%s", (newname, chat_id, user_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.set_pet_name(chat_id, user_id, newname)
+    leaderboard.observe(chat_id, user_id, player['weight'], newname)
     send_message(chat_id, user_id, f"Готово — твоє пацєтко тепер звати: {newname}")
 
+_top_cache = {}  # chat_id -> останній показаний топ, для перевантаження
+
 def handle_top(chat_id, user_id):
-    ensure_player(chat_id, user_id, None)
-    update_recruits_count(chat_id, user_id)
-    rows = top_players(chat_id, limit=10)
+    if chat_id in _top_cache and pressure.degrade(pressure.STALE_TOP, "pressure.stale_top"):
+        rows = _top_cache[chat_id]
+    else:
+        ensure_player(chat_id, user_id, None)
+        update_recruits_count(chat_id, user_id)
+        rows = top_players(chat_id, limit=10)
+        _top_cache[chat_id] = rows
     if not rows:
         send_message(chat_id, user_id, "Ще немає пацєток у цьому чаті.")
         return
@@ -677,6 +3386,45 @@ def handle_top(chat_id, user_id):
     
     send_message(chat_id, user_id, "Топ пацєток:\n" + "\n".join(top_lines))
 
+# === NEW FEATURE: Weight history і /stats ===
+def handle_stats(chat_id, user_id, username):
+    player = ensure_player(chat_id, user_id, username)
+    pet_name = player.get('pet_name') or 'Пацєтко'
+    lines = []
+    if player['weight'] > 0:
+        lines.append(f"📈 {pet_name}: {player['weight']} кг, прожито {get_days_alive(player['born_utc'])} дн.")
+    else:
+        lines.append("Твоє пацєтко мертве, але пам'ять про його сальце жива.")
+
+    history = storage.weight_history(chat_id, user_id, STATS_HISTORY_DAYS)
+    if history:
+        lines.append(f"\nВага за останні {len(history)} дн. (мін–макс, на кінець дня):")
+        for row in history:
+            lines.append(f"{row['day'].strftime('%d.%m')}: {row['min_weight']}–{row['max_weight']} кг, {row['close_weight']} кг")
+
+    records = storage.chat_records(chat_id)
+    if records:
+        lines.append("\n🏆 Рекорди чату:")
+        heaviest = records.get('heaviest')
+        if heaviest:
+            lines.append(f"Найважче пацєтко: {heaviest['pet_name'] or heaviest['user_id']} — {heaviest['value']} кг")
+        longest = records.get('longest_lived')
+        if longest:
+            lines.append(f"Найдовше прожило: {longest['pet_name'] or longest['user_id']} — {longest['value']} дн.")
+    send_message(chat_id, user_id, "\n".join(lines))
+# ============================================
+
+def handle_globaltop(chat_id, user_id):
+    rows = leaderboard.top(GLOBAL_TOP_SIZE)
+    if not rows:
+        send_message(chat_id, user_id, "Ще немає живих пацєток у жодному чаті.")
+        return
+    lines = []
+    for rank, (row_chat_id, row_user_id, weight, pet_name) in enumerate(rows, start=1):
+        here = " (цей чат)" if row_chat_id == chat_id else ""
+        lines.append(f"{rank}. {pet_name or row_user_id} — {weight} кг{here}")
+    send_message(chat_id, user_id, "🌍 Глобальний топ пацєток усіх чатів:\n" + "\n".join(lines))
+
 def handle_pet(chat_id, user_id, username):
     player = ensure_player(chat_id, user_id, username)
     update_recruits_count(chat_id, user_id)
@@ -690,7 +3438,7 @@ def handle_pet(chat_id, user_id, username):
     
     if last_pet_time:
         time_since_last_pet = current_time - last_pet_time
-        cooldown = timedelta(hours=PET_COOLDOWN_HOURS)
+        cooldown = timedelta(hours=GAME.pet_cooldown_hours)
         if time_since_last_pet < cooldown:
             time_left = cooldown - time_since_last_pet
             time_left_str = format_timedelta(time_left)
@@ -699,13 +3447,14 @@ def handle_pet(chat_id, user_id, username):
 
     update_last_pet_time(chat_id, user_id, current_time)
     
-    if random.random() < 0.30:
-        sign = random.choice([-1,1])
-        delta = random.randint(1,3) * sign
+    if rng.random() < 0.30:
+        sign = rng.choice([-1,1])
+        delta = rng.randint(1,3) * sign
         neww = bounded_weight(old, delta)
         update_weight(chat_id, user_id, neww)
+        emit_event('pet', chat_id, user_id, delta=delta, weight=neww)
         if neww <= 0:
-            kill_pet(chat_id, user_id)
+            kill_pet(chat_id, user_id, cause='pet')
             send_message(chat_id, user_id, f"На жаль, {pet_name} так сильно налякалося, що отримало інфаркт і померло. Ви чухали його занадто сильно. Фініта ля комеді.")
             return
 
@@ -723,13 +3472,13 @@ def handle_inventory(chat_id, user_id, username):
     if pet_is_dead_check(chat_id, user_id, player.get('pet_name'), 'inventory'):
         return
 
-    inv = get_inventory(chat_id, user_id)
+    inv = get_player_inventory(player)
     if not inv:
         send_message(chat_id, user_id, "Інвентар порожній.")
         return
     lines = []
     for k,q in inv.items():
-        u = ITEMS.get(k, {}).get('u_name', k)
+        u = GAME.item_name(k)
         lines.append(f"* {u}: {q}")
     send_message(chat_id, user_id, "Інвентар:\n" + "\n".join(lines))
 
@@ -739,6 +3488,11 @@ def handle_feed(chat_id, user_id, username, arg_item):
     if pet_is_dead_check(chat_id, user_id, player.get('pet_name'), 'feed'):
         return
 
+    max_items = parse_batch_arg(arg_item)
+    if max_items is not None:
+        handle_feed_batch(chat_id, user_id, player, max_items)
+        return
+
     old = player['weight']
     last_feed_date = player.get('last_feed_utc')
     feed_count = player.get('daily_feeds_count')
@@ -750,39 +3504,17 @@ def handle_feed(chat_id, user_id, username, arg_item):
         feed_count = 0
         set_last_feed_date_and_count(chat_id, user_id, current_utc_date, count=0)
     
-    FEED_PRIORITY = ['baton', 'sausage', 'can', 'vodka']
-    free_feeds_left = DAILY_FEEDS_LIMIT - feed_count
+    free_feeds_left = GAME.daily_feeds_limit - feed_count
     
     # === Обробка безкоштовної годівлі ===
     if free_feeds_left > 0 and not arg_item:
-        r = random.random()
-        if r < 0.35:
-            # 35% шанс втрати ваги (від -40 до -1)
-            delta = random.randint(1, 20)
-        elif r < 0.50:
-            # 15% шанс, що вага не зміниться (з 40% по 45%)
-            delta = random.randint(21, 30)
-        elif r < 0.55:
-            # 5% шанс, що вага не зміниться (з 40% по 45%)
-            delta = random.randint(31, 40)
-        elif r < 0.60:
-            # 5% шанс, що вага не зміниться (з 40% по 45%)
-            delta = 0
-        elif r < 0.85:
-            # 25% шанс, що вага не зміниться (з 40% по 45%)
-            delta = random.randint(-20, -1)
-        elif r < 0.95:
-            # 10% шанс, що вага не зміниться (з 40% по 45%)
-            delta = random.randint(-30, -21)
-        else:
-            # 55% шанс набрати вагу (від 1 до 40)
-            delta = random.randint(-40, -31)
-        
+        delta = free_feed_delta()
         neww = bounded_weight(old, delta)
         update_weight(chat_id, user_id, neww)
         increment_feed_count(chat_id, user_id)
+        emit_event('feed', chat_id, user_id, source='free', delta=delta, weight=neww)
         if neww <= 0:
-            kill_pet(chat_id, user_id)
+            kill_pet(chat_id, user_id, cause='feed')
             messages.append(f"Ви відкриваєте безкоштовну поставку харчів від Бармена: {pet_name} хряцає їжу, після чого так сильно просирається, що вмирає від срачки. Інші пацєтки ходять з цибулею і хлібом, бо старий хрін щось там намутив в продуктах.")
             send_message(chat_id, user_id, '\n'.join(messages))
             return
@@ -800,31 +3532,27 @@ def handle_feed(chat_id, user_id, username, arg_item):
             
     # === Обробка, якщо безкоштовних годівль не залишилось, але предмет не вказано ===
     elif not arg_item:
-        inv = get_inventory(chat_id, user_id)
+        inv = get_player_inventory(player)
         item_to_use = None
-        for item_key in FEED_PRIORITY:
-            if inv.get(item_key, 0) > 0 and 'feed' in ITEMS[item_key]['uses_for']:
+        for item_key in GAME.feed_priority:
+            if inv.get(item_key, 0) > 0 and item_key in GAME.usable['feed']:
                 item_to_use = item_key
                 break
             
         if item_to_use:
             ok = remove_item(chat_id, user_id, item_to_use, qty=1)
             if ok:
-                a, b = ITEMS[item_to_use]['feed_delta']
-                if random.random() < 0.40:
-                    d = random.randint(a, 0)
-                else:
-                    d = random.randint(0, b)
-                    
+                d = auto_feed_delta(item_to_use)
                 neww = bounded_weight(old, d)
                 update_weight(chat_id, user_id, neww)
+                emit_event('feed', chat_id, user_id, source=item_to_use, delta=d, weight=neww)
                 if neww <= 0:
-                    kill_pet(chat_id, user_id)
-                    messages.append(f"У {pet_name} бурчить в животі, і ти вирішив скористатися {ITEMS[item_to_use]['u_name']}. Але {ITEMS[item_to_use]['u_name']} виявилось отруєним, після чого пацєтко дає рідким і помирає від отруєння.")
+                    kill_pet(chat_id, user_id, cause='feed')
+                    messages.append(f"У {pet_name} бурчить в животі, і ти вирішив скористатися {GAME.items[item_to_use]['u_name']}. Але {GAME.items[item_to_use]['u_name']} виявилось отруєним, після чого пацєтко дає рідким і помирає від отруєння.")
                     send_message(chat_id, user_id, '\n'.join(messages))
                     return
 
-                messages.append(f"У {pet_name} бурчить в животі, тому ти використав {ITEMS[item_to_use]['u_name']} з інвентарю. Паця набрало {d:+d} кг сальця і тепер важить {neww} кг")
+                messages.append(f"У {pet_name} бурчить в животі, тому ти використав {GAME.items[item_to_use]['u_name']} з інвентарю. Паця набрало {d:+d} кг сальця і тепер важить {neww} кг")
                 old = neww
             else:
                 messages.append("Якась помилка. Предмет мав бути в інвентарі, але його не знайшли.")
@@ -834,33 +3562,34 @@ def handle_feed(chat_id, user_id, username, arg_item):
     
     # === Обробка годівлі з вказаним предметом ===
     if arg_item:
-        key = ALIASES.get(arg_item.lower())
+        key = GAME.aliases.get(arg_item.lower())
         if not key:
             messages.append("Невідомий предмет. Доступні: батон, ковбаса, консерва, горілка, енергетик.")
         else:
-            if key not in ITEMS or 'feed' not in (ITEMS[key]['uses_for'] or []):
-                messages.append(f"{ITEMS.get(key, {}).get('u_name', key)} не годиться для харчування паці.")
+            if key not in GAME.usable['feed']:
+                messages.append(f"{GAME.item_name(key)} не годиться для харчування паці.")
             else:
                 ok = remove_item(chat_id, user_id, key, qty=1)
                 if not ok:
-                    messages.append(f"У тебе немає {ITEMS[key]['u_name']} в інвентарі.")
+                    messages.append(f"У тебе немає {GAME.items[key]['u_name']} в інвентарі.")
                 else:
-                    a, b = ITEMS[key]['feed_delta']
-                    d = random.randint(a, b)
+                    a, b = GAME.items[key]['feed_delta']
+                    d = rng.randint(a, b)
                     neww = bounded_weight(old, d)
                     update_weight(chat_id, user_id, neww)
+                    emit_event('feed', chat_id, user_id, source=key, delta=d, weight=neww)
                     if neww <= 0:
-                        kill_pet(chat_id, user_id)
-                        messages.append(f"Пацєтко з'їло {ITEMS[key]['u_name']}, але {ITEMS[key]['u_name']} було отруєним і пацєтко смертельно просралося. Фініта ля комеді.")
+                        kill_pet(chat_id, user_id, cause='feed')
+                        messages.append(f"Пацєтко з'їло {GAME.items[key]['u_name']}, але {GAME.items[key]['u_name']} було отруєним і пацєтко смертельно просралося. Фініта ля комеді.")
                         send_message(chat_id, user_id, '\n'.join(messages))
                         return
 
                     if d > 0:
-                        msg = f"Дав схрумкати {pet_name} {ITEMS[key]['u_name']}, і маєш приріст сальця!"
+                        msg = f"Дав схрумкати {pet_name} {GAME.items[key]['u_name']}, і маєш приріст сальця!"
                     elif d < 0:
-                        msg = f"{pet_name} з'їло {ITEMS[key]['u_name']} і щось пішло не так. {pet_name} просралося і вага зменшилася - мінус сальце."
+                        msg = f"{pet_name} з'їло {GAME.items[key]['u_name']} і щось пішло не так. {pet_name} просралося і вага зменшилася - мінус сальце."
                     else:
-                        msg = f"Накормив пацєтко {ITEMS[key]['u_name']}, але вага не змінилась, сальця не додалося."
+                        msg = f"Накормив пацєтко {GAME.items[key]['u_name']}, але вага не змінилась, сальця не додалося."
 
                     messages.append(f"{msg}. {pet_name} важило {old} кг, тепер {neww} кг (зміна сальця на {d:+d} кг)")
                     old = neww
@@ -872,10 +3601,10 @@ def handle_feed(chat_id, user_id, username, arg_item):
         time_left = format_timedelta_to_next_day()
         messages.append(f"\nНаступна безкоштовна поставка харчів від Бармена через {time_left}.")
 
-    inv = get_inventory(chat_id, user_id)
-    avail_feed = {k:v for k,v in inv.items() if k in ITEMS and 'feed' in (ITEMS[k]['uses_for'] or [])}
+    inv = {} if pressure.degrade(pressure.SKIP_FOOTER, "pressure.skip_footer") else get_inventory(chat_id, user_id)
+    avail_feed = {k:v for k,v in inv.items() if k in GAME.usable['feed']}
     if avail_feed:
-        lines = [f"{ITEMS[k]['u_name']}: {q}" for k,q in avail_feed.items()]
+        lines = [f"{GAME.items[k]['u_name']}: {q}" for k,q in avail_feed.items()]
         messages.append("\nУ тебе є предмети для додаткового харчування: " + ", ".join(lines))
     
     send_message(chat_id, user_id, '\n'.join(messages) if messages else 'Нічого не сталося.')
@@ -887,6 +3616,11 @@ def handle_zonewalk(chat_id, user_id, username, arg_item):
     if pet_is_dead_check(chat_id, user_id, player.get('pet_name'), 'zonewalk'):
         return
 
+    max_items = parse_batch_arg(arg_item)
+    if max_items is not None:
+        handle_zonewalk_batch(chat_id, user_id, player, max_items)
+        return
+
     last_zonewalk_date = player.get('last_zonewalk_utc')
     zonewalk_count = player.get('daily_zonewalks_count')
     pet_name = player.get('pet_name', 'Пацєтко')
@@ -897,49 +3631,18 @@ def handle_zonewalk(chat_id, user_id, username, arg_item):
         zonewalk_count = 0
         set_last_zonewalk_date_and_count(chat_id, user_id, current_utc_date, count=0)
 
-    ZONEWALK_PRIORITY = ['energy', 'vodka']
-
     def do_one_walk(player_data):
-        death_messages = [
-            f"Під час ходки, {pet_name} загризли собаки.",
-            f"{pet_name} вирішив дослідити закинуте село, і жахливий салосіся висмоктав все сальце у {pet_name}.",
-            f"{pet_name} вирішив повеселитися і заліз в Карусель.",
-            f"{pet_name} був поранений і просив допомоги, але інше пацєтко йомо лише сказало 'До зустрічі!'.",
-            f"{pet_name} потрапив під Викид і розплавилося на шкварочки.",
-            f"{pet_name} поліз з цікавості куди не треба і потрапив під вплив іншого Моноліту."
-        ]
-
-        # === Моментальна смерть (5% шанс) ===
-        if random.random() < 0.05:
-            kill_pet(chat_id, player_data['user_id'])
-            death_title = "☠️Ще одне пацєтко поглинула Зона...☠️"
-            death_text = random.choice(death_messages)
-            return "Смерть", f"\n{death_title}\n{death_text}"
-        # =====================================
-
-        cnt = pick_item_count()
-        loot = []
-        if cnt > 0:
-            loot = pick_loot(cnt)
-            for it in loot:
-                add_item(chat_id, user_id, it, 1)
-        delta = zonewalk_weight_delta()
-        oldw = player_data['weight']
-        neww = bounded_weight(oldw, delta)
+        status, s, loot, neww = roll_zonewalk(pet_name, player_data['weight'])
+        emit_event('zonewalk', chat_id, user_id, delta=neww - player_data['weight'], weight=neww, loot=loot)
+        if status == "Смерть":
+            kill_pet(chat_id, user_id, cause='zonewalk')
+            return status, s
+        for it in loot:
+            add_item(chat_id, user_id, it, 1)
         update_weight(chat_id, user_id, neww)
+        return status, s
 
-        if neww <= 0:
-            kill_pet(chat_id, user_id)
-            return "Смерть", f"Під час ходки, {pet_name} наступив на аномалію, і помер. Смерть в зоні – звичне діло. Царство йому небесне."
-
-        s = f"\nВ процесі ходки {pet_name} набрав {delta:+d} кг сальця, і тепер важить {neww} кг."
-        if cnt == 0:
-            s += "\nЦей раз без хабаря."
-        else:
-            s += f"\nЄ хабар! {pet_name} приніс: " + ", ".join(f"{ITEMS[it]['u_name']}" for it in loot)
-        return "Продовження", s
-
-    free_walks_left = DAILY_ZONEWALKS_LIMIT - zonewalk_count
+    free_walks_left = GAME.daily_zonewalks_limit - zonewalk_count
 
     if free_walks_left > 0:
         if not arg_item:
@@ -951,12 +3654,14 @@ def handle_zonewalk(chat_id, user_id, username, arg_item):
                 send_message(chat_id, user_id, '\n'.join(messages))
                 return
             free_walks_left -= 1
+            if free_walks_left == 0:
+                schedule_reminder(chat_id, user_id, 'zonewalk', next_utc_day())
 
     elif not arg_item:
-        inv = get_inventory(chat_id, user_id)
+        inv = get_player_inventory(player)
         item_to_use = None
-        for item_key in ZONEWALK_PRIORITY:
-            if inv.get(item_key, 0) > 0 and 'zonewalk' in ITEMS[item_key]['uses_for']:
+        for item_key in GAME.zonewalk_priority:
+            if inv.get(item_key, 0) > 0 and item_key in GAME.usable['zonewalk']:
                 item_to_use = item_key
                 break
 
@@ -965,7 +3670,7 @@ def handle_zonewalk(chat_id, user_id, username, arg_item):
             if ok:
                 player_data = get_player_data(chat_id, user_id)
                 status, s = do_one_walk(player_data)
-                messages.append(f"Пацєтко втомилося, тому ти використав {ITEMS[item_to_use]['u_name']} з інвентарю для додаткової ходки: " + s)
+                messages.append(f"Пацєтко втомилося, тому ти використав {GAME.items[item_to_use]['u_name']} з інвентарю для додаткової ходки: " + s)
                 if status == "Смерть":
                     send_message(chat_id, user_id, '\n'.join(messages))
                     return
@@ -976,20 +3681,20 @@ def handle_zonewalk(chat_id, user_id, username, arg_item):
             messages.append(f"Паця втомилося, а у тебе немає ні енергетика, ні горілки в інвентарі. \n{pet_name} нікуди не пішло і залишилось травити анекдоти біля ватри з іншими пацєтками.")
 
     if arg_item:
-        key = ALIASES.get(arg_item.lower())
+        key = GAME.aliases.get(arg_item.lower())
         if not key:
             messages.append("Невідомий предмет для використання в ходці.")
         else:
-            if key not in ITEMS or 'zonewalk' not in (ITEMS[key]['uses_for'] or []):
-                messages.append(f"{ITEMS.get(key, {}).get('u_name', key)} не дає можливості ходити в зону.")
+            if key not in GAME.usable['zonewalk']:
+                messages.append(f"{GAME.item_name(key)} не дає можливості ходити в зону.")
             else:
                 ok = remove_item(chat_id, user_id, key, qty=1)
                 if not ok:
-                    messages.append(f"У тебе немає {ITEMS[key]['u_name']} в інвентарі.")
+                    messages.append(f"У тебе немає {GAME.items[key]['u_name']} в інвентарі.")
                 else:
                     player_data = get_player_data(chat_id, user_id)
                     status, s = do_one_walk(player_data)
-                    messages.append(f"Використано {ITEMS[key]['u_name']} для додаткової ходки: " + s)
+                    messages.append(f"Використано {GAME.items[key]['u_name']} для додаткової ходки: " + s)
                     if status == "Смерть":
                         send_message(chat_id, user_id, '\n'.join(messages))
                         return
@@ -1001,14 +3706,160 @@ def handle_zonewalk(chat_id, user_id, username, arg_item):
         time_left = format_timedelta_to_next_day()
         messages.append(f"\nЦе були останні сили на сьогодні для походів в Зону у паці. Сили на наступні будуть через {time_left}.")
 
-    inv = get_inventory(chat_id, user_id)
-    zone_items = {k: v for k, v in inv.items() if k in ITEMS and 'zonewalk' in (ITEMS[k]['uses_for'] or [])}
+    inv = {} if pressure.degrade(pressure.SKIP_FOOTER, "pressure.skip_footer") else get_inventory(chat_id, user_id)
+    zone_items = {k: v for k, v in inv.items() if k in GAME.usable['zonewalk']}
     if zone_items:
-        lines = [f"{ITEMS[k]['u_name']}: {q}" for k, q in zone_items.items()]
+        lines = [f"{GAME.items[k]['u_name']}: {q}" for k, q in zone_items.items()]
         messages.append("У тебе є предмети для додаткових ходок: " + ", ".join(lines))
 
     send_message(chat_id, user_id, '\n'.join(messages) if messages else 'Нічого не сталося.')
 
+# === NEW FEATURE: Пакетний режим (/feed all [N], /zonewalk all [N]) ===
+# Усі безкоштовні спроби + до N предметів з інвентаря рахуються в пам'яті,
+# а результат пишеться однією транзакцією і одним повідомленням.
+BATCH_ARGS = ('all', 'все', 'всі')
+
+def parse_batch_arg(arg):
+    """'all [N]' -> N (скільки предметів можна витратити), інакше None."""
+    parts = (arg or '').split()
+    if not parts or parts[0].lower() not in BATCH_ARGS:
+        return None
+    if len(parts) > 1 and parts[1].isdigit():
+        return int(parts[1])
+    return 0
+
+def format_item_counts(counts):
+    return ", ".join(f"{GAME.items[k]['u_name']} x{q}" for k, q in counts.items() if q > 0)
+
+def apply_batch_result(chat_id, user_id, weight, dead, inv_before, inv_after, set_day_and_count, cause):
+    """Записує підсумок пакетної дії однією транзакцією."""
+    with storage.transaction():
+        set_day_and_count()
+        if dead:
+            kill_pet(chat_id, user_id, cause=cause)
+            return
+        update_weight(chat_id, user_id, weight)
+        for item in set(inv_before) | set(inv_after):
+            diff = inv_after.get(item, 0) - inv_before.get(item, 0)
+            if diff > 0:
+                add_item(chat_id, user_id, item, diff)
+            elif diff < 0 and not remove_item(chat_id, user_id, item, -diff):
+                raise RuntimeError(f"inventory changed during batch: {item}")
+
+def next_batch_item(inv, priority, use):
+    for item_key in priority:
+        if inv.get(item_key, 0) > 0 and item_key in GAME.usable[use]:
+            return item_key
+    return None
+
+def handle_zonewalk_batch(chat_id, user_id, player, max_items):
+    pet_name = player.get('pet_name', 'Пацєтко')
+    today = now_utc().date()
+    count = player['daily_zonewalks_count'] if player.get('last_zonewalk_utc') == today else 0
+    inv_before = get_player_inventory(player)
+    inv = dict(inv_before)
+    old = weight = player['weight']
+    lines, loot_total, used = [], {}, {}
+    dead = False
+
+    while not dead:
+        item_key = None
+        if count < GAME.daily_zonewalks_limit:
+            count += 1
+        elif max_items > 0:
+            item_key = next_batch_item(inv, GAME.zonewalk_priority, 'zonewalk')
+            if not item_key:
+                break
+            inv[item_key] -= 1
+            used[item_key] = used.get(item_key, 0) + 1
+            max_items -= 1
+        else:
+            break
+        status, s, loot, weight = roll_zonewalk(pet_name, weight)
+        label = f"Ходка {len(lines) + 1}" + (f" ({GAME.items[item_key]['u_name']})" if item_key else "")
+        lines.append(f"{label}: {s.strip()}")
+        dead = status == "Смерть"
+        for it in loot:
+            inv[it] = inv.get(it, 0) + 1
+            loot_total[it] = loot_total.get(it, 0) + 1
+
+    if not lines:
+        time_left = format_timedelta_to_next_day()
+        send_message(chat_id, user_id, f"Паця вже виходило всі безкоштовні ходки, а предметів для додаткових немає (або не вказано скільки: /zonewalk all 3). Сили на наступні будуть через {time_left}.")
+        return
+
+    apply_batch_result(chat_id, user_id, weight, dead, inv_before, inv,
+                       lambda: set_last_zonewalk_date_and_count(chat_id, user_id, today, count), 'zonewalk')
+    emit_event('zonewalk', chat_id, user_id, batch=len(lines), delta=weight - old, weight=weight,
+               loot=loot_total, used=used)
+
+    messages = [f"{pet_name} напялює протигаз і йде в серію ходок у Зону:"] + lines
+    if dead:
+        send_message(chat_id, user_id, '\n\n'.join(messages))
+        return
+    summary = f"Разом за {len(lines)} ходок: {weight - old:+d} кг сальця, тепер {pet_name} важить {weight} кг."
+    if loot_total:
+        summary += "\nХабар: " + format_item_counts(loot_total)
+    if used:
+        summary += "\nВикористано: " + format_item_counts(used)
+    zone_items = {k: v for k, v in inv.items() if v > 0 and k in GAME.usable['zonewalk']}
+    if zone_items:
+        summary += "\nУ тебе є предмети для додаткових ходок: " + format_item_counts(zone_items)
+    messages.append(summary)
+    send_message(chat_id, user_id, '\n\n'.join(messages))
+
+def handle_feed_batch(chat_id, user_id, player, max_items):
+    pet_name = player.get('pet_name', 'Пацєтко')
+    today = now_utc().date()
+    count = player['daily_feeds_count'] if player.get('last_feed_utc') == today else 0
+    inv_before = get_player_inventory(player)
+    inv = dict(inv_before)
+    old = weight = player['weight']
+    lines, used = [], {}
+
+    while weight > 0:
+        if count < GAME.daily_feeds_limit:
+            count += 1
+            label = "Поставка від Бармена"
+            delta = free_feed_delta()
+        elif max_items > 0:
+            item_key = next_batch_item(inv, GAME.feed_priority, 'feed')
+            if not item_key:
+                break
+            inv[item_key] -= 1
+            used[item_key] = used.get(item_key, 0) + 1
+            max_items -= 1
+            label = GAME.items[item_key]['u_name']
+            delta = auto_feed_delta(item_key)
+        else:
+            break
+        weight = bounded_weight(weight, delta)
+        lines.append(f"{label}: {delta:+d} кг, вага {weight} кг")
+
+    if not lines:
+        time_left = format_timedelta_to_next_day()
+        send_message(chat_id, user_id, f"Безкоштовні харчі вже з'їдені, а предметів для годівлі немає (або не вказано скільки: /feed all 3). Наступна поставка від Бармена через {time_left}.")
+        return
+
+    dead = weight <= 0
+    apply_batch_result(chat_id, user_id, weight, dead, inv_before, inv,
+                       lambda: set_last_feed_date_and_count(chat_id, user_id, today, count), 'feed')
+    emit_event('feed', chat_id, user_id, batch=len(lines), delta=weight - old, weight=weight, used=used)
+
+    messages = [f"{pet_name} сідає за великий стіл:"] + lines
+    if dead:
+        messages.append(f"\n{pet_name} переїло, так сильно просралося, що вмерло. Фініта ля комеді.")
+        send_message(chat_id, user_id, '\n'.join(messages))
+        return
+    messages.append(f"\nРазом: {weight - old:+d} кг сальця, тепер {pet_name} важить {weight} кг.")
+    if used:
+        messages.append("Використано: " + format_item_counts(used))
+    feed_items = {k: v for k, v in inv.items() if v > 0 and k in GAME.usable['feed']}
+    if feed_items:
+        messages.append("У тебе є предмети для додаткового харчування: " + format_item_counts(feed_items))
+    send_message(chat_id, user_id, '\n'.join(messages))
+# =======================================================
+
 # === NEW FEATURE: Колесо Фортуни (Command Handler) ===
 def handle_wheel(chat_id, user_id, username):
     player = ensure_player(chat_id, user_id, username)
@@ -1027,7 +3878,7 @@ def handle_wheel(chat_id, user_id, username):
     
     pet_name = player.get('pet_name', 'Пацєтко')
 
-    spins_left = DAILY_WHEEL_LIMIT - wheel_count
+    spins_left = GAME.daily_wheel_limit - wheel_count
 
     if spins_left <= 0:
         time_left = format_timedelta_to_next_day()
@@ -1035,11 +3886,12 @@ def handle_wheel(chat_id, user_id, username):
         return
         
     reward = spin_wheel()
-    reward_info = WHEEL_REWARDS[reward]
+    reward_info = GAME.wheel_rewards[reward]
     reward_name = reward_info['u_name']
     reward_qty = reward_info['quantity']
-    new_spins_left = DAILY_WHEEL_LIMIT - (wheel_count + 1)
+    new_spins_left = GAME.daily_wheel_limit - (wheel_count + 1)
     
+    emit_event('wheel', chat_id, user_id, reward=reward, quantity=reward_qty if reward != "nothing" else 0)
     if reward != "nothing":
         add_item(chat_id, user_id, reward, reward_qty)
         send_message(chat_id, user_id, f"Казіч крутиться, Сидор мутиться... і ви виграли: {reward_name} ({reward_qty} шт)! 🎉\n\nУ {pet_name} залишилося {new_spins_left} депів на сьогодні.")
@@ -1067,7 +3919,7 @@ def handle_recruit(chat_id, user_id, username):
     spawn_pet(chat_id, user_id, username)
     player = get_player_data(chat_id, user_id)
     new_recruits_count = player['recruited_pets_count']
-    send_message(chat_id, user_id, f"Пацєтко сі вродило!\n\nВи активуєте ваш Моноліт, призиваючи і вербучи пацєтко. \nЙого вага {STARTING_WEIGHT} кг, а звуть {player['pet_name']}. \nУ вас залишилось {new_recruits_count} вірних пацєток для вербування.")
+    send_message(chat_id, user_id, f"Пацєтко сі вродило!\n\nВи активуєте ваш Моноліт, призиваючи і вербучи пацєтко. \nЙого вага {GAME.starting_weight} кг, а звуть {player['pet_name']}. \nУ вас залишилось {new_recruits_count} вірних пацєток для вербування.")
 
 def handle_check_recruits(chat_id, user_id, username):
     player = ensure_player(chat_id, user_id, username)
@@ -1083,31 +3935,55 @@ def handle_check_recruits(chat_id, user_id, username):
 # =============================================================
 
 # --- Логіка бою ---
+def fight_cooldown_left(player):
+    """Скільки ще чекати до наступної бійки; None — можна битися."""
+    last_fight_time = player.get('last_fight_utc')
+    if last_fight_time:
+        elapsed = now_utc() - last_fight_time
+        cooldown = timedelta(hours=GAME.fight_cooldown_hours)
+        if elapsed < cooldown:
+            return cooldown - elapsed
+    return None
+
+def send_fight_cooldown(chat_id, user_id, pet_name, left):
+    time_left = format_timedelta(left)
+    send_message(chat_id, user_id, f"{pet_name} ще облизує подряпини після попередньої бійки і тягне чарку. \n{pet_name} відчуває що буде готовий знову гатитися через {time_left}.")
+
 def process_fight(chat_id, attacker_id, defender_id):
+    """Викликається під player_lock: стан нападника перечитується тут, тож друга кнопка
+    (чи повторне натискання) після вже проведеної бійки впирається в кулдаун."""
     attacker = get_player_data(chat_id, attacker_id)
     defender = get_player_data(chat_id, defender_id)
 
     if not attacker or attacker['weight'] <= 0:
         send_message(chat_id, attacker_id, "Твоє пацєтко мертве і не може битися.")
         return
+    left = fight_cooldown_left(attacker)
+    if left:
+        send_fight_cooldown(chat_id, attacker_id, attacker.get('pet_name', 'Пацєтко'), left)
+        return
     if not defender or defender['weight'] <= 0:
         send_message(chat_id, attacker_id, "Обране пацєтко вже мертве.")
         return
 
     # Випадковий вибір переможця та переможеного
     fighters = [attacker, defender]
-    winner_data = random.choice(fighters)
+    winner_data = rng.choice(fighters)
     loser_data = next(f for f in fighters if f['user_id'] != winner_data['user_id'])
 
     # Випадкові зміни ваги
-    winner_delta = random.randint(1, 5)
-    loser_delta = random.randint(-5, -1)
+    winner_delta = rng.randint(1, 5)
+    loser_delta = rng.randint(-5, -1)
 
     winner_new_weight = bounded_weight(winner_data['weight'], winner_delta)
     loser_new_weight = bounded_weight(loser_data['weight'], loser_delta)
 
     update_weight(chat_id, winner_data['user_id'], winner_new_weight)
     update_weight(chat_id, loser_data['user_id'], loser_new_weight)
+    emit_event('fight', chat_id, winner_data['user_id'], won=True, opponent=loser_data['user_id'],
+               delta=winner_delta, weight=winner_new_weight)
+    emit_event('fight', chat_id, loser_data['user_id'], won=False, opponent=winner_data['user_id'],
+               delta=loser_delta, weight=loser_new_weight)
 
     fight_story = [
         f"Пацєтко {attacker['pet_name']} ({attacker['weight']} кг) підкотило до {defender['pet_name']} ({defender['weight']} кг).",
@@ -1118,7 +3994,7 @@ def process_fight(chat_id, attacker_id, defender_id):
     fight_story.append(f" По результатам потужне {winner_data['pet_name']} набрало {winner_delta} кг сальця і тепер важить {winner_new_weight} кг. \nВіддухопелене і відгачене {loser_data['pet_name']} втратило {abs(loser_delta)} кг сальця і тепер важить {loser_new_weight} кг.")
 
     if loser_new_weight <= 0:
-        kill_pet(chat_id, loser_data['user_id'])
+        kill_pet(chat_id, loser_data['user_id'], cause='fight')
         loot = get_inventory(chat_id, loser_data['user_id'])
         if loot:
             for item, qty in loot.items():
@@ -1140,14 +4016,10 @@ def handle_fight(chat_id, user_id, username):
     if pet_is_dead_check(chat_id, user_id, player.get('pet_name'), 'fight'):
         return
 
-    last_fight_time = player.get('last_fight_utc')
-    if last_fight_time:
-        elapsed = now_utc() - last_fight_time
-        cooldown = timedelta(hours=FIGHT_COOLDOWN_HOURS)
-        if elapsed < cooldown:
-            time_left = format_timedelta(cooldown - elapsed)
-            send_message(chat_id, user_id, f"{pet_name} ще облизує подряпини після попередньої бійки і тягне чарку. \n{pet_name} відчуває що буде готовий знову гатитися через {time_left}.")
-            return
+    left = fight_cooldown_left(player)
+    if left:
+        send_fight_cooldown(chat_id, user_id, pet_name, left)
+        return
 
     opponents = get_alive_opponents(chat_id, user_id)
     if not opponents:
@@ -1157,15 +4029,90 @@ def handle_fight(chat_id, user_id, username):
     buttons = []
     for opp in opponents:
         label = f"{opp['pet_name']} ({opp['weight']} кг)"
-        buttons.append([{"text": label, "callback_data": f"fight:{user_id}:{opp['user_id']}"}])
+        buttons.append([{"text": label, "callback_data": make_callback(chat_id, 'fight', user_id, opp['user_id'])}])
 
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": "Вибери, з ким твоя паця піде лупцюватися:",
-        "reply_markup": {"inline_keyboard": buttons}
-    }
-    requests.post(url, json=payload)
+    send_message(chat_id, user_id, "Вибери, з ким твоя паця піде лупцюватися:", reply_markup={"inline_keyboard": buttons})
+# ========================================================
+
+# === NEW FEATURE: Королівська битва (/royale) ===
+# Турнір на вибування між усіма живими пацєтками чату. Сітка рахується в пам'яті
+# за тими ж правилами, що й /fight, а результат пишеться кількома set-based запитами.
+ROYALE_REPORT_LINES = 20
+
+def resolve_royale(pets, inventories):
+    """Повертає (чемпіон, ваги, загиблі, змінені інвентарі, лог, кількість раундів)."""
+    weights = {p['user_id']: p['weight'] for p in pets}
+    names = {p['user_id']: p.get('pet_name') or str(p['user_id']) for p in pets}
+    inventories = {u: dict(inventories.get(u, {})) for u in weights}
+    looted, dead, log = set(), [], []
+
+    bracket = list(weights)
+    rng.shuffle(bracket)
+    rounds = 0
+    while len(bracket) > 1:
+        rounds += 1
+        next_bracket = [bracket.pop()] if len(bracket) % 2 else []  # непарний отримує пропуск
+        for a, b in zip(bracket[::2], bracket[1::2]):
+            winner, loser = (a, b) if rng.random() < 0.5 else (b, a)
+            weights[winner] = bounded_weight(weights[winner], rng.randint(1, 5))
+            weights[loser] = bounded_weight(weights[loser], rng.randint(-5, -1))
+            if weights[loser] <= 0:
+                dead.append(loser)
+                for item, qty in inventories.pop(loser).items():
+                    inventories[winner][item] = inventories[winner].get(item, 0) + qty
+                looted.add(winner)
+                log.append(f"💀 {names[winner]} добиває {names[loser]} і витрушує з туші хабар.")
+            next_bracket.append(winner)
+        bracket = next_bracket
+
+    changed = {u: inventories[u] for u in looted if u not in dead}
+    return bracket[0], weights, dead, changed, log, rounds
+
+def handle_royale(chat_id, user_id):
+    if chat_id > 0:
+        send_message(chat_id, user_id, "Ця команда працює лише в групових чатах.")
+        return
+    if not is_admin(chat_id, user_id):
+        send_message(chat_id, user_id, "Лише адміністратори можуть використовувати цю команду.")
+        return
+
+    with storage.transaction():
+        # Ті самі advisory locks і той самий порядок, що й у player_lock(), до FOR UPDATE
+        storage.lock_players(chat_id, storage.alive_pet_ids(chat_id))
+        pets, inventories = storage.load_chat_pets(chat_id)
+        if len(pets) < 2:
+            pets = None
+        else:
+            champion, weights, dead, changed, log, rounds = resolve_royale(pets, inventories)
+            storage.bulk_set_weights(chat_id, {u: w for u, w in weights.items() if u not in dead}, now_utc())
+            if dead:
+                for p in pets:
+                    if p['user_id'] in dead:
+                        storage.bump_record(chat_id, p['user_id'], 'longest_lived', get_days_alive(p['born_utc']), now_utc())
+                storage.bulk_kill(chat_id, dead)
+            if changed:
+                storage.bulk_replace_inventories(chat_id, changed)
+
+    if pets is None:
+        send_message(chat_id, user_id, "Для королівської битви потрібно хоча б два живих пацєтка.")
+        return
+
+    for p in pets:
+        uid = p['user_id']
+        leaderboard.observe(chat_id, uid, 0 if uid in dead else weights[uid])
+        emit_event('royale', chat_id, uid, delta=weights[uid] - p['weight'], weight=weights[uid],
+                   champion=uid == champion)
+        if uid in dead:
+            emit_event('death', chat_id, uid, cause='royale', pet_name=p.get('pet_name'))  # bulk_kill минає kill_pet()
+
+    names = {p['user_id']: p.get('pet_name') or str(p['user_id']) for p in pets}
+    lines = [f"⚔️ КОРОЛІВСЬКА БИТВА! {len(pets)} пацєток, {rounds} раундів лупцювання."]
+    lines += log[:ROYALE_REPORT_LINES]
+    if len(log) > ROYALE_REPORT_LINES:
+        lines.append(f"...і ще {len(log) - ROYALE_REPORT_LINES} загиблих.")
+    lines.append(f"\nЗагинуло пацєток: {len(dead)}.")
+    lines.append(f"🏆 Чемпіон: {names[champion]} — {weights[champion]} кг сальця!")
+    send_message(chat_id, user_id, "\n".join(lines)[:4096])
 # ========================================================
 
 # === NEW FEATURE: External Item Use ===
@@ -1184,34 +4131,35 @@ def handle_use_item_on_pet(chat_id, user_id, item_key, target_user_id):
         send_message(chat_id, user_id, f"{target_pet_name} мертве, на ньому не можна використовувати предмети.")
         return
         
-    if 'external_feed' not in ITEMS.get(item_key, {}).get('uses_for', []):
-        send_message(chat_id, user_id, f"Предмет {ITEMS[item_key]['u_name']} не може бути використаний на іншому пацєтку.")
+    if item_key not in GAME.usable['external_feed']:
+        send_message(chat_id, user_id, f"Предмет {GAME.items[item_key]['u_name']} не може бути використаний на іншому пацєтку.")
         return
 
     if not remove_item(chat_id, user_id, item_key, qty=1):
-        send_message(chat_id, user_id, f"У тебе немає {ITEMS[item_key]['u_name']} в інвентарі.")
+        send_message(chat_id, user_id, f"У тебе немає {GAME.items[item_key]['u_name']} в інвентарі.")
         return
         
     old_weight = target_player['weight']
-    a, b = ITEMS[item_key]['feed_delta']
-    delta = random.randint(a, b)
+    a, b = GAME.items[item_key]['feed_delta']
+    delta = rng.randint(a, b)
     new_weight = bounded_weight(old_weight, delta)
     update_weight(chat_id, target_user_id, new_weight)
+    emit_event('use_item', chat_id, target_user_id, source_user=user_id, item=item_key, delta=delta, weight=new_weight)
     
     if new_weight <= 0:
-        kill_pet(chat_id, target_user_id)
-        send_message(chat_id, user_id, f"Ти використав {ITEMS[item_key]['u_name']} на {target_pet_name}. На жаль, {target_pet_name} не витримало такої щедрості і померло. Ну, ти зробив усе, що міг...")
+        kill_pet(chat_id, target_user_id, cause='use_item')
+        send_message(chat_id, user_id, f"Ти використав {GAME.items[item_key]['u_name']} на {target_pet_name}. На жаль, {target_pet_name} не витримало такої щедрості і померло. Ну, ти зробив усе, що міг...")
         return
     
     if delta > 0:
-        message = f"Ти використав {ITEMS[item_key]['u_name']} на {target_pet_name}. Задоволене паця набрало {delta:+d} кг сальця і тепер важить {new_weight} кг. 🎉"
+        message = f"Ти використав {GAME.items[item_key]['u_name']} на {target_pet_name}. Задоволене паця набрало {delta:+d} кг сальця і тепер важить {new_weight} кг. 🎉"
     elif delta < 0:
-        message = f"Ти використав {ITEMS[item_key]['u_name']} на {target_pet_name}. На жаль, пацєтко втратило {abs(delta)} кг сальця через {ITEMS[item_key]['u_name']} і тепер важить {new_weight} кг."
+        message = f"Ти використав {GAME.items[item_key]['u_name']} на {target_pet_name}. На жаль, пацєтко втратило {abs(delta)} кг сальця через {GAME.items[item_key]['u_name']} і тепер важить {new_weight} кг."
     else:
-        message = f"Ти використав {ITEMS[item_key]['u_name']} на {target_pet_name}. Воно їбало в рот твої подарунки і викинуло його до чортів свинячих. "
+        message = f"Ти використав {GAME.items[item_key]['u_name']} на {target_pet_name}. Воно їбало в рот твої подарунки і викинуло його до чортів свинячих. "
     
     send_message(chat_id, user_id, message)
-    send_message(chat_id, target_user_id, f"Йобен бобен, ні сталося ні всралося, гості приперлися! Та ще й з гостинцем! \n{pet_name} використав на тобі {ITEMS[item_key]['u_name']}. Тепер твоє паця важить {new_weight} кг.")
+    send_message(chat_id, target_user_id, f"Йобен бобен, ні сталося ні всралося, гості приперлися! Та ще й з гостинцем! \n{pet_name} використав на тобі {GAME.items[item_key]['u_name']}. Тепер твоє паця важить {new_weight} кг.")
 
 
 def handle_use(chat_id, user_id, username):
@@ -1220,8 +4168,8 @@ def handle_use(chat_id, user_id, username):
     if pet_is_dead_check(chat_id, user_id, player.get('pet_name'), 'use'):
         return
 
-    inv = get_inventory(chat_id, user_id)
-    usable_items = {k: v for k, v in inv.items() if k in ITEMS and 'external_feed' in ITEMS[k].get('uses_for', [])}
+    inv = get_player_inventory(player)
+    usable_items = {k: v for k, v in inv.items() if k in GAME.usable['external_feed']}
     
     if not usable_items:
         send_message(chat_id, user_id, "У твоєму інвентарі немає предметів, які можна використати на інших пацєтках.")
@@ -1229,8 +4177,8 @@ def handle_use(chat_id, user_id, username):
         
     buttons = []
     for item_key, qty in usable_items.items():
-        item_name = ITEMS[item_key]['u_name']
-        buttons.append([{"text": f"{item_name} ({qty} шт.)", "callback_data": f"use_item:{user_id}:{item_key}"}])
+        item_name = GAME.items[item_key]['u_name']
+        buttons.append([{"text": f"{item_name} ({qty} шт.)", "callback_data": make_callback(chat_id, 'use_item', user_id, item_key)}])
     
     send_message(chat_id, user_id, "Обери предмет, який хочеш використати:", reply_markup={"inline_keyboard": buttons})
 
@@ -1259,12 +4207,7 @@ def handle_clear_chat(chat_id, user_id):
         send_message(chat_id, user_id, "Лише адміністратори можуть використовувати цю команду.")
         return
     
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT user_id, last_message_id FROM players WHERE chat_id=%s AND last_message_id IS NOT NULL", (chat_id,))
-    players_to_clear = cur.fetchall()
-    cur.close()
-    conn.close()
+    players_to_clear = storage.get_last_message_ids(chat_id)
 
     if not players_to_clear:
         send_message(chat_id, user_id, "Немає повідомлень бота для видалення.")
@@ -1277,69 +4220,288 @@ def handle_clear_chat(chat_id, user_id):
     send_message(chat_id, user_id, f"Видалено {len(players_to_clear)} останніх повідомлень бота.")
 # ===============================================
 
+# === NEW FEATURE: Traffic capture ===
+# Кожен апдейт разом з seed для random пишеться рядком JSON у gzip-файл, що
+# ротується за розміром. replay.py проганяє такі файли через process_update.
+class TrafficRecorder:
+    def __init__(self, directory, max_bytes=CAPTURE_MAX_BYTES, keep_files=CAPTURE_KEEP_FILES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep_files = keep_files
+        self._lock = threading.Lock()
+        self._fh = None
+        self._path = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_next(self):
+        if self._fh:
+            self._fh.close()
+        stamp = now_utc().strftime('%Y%m%d-%H%M%S-%f')
+        self._path = os.path.join(self.directory, f"updates-{stamp}.jsonl.gz")
+        self._fh = gzip.open(self._path, 'at', encoding='utf-8')
+        old_files = sorted(glob.glob(os.path.join(self.directory, 'updates-*.jsonl.gz')))
+        for path in old_files[:-self.keep_files]:
+            os.remove(path)
+
+    def record(self, update, seed):
+        line = json.dumps({"ts": time.time(), "seed": seed, "update": update}, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            if self._fh is None or os.path.getsize(self._path) >= self.max_bytes:
+                self._open_next()
+            self._fh.write(line + "\n")
+            self._fh.flush()
+        incr("capture.updates")
+
+def iter_capture(paths):
+    """Записи з файлів захоплення у порядку запису: {"ts", "seed", "update"}."""
+    for path in sorted(paths):
+        with gzip.open(path, 'rt', encoding='utf-8') as fh:
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+
+recorder = TrafficRecorder(CAPTURE_DIR) if CAPTURE_DIR else None
+
+class _RandomProxy:
+    """rng.<метод> — генератор, закріплений за поточним апдейтом, або глобальний random.
+    Кидки одного апдейта не залежать від інших потоків, тож seed їх відтворює."""
+
+    def __getattr__(self, name):
+        return getattr(getattr(_rng_local, 'random', None) or random, name)
+
+
+_rng_local = threading.local()
+rng = _RandomProxy()
+
+@contextmanager
+def seeded_random(seed):
+    """Власний random.Random(seed) для механік на час одного апдейта; None — глобальний random."""
+    _rng_local.random = random.Random(seed) if seed is not None else None
+    try:
+        yield
+    finally:
+        _rng_local.random = None
+# ====================================
+
 # === Webhook endpoint ===
+# Маркери в сирому JSON апдейта, без яких його не треба навіть розбирати. Telegram
+# може екранувати "/" як "\/", тому початок команди шукаємо в обох варіантах.
+RELEVANT_UPDATE_RE = re.compile(rb'"(?:callback_query|bot_command|my_chat_member)"|"text":\s*"\\?/')
+
+def is_relevant_update(body):
+    """Дешевий фільтр до json-декодування: лише команди й callback-и."""
+    return RELEVANT_UPDATE_RE.search(body) is not None
+
+@app.before_request
+def start_worker_jobs():
+    # Під gunicorn блок __main__ не виконується: фонові потоки воркера стартують з першим
+    # же запитом до нього, а не з першої за добу команди якогось гравця
+    if DATABASE_URL:
+        start_background_jobs()
+
 @app.route(f"/{TELEGRAM_TOKEN}", methods=['POST'])
 def telegram_webhook():
-    update = request.get_json()
+    status, reply, update = accept_update(request.headers.get('X-Telegram-Bot-Api-Secret-Token'), request.get_data(cache=False))
+    if update is not None:
+        reply = run_webhook_update(update) or reply
+    return jsonify(reply), status
+
+def accept_update(secret, body):
+    """Все, що робиться з апдейтом до хендлерів: (HTTP-статус, тіло відповіді, апдейт або None,
+    якщо обробляти нічого). Спільне для Flask і asgi.py."""
+    incr("webhook.received")
+    if secret != WEBHOOK_SECRET_TOKEN:
+        if webhook_secret_required:
+            incr("webhook.rejected_secret")
+            return 403, {'ok': False}, None
+        incr("webhook.unverified_secret")
+    if not is_relevant_update(body):
+        incr("webhook.shed")
+        incr("webhook.shed_bytes", len(body))
+        return 200, {'ok': True}, None
+    try:
+        update = json.loads(body)
+    except ValueError:
+        incr("webhook.bad_json")
+        return 200, {'ok': True}, None
     if not update:
-        return jsonify({'ok': True})
-        
-    # --- Обробка callback ---
+        return 200, {'ok': True}, None
+    # Зміну членства бота Telegram не повторить, а від неї залежить видалення чату й розблокування
+    # розсилок — її обробляємо навіть під перевантаженням
+    if not update.get('my_chat_member') and pressure.degrade(pressure.BUSY, "pressure.busy"):
+        # Відповідь прямо в тілі вебхука: ні запитів до БД, ні виклику Telegram API
+        capture_update(update)
+        return 200, busy_reply(update), None
+    return 200, {'ok': True}, update
+
+def capture_update(update):
+    """Пише апдейт у capture; повертає його seed (None, якщо запис вимкнено)."""
+    if not recorder:
+        return None
+    # Явний seed робить обробку апдейта відтворюваною при replay
+    seed = random.SystemRandom().getrandbits(63)
+    try:
+        recorder.record(update, seed)
+    except Exception as e:
+        print('capture error', e)
+    return seed
+
+_webhook_local = threading.local()
+
+def run_webhook_update(update):
+    """run_update під вебхуком: повертає виклик Bot API (answerCallbackQuery) для тіла
+    відповіді на вебхук або None — так обробка не чекає на api.telegram.org."""
+    _webhook_local.replies = []
+    try:
+        run_update(update)
+        return _webhook_local.replies[0] if _webhook_local.replies else None
+    finally:
+        _webhook_local.replies = None
+
+def run_update(update, seed=None):
+    if seed is None:
+        seed = capture_update(update)
+    with pressure.track(), coalesce_messages(update.get('update_id')), storage.session(), pin_game(), seeded_random(seed):
+        process_update(update)
+
+# === NEW FEATURE: Long polling (пакетна обробка) ===
+# poll.py забирає до 100 апдейтів за getUpdates. Пачка обробляється однією
+# транзакцією в порядку надходження (як і під вебхуком), рядки players/inventory
+# усіх гравців пачки читаються наперед, а кожен апдейт — під своїм savepoint,
+# тож помилка одного не відкочує решту.
+def update_player_key(update):
+    """(chat_id, user_id) для команди або callback; None — апдейт обробляти не треба."""
     callback = update.get('callback_query')
     if callback:
-        data = callback.get('data')
-        chat_id = callback['message']['chat']['id']
-        message_id = callback['message']['message_id']
-        from_user = callback['from']
-        user_id = from_user['id']
-
-        if data.startswith("fight:"):
-            _, attacker_id, defender_id = data.split(":")
-            attacker_id = int(attacker_id)
-            defender_id = int(defender_id)
-            if user_id != attacker_id:
-                return jsonify({'ok': True})
-            process_fight(chat_id, attacker_id, defender_id)
-            delete_message(chat_id, message_id)
+        message = callback.get('message') or {}
+        return (message.get('chat') or {}).get('id'), callback['from']['id']
+    msg = update.get('message') or update.get('edited_message')
+    if not msg or not (msg.get('text') or '').startswith('/'):
+        return None
+    return (msg.get('chat') or {}).get('id'), (msg.get('from') or {}).get('id')
+
+def batch_updates(updates):
+    """Апдейти пачки, які треба обробити, у порядку надходження. Гравці впливають один на
+    одного (/fight, /use, /royale, /top), тож переставляти апдейти не можна: гравці пачки
+    потрібні лише для вибору рядків, що читаються наперед."""
+    kept = []
+    for update in updates:
+        key = update_player_key(update)
+        if not update.get('my_chat_member') and (key is None or None in key):
+            incr("poll.shed")
+            continue
+        kept.append(update)
+    return kept
+
+def process_batch(updates):
+    """Обробляє пачку апдейтів однією транзакцією; повертає кількість оброблених."""
+    ordered = batch_updates(updates)
+    if not ordered:
+        return 0
+    failed = []
+    started = time.perf_counter()
+    with storage.transaction(), storage.prefetch({update_player_key(u) for u in ordered} - {None}):
+        for update in ordered:
+            seed = capture_update(update)
+            try:
+                with storage.savepoint():
+                    run_update(update, seed)
+            except Exception as e:
+                print('batch update error:', e)
+                failed.append((update, seed))
+    record_timing("poll.batch", time.perf_counter() - started)
+    # Апдейт, що зламав свій savepoint, ще раз окремо — як повтор вебхука Telegram
+    for update, seed in failed:
+        incr("poll.retried")
+        try:
+            run_update(update, seed)
+        except Exception as e:
+            print('update error:', e)
+            incr("poll.failed")
+    incr("poll.batches")
+    incr("poll.updates", len(ordered))
+    if OUTBOX_ENABLED:
+        outbox.wake()  # відповіді пачки закомічені разом — доставляти одразу
+    return len(ordered)
+# ====================================
+
+def handle_callback(callback):
+    """Натискання inline-кнопки. Токен перевіряється до будь-яких запитів до БД, а на
+    callback відповідаємо завжди (під вебхуком — у тілі відповіді на нього), інакше
+    клієнт крутить спінер і кнопку тиснуть знову."""
+    message = callback.get('message') or {}
+    chat_id = (message.get('chat') or {}).get('id')
+    message_id = message.get('message_id')
+    user_id = callback['from']['id']
+    decoded = read_callback(chat_id, callback.get('data') or '')
+    if decoded is None:
+        incr("callback.invalid")
+        answer_callback(callback['id'], "Ця кнопка більше не працює. Виклич команду ще раз.")
+        return
+    action, args, expires = decoded
+    if expires < time.time():
+        incr("callback.expired")
+        answer_callback(callback['id'], "Кнопка застаріла. Виклич команду ще раз.")
+        delete_message(chat_id, message_id)
+        return
+    if user_id != args[0]:
+        incr("callback.foreign")
+        answer_callback(callback['id'], "Це не твоя бійка." if action == 'fight' else "Ти не можеш використовувати чужі предмети.")
+        return
+    if not callback_presses.first(chat_id, message_id, callback['id'], expires):
+        incr("callback.duplicate")
+        answer_callback(callback['id'])
+        return
+    answer_callback(callback['id'])
+    # Відкат транзакції (пачки poll.py) повертає натискання: Telegram/poll.py повторять апдейт
+    storage.after_rollback(callback_presses.finish, chat_id, message_id, callback['id'], False)
+
+    try:
+        if action == 'fight':
+            attacker_id, defender_id = args
+            with player_lock(chat_id, attacker_id, defender_id):
+                process_fight(chat_id, attacker_id, defender_id)
         # --- Обробка вибору предмета ---
-        elif data.startswith("use_item:"):
-            _, source_user_id, item_key = data.split(":")
-            if user_id != int(source_user_id):
-                send_message(chat_id, user_id, "Ти не можеш використовувати чужі предмети.")
-                delete_message(chat_id, message_id)
-                return
-            
+        elif action == 'use_item':
+            source_user_id, item_key = args
             opponents = get_alive_opponents(chat_id, user_id)
             if not opponents:
                 send_message(chat_id, user_id, "У цьому чаті немає живих пацєток, на яких можна використати предмет.")
-                delete_message(chat_id, message_id)
-                return
-            
-            buttons = []
-            for opp in opponents:
-                label = f"{opp['pet_name']} ({opp['weight']} кг)"
-                buttons.append([{"text": label, "callback_data": f"use_target:{source_user_id}:{item_key}:{opp['user_id']}"}])
-            
-            item_name = ITEMS.get(item_key, {}).get('u_name', item_key)
-            send_message(chat_id, user_id, f"Використовуєш {item_name}. Обери пацєтка:", reply_markup={"inline_keyboard": buttons})
-            delete_message(chat_id, message_id)
+            else:
+                buttons = []
+                for opp in opponents:
+                    label = f"{opp['pet_name']} ({opp['weight']} кг)"
+                    buttons.append([{"text": label, "callback_data": make_callback(chat_id, 'use_target', source_user_id, item_key, opp['user_id'])}])
+                item_name = GAME.item_name(item_key)
+                send_message(chat_id, user_id, f"Використовуєш {item_name}. Обери пацєтка:", reply_markup={"inline_keyboard": buttons})
         # --- Обробка вибору цілі ---
-        elif data.startswith("use_target:"):
-            _, source_user_id, item_key, target_user_id = data.split(":")
-            if user_id != int(source_user_id):
-                send_message(chat_id, user_id, "Ти не можеш використовувати чужі предмети.")
-                delete_message(chat_id, message_id)
-                return
-            
-            handle_use_item_on_pet(chat_id, int(source_user_id), item_key, int(target_user_id))
-            delete_message(chat_id, message_id)
+        elif action == 'use_target':
+            source_user_id, item_key, target_user_id = args
+            with player_lock(chat_id, source_user_id, target_user_id):
+                handle_use_item_on_pet(chat_id, source_user_id, item_key, target_user_id)
+    except Exception as e:
+        print('error handling callback', e)
+        callback_presses.finish(chat_id, message_id, callback['id'], False)
+        send_message(chat_id, user_id, 'Сталася помилка при обробці команди.')
+    else:
+        storage.after_commit(callback_presses.finish, chat_id, message_id, callback['id'], True)
+    delete_message(chat_id, message_id)
 
-        return jsonify({'ok': True})
+def process_update(update):
+    """Обробляє один апдейт Telegram (повідомлення з командою, callback або зміну членства бота)."""
+    if update.get('my_chat_member'):
+        handle_bot_membership(update['my_chat_member'])
+        return
+    # --- Обробка callback ---
+    callback = update.get('callback_query')
+    if callback:
+        handle_callback(callback)
+        return
     # ========================================================
     
     msg = update.get('message') or update.get('edited_message')
     if not msg:
-        return jsonify({'ok': True})
+        return
     chat = msg.get('chat') or {}
     chat_id = chat.get('id')
     from_u = msg.get('from') or {}
@@ -1349,14 +4511,16 @@ def telegram_webhook():
     message_id = msg.get('message_id')
     
     is_command = text.startswith('/')
-    if is_command and chat_id < 0: # Delete user's command message in group chats
+    if is_command and chat_id < 0 and pressure.degrade(pressure.SKIP_CLEANUP, "pressure.skip_cleanup"):
+        pass
+    elif is_command and chat_id < 0: # Delete user's command message in group chats
         try:
             delete_message(chat_id, message_id)
         except Exception as e:
             print(f"Failed to delete user's command message: {e}")
             
     if not is_command:
-        return jsonify({'ok': True})
+        return
         
     parts = text.split(maxsplit=1)
     cmd_full = parts[0].lower()
@@ -1365,11 +4529,14 @@ def telegram_webhook():
     if '@' in cmd_full:
         cmd_name, cmd_user = cmd_full.split('@', 1)
         if BOT_USERNAME and cmd_user != BOT_USERNAME:
-            return jsonify({'ok': True})
+            return
         cmd = cmd_name
     else:
         cmd = cmd_full
 
+    if cmd in SHIELDED_COMMANDS and shield.intercept(chat_id, user_id, SHIELDED_COMMANDS[cmd]):
+        return
+
     try:
         if cmd == '/start':
             handle_start(chat_id, user_id)
@@ -1377,23 +4544,32 @@ def telegram_webhook():
             handle_name(chat_id, user_id, username, arg)
         elif cmd == '/top':
             handle_top(chat_id, user_id)
+        elif cmd == '/stats':
+            handle_stats(chat_id, user_id, username)
+        elif cmd == '/globaltop':
+            handle_globaltop(chat_id, user_id)
         elif cmd == '/pet':
-            handle_pet(chat_id, user_id, username)
+            with player_lock(chat_id, user_id):
+                handle_pet(chat_id, user_id, username)
         elif cmd == '/inventory':
             handle_inventory(chat_id, user_id, username)
         elif cmd == '/feed':
-            handle_feed(chat_id, user_id, username, arg)
+            with player_lock(chat_id, user_id):
+                handle_feed(chat_id, user_id, username, arg)
         elif cmd == '/zonewalk':
-            handle_zonewalk(chat_id, user_id, username, arg)
+            with player_lock(chat_id, user_id):
+                handle_zonewalk(chat_id, user_id, username, arg)
         elif cmd == '/wheel':
-            handle_wheel(chat_id, user_id, username)
+            with player_lock(chat_id, user_id):
+                handle_wheel(chat_id, user_id, username)
         elif cmd == '/toggle_cleanup':
             handle_toggle_cleanup(chat_id, user_id)
         elif cmd == '/clear_chat':
             handle_clear_chat(chat_id, user_id)
         # === NEW FEATURE: Смерть і вербування (New command) ===
         elif cmd == '/recruit':
-            handle_recruit(chat_id, user_id, username)
+            with player_lock(chat_id, user_id):
+                handle_recruit(chat_id, user_id, username)
         elif cmd == '/check_recruits':
             handle_check_recruits(chat_id, user_id, username)
         # =======================================================
@@ -1403,16 +4579,20 @@ def telegram_webhook():
         # =======================================================
         elif cmd == '/use':
             handle_use(chat_id, user_id, username)
+        elif cmd == '/royale':
+            handle_royale(chat_id, user_id)
+        elif cmd == '/remind':
+            handle_remind(chat_id, user_id, username)
         else:
             send_message(chat_id, user_id, 'Невідома команда.')
     except Exception as e:
         print('error handling command', e)
         send_message(chat_id, user_id, 'Сталася помилка при обробці команди.')
-    return jsonify({'ok': True})
 
 if __name__ == '__main__':
     get_bot_username()
     if DATABASE_URL:
         init_db()
+        start_background_jobs()
     set_webhook()
     app.run(host='0.0.0.0', port=PORT)
@@ -0,0 +1,87 @@
+"""Запуск бота через long polling (getUpdates) замість вебхука — без публічної адреси.
+
+Приклади:
+    python poll.py                                  # DATABASE_URL і TELEGRAM_TOKEN з оточення
+    python poll.py --db sqlite:///pacetko.db        # локально, без Postgres
+    python poll.py --timeout 50 --limit 100
+
+Вебхук при старті знімається (з ним getUpdates повертає 409). Кожен виклик
+getUpdates забирає до --limit апдейтів, і вся пачка обробляється однією
+транзакцією (main.process_batch) у порядку надходження, рядки players/inventory —
+одним запитом наперед. Наступний getUpdates підтверджує пачку (offset), тож після
+падіння до коміту вона прийде знову; якщо пачку зламала помилка БД, вона
+повторюється з паузою, а offset не зсувається. Щоб повернутися до вебхука, досить
+знову запустити main.py з WEBHOOK_BASE_URL.
+"""
+import argparse
+import os
+import sys
+import time
+
+
+def fetch_updates(bot, session, offset, timeout, limit):
+    payload = {"timeout": timeout, "limit": limit, "allowed_updates": bot.WEBHOOK_ALLOWED_UPDATES}
+    if offset is not None:
+        payload["offset"] = offset
+    data = session.post(bot.telegram_url('getUpdates'), json=payload, timeout=timeout + 10).json()
+    if not data.get('ok'):
+        raise RuntimeError(f"getUpdates: {data.get('error_code')} {data.get('description')}")
+    return data['result']
+
+
+def run_polling(bot, timeout, limit, report_seconds=60):
+    session = bot.requests.Session()
+    offset, backoff = None, 1
+    processed, started, printed = 0, time.perf_counter(), time.perf_counter()
+    while True:
+        try:
+            updates = fetch_updates(bot, session, offset, timeout, limit)
+            backoff = 1
+        except Exception as e:
+            print('poll error:', e, file=sys.stderr)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+        if updates:
+            try:
+                processed += bot.process_batch(updates)
+            except Exception as e:
+                # Транзакція пачки відкотилася (з'єднання, prefetch, COMMIT) — ту саму пачку ще раз
+                print('batch error:', e, file=sys.stderr)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            offset = updates[-1]['update_id'] + 1
+        now = time.perf_counter()
+        if now - printed >= report_seconds:
+            printed = now
+            print(f"  processed {processed} updates, {processed / (now - started):.1f} upd/s", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot with getUpdates long polling")
+    parser.add_argument('--db', default=os.getenv('DATABASE_URL'), help="DATABASE_URL (за замовчуванням з оточення)")
+    parser.add_argument('--timeout', type=int, default=30, help="скільки секунд Telegram тримає getUpdates без апдейтів")
+    parser.add_argument('--limit', type=int, default=100, help="апдейтів за виклик (1-100), тобто розмір пачки")
+    args = parser.parse_args()
+    if not args.db:
+        parser.error("--db or DATABASE_URL is required")
+    if not 1 <= args.limit <= 100:
+        parser.error("--limit must be between 1 and 100")
+
+    os.environ['DATABASE_URL'] = args.db
+    os.environ.pop('WEBHOOK_BASE_URL', None)
+    import main as bot
+
+    bot.get_bot_username()
+    bot.init_db()
+    bot.delete_webhook()
+    bot.start_background_jobs()
+    try:
+        run_polling(bot, args.timeout, args.limit)
+    except KeyboardInterrupt:
+        print("stopped", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Відтворення захопленого трафіку (CAPTURE_DIR) через обробники бота.
+
+Приклади:
+    python replay.py captures/updates-*.jsonl.gz
+    python replay.py captures/*.jsonl.gz --pace recorded --speed 10
+    python replay.py captures/*.jsonl.gz --db sqlite:///scratch.db
+
+Апдейти обробляються тими самими process_update/handlers, але на чистій БД
+(за замовчуванням SQLite у пам'яті) і з заглушкою Telegram API замість мережі.
+Кожен апдейт отримує записаний seed і записаний час, тож результат детермінований.
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+
+class StubResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+        self.text = str(data)
+
+    def json(self):
+        return self._data
+
+
+class StubTelegram:
+    """Підміняє модуль requests у main: відповідає як Telegram, нічого не відправляючи."""
+
+    def __init__(self):
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+
+    def post(self, url, json=None, data=None, timeout=None, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'sendMessage':
+            return StubResponse({"ok": True, "result": {"message_id": next(self._message_ids)}})
+        if method == 'getChatMember':
+            return StubResponse({"ok": True, "result": {"status": "administrator"}})
+        return StubResponse({"ok": True, "result": True})
+
+    get = post
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured Telegram updates")
+    parser.add_argument('captures', nargs='+', help="файли updates-*.jsonl.gz")
+    parser.add_argument('--db', default='sqlite:///:memory:', help="DATABASE_URL чистої БД (не продакшн!)")
+    parser.add_argument('--pace', choices=['fast', 'recorded'], default='fast', help="як швидко подавати апдейти")
+    parser.add_argument('--speed', type=float, default=1.0, help="прискорення для --pace recorded")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.db
+    os.environ.setdefault('TELEGRAM_TOKEN', 'replay')
+    os.environ.pop('CAPTURE_DIR', None)
+    os.environ.pop('WEBHOOK_BASE_URL', None)
+    import main as bot
+
+    stub = StubTelegram()
+    bot.requests = stub
+    bot.outbox.background = False  # outbox дренується синхронно після кожного апдейта
+    bot.archiver.background = False
+    bot.digest.background = False
+    bot.reminders.background = False
+    bot.init_db()
+
+    latencies = []
+    errors = 0
+    prev_ts = None
+    started = time.perf_counter()
+    for record in bot.iter_capture(args.captures):
+        if args.pace == 'recorded' and prev_ts is not None:
+            time.sleep(max(0.0, (record['ts'] - prev_ts) / args.speed))
+        prev_ts = record['ts']
+
+        recorded_now = datetime.fromtimestamp(record['ts'], tz=timezone.utc)
+        bot.now_utc = lambda: recorded_now
+
+        t0 = time.perf_counter()
+        try:
+            with bot.coalesce_messages(record['update'].get('update_id')), bot.storage.session(), bot.pin_game(), \
+                    bot.seeded_random(record.get('seed')):
+                bot.process_update(record['update'])
+        except Exception as e:
+            errors += 1
+            print('replay error:', e, file=sys.stderr)
+        latencies.append(time.perf_counter() - t0)
+        bot.outbox.drain()
+
+    elapsed = time.perf_counter() - started
+    print(f"updates: {len(latencies)}, errors: {errors}, elapsed: {elapsed:.3f}s, "
+          f"rate: {len(latencies) / elapsed if elapsed else 0:.1f} upd/s")
+    print(f"latency ms: p50={percentile(latencies, 0.50) * 1000:.2f} "
+          f"p95={percentile(latencies, 0.95) * 1000:.2f} p99={percentile(latencies, 0.99) * 1000:.2f}")
+    print("telegram calls:", ", ".join(f"{k}={v}" for k, v in sorted(stub.calls.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Потоковий знімок стану гри (players, inventory, players_archive) у теку і назад.
+
+Приклади:
+    python snapshot.py export backups/2026-10-18                   # усе, DATABASE_URL з оточення
+    python snapshot.py export backups/chat --chat -100123 --chat -100456
+    python snapshot.py import backups/2026-10-18 --db postgresql://...
+
+Кожна таблиця пишеться через COPY ... TO STDOUT (у SQLite — курсором) у частини
+<table>.NNNN.csv.gz по --part-mb МБ незжатого CSV; частини ріжуться по межі рядка,
+тож кожна — самостійний CSV. manifest.json описує колонки, ключі та частини.
+Імпорт вантажить частини по одній (COPY FROM у тимчасову таблицю + upsert), тож
+пам'ять не залежить від розміру знімка. Після імпорту init_db() приводить
+інвентар до поточного INVENTORY_LAYOUT.
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+# Порядок важливий лише для читабельності manifest; ключі — для upsert при імпорті
+SNAPSHOT_TABLES = (
+    ('players', ('chat_id', 'user_id')),
+    ('inventory', ('chat_id', 'user_id', 'item')),
+    ('players_archive', ('chat_id', 'user_id')),
+)
+MANIFEST_VERSION = 1
+
+
+class Progress:
+    def __init__(self, table):
+        self.table = table
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.bytes = 0
+        self._printed = 0.0
+
+    def update(self, rows, nbytes, force=False):
+        self.rows += rows
+        self.bytes += nbytes
+        now = time.perf_counter()
+        if force or now - self._printed >= 1.0:
+            self._printed = now
+            elapsed = now - self.started
+            print(f"  {self.table}: {self.rows} rows, {self.bytes / 1e6:.1f} MB, "
+                  f"{self.rows / elapsed if elapsed else 0:.0f} rows/s", file=sys.stderr)
+
+
+class PartWriter:
+    """File-like для COPY TO: пише CSV у стиснуті частини, починаючи нову лише на межі рядка.
+
+    Кінець рядка — перенос поза лапками; лапки всередині поля подвоєні, тож стан
+    "у лапках" — це просто парність кількості лапок.
+    """
+
+    def __init__(self, directory, table, part_bytes, progress):
+        self.directory = directory
+        self.table = table
+        self.part_bytes = part_bytes
+        self.progress = progress
+        self.parts = []
+        self._out = None
+        self._size = 0
+        self._in_quotes = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        start = offset = 0
+        rows = 0
+        for i, segment in enumerate(data.split(b'"')):
+            if (i % 2 == 1) == self._in_quotes:  # сегмент поза лапками
+                nl = segment.find(b'\n')
+                while nl != -1:
+                    rows += 1
+                    end = offset + nl + 1
+                    if self._size + end - start >= self.part_bytes:
+                        self._write(data[start:end])
+                        start = end
+                        self._close_part()
+                    nl = segment.find(b'\n', nl + 1)
+            offset += len(segment) + 1
+        if data.count(b'"') % 2:
+            self._in_quotes = not self._in_quotes
+        if start < len(data):
+            self._write(data[start:])
+        self.progress.update(rows, len(data))
+        return len(data)
+
+    def _write(self, chunk):
+        if self._out is None:
+            name = f"{self.table}.{len(self.parts):04d}.csv.gz"
+            self.parts.append(name)
+            self._out = gzip.open(os.path.join(self.directory, name), 'wb', compresslevel=6)
+        self._out.write(chunk)
+        self._size += len(chunk)
+
+    def _close_part(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+            self._size = 0
+
+    def close(self):
+        self._close_part()
+
+
+def export_snapshot(bot, directory, chat_ids, part_mb):
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "engine": bot.storage.name,
+        "chats": chat_ids or None,
+        "tables": {},
+    }
+    for table, keys in SNAPSHOT_TABLES:
+        columns = [c for c in bot.storage.table_columns(table) if c != 'id']
+        progress = Progress(table)
+        writer = PartWriter(directory, table, part_mb * 1024 * 1024, progress)
+        try:
+            bot.storage.copy_out(table, columns, chat_ids, writer)
+        finally:
+            writer.close()
+        progress.update(0, 0, force=True)
+        manifest["tables"][table] = {"columns": columns, "keys": list(keys), "parts": writer.parts, "rows": progress.rows}
+    # manifest пишеться останнім: теку без нього імпорт не прийме
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def import_snapshot(bot, directory):
+    with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as fh:
+        manifest = json.load(fh)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise SystemExit(f"unsupported snapshot version: {manifest.get('version')}")
+    bot.init_db()
+    for table, spec in manifest["tables"].items():
+        progress = Progress(table)
+        for part in spec["parts"]:
+            path = os.path.join(directory, part)
+            with gzip.open(path, 'rb') as src:
+                rows = bot.storage.copy_in(table, spec["columns"], spec["keys"], src)
+            progress.update(rows, os.path.getsize(path), force=True)
+        if progress.rows != spec["rows"]:
+            print(f"  {table}: {progress.rows} rows upserted, manifest says {spec['rows']}", file=sys.stderr)
+    bot.init_db()  # інвентар у поточний INVENTORY_LAYOUT
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export/import game state snapshots")
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export', help="записати знімок у теку")
+    exp.add_argument('directory')
+    exp.add_argument('--chat', type=int, action='append', default=[], help="лише цей чат (можна повторювати)")
+    exp.add_argument('--part-mb', type=int, default=64, help="розмір частини, МБ незжатого CSV")
+    imp = sub.add_parser('import', help="завантажити знімок з теки (upsert)")
+    imp.add_argument('directory')
+    for p in (exp, imp):
+        p.add_argument('--db', default=os.getenv('DATABASE_URL'), help="DATABASE_URL (за замовчуванням з оточення)")
+    args = parser.parse_args()
+    if not args.db:
+        parser.error("--db or DATABASE_URL is required")
+
+    os.environ['DATABASE_URL'] = args.db
+    os.environ.setdefault('TELEGRAM_TOKEN', 'snapshot')
+    os.environ.pop('WEBHOOK_BASE_URL', None)
+    import main as bot
+
+    started = time.perf_counter()
+    if args.command == 'export':
+        manifest = export_snapshot(bot, args.directory, args.chat, args.part_mb)
+    else:
+        manifest = import_snapshot(bot, args.directory)
+    total = sum(t["rows"] for t in manifest["tables"].values())
+    print(f"{args.command}: {total} rows in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()